@@ -1,15 +1,22 @@
+import os
 import logging
 import hashlib
 
+import joblib
 import numpy as np
 import yaml
 import desmeds
 
-from constants import MEDSCONF, PIFF_RUN
+from constants import MEDSCONF, PIFF_RUN, BOUNDS_BUFFER_UV
 from files import (
     get_band_info_file,
+    get_ccd_footprint_file,
+    get_psfex_fit_cache_dir,
+    expand_path,
     make_dirs_for_file)
 from des_info import add_extra_des_coadd_tile_info
+from sky_bounding import make_ccd_footprints, write_ccd_footprints
+from wcsing import get_galsim_wcs
 
 logger = logging.getLogger(__name__)
 
@@ -83,6 +90,86 @@ def make_band_info(*, tilename, bands, output_meds_dir, n_files=None):
         with open(band_info_file, 'w') as fp:
             yaml.dump(info, fp)
 
+        # the CCD footprints are reused by the later stages to find the
+        # objects on each SE image
+        write_ccd_footprints(
+            filename=get_ccd_footprint_file(
+                meds_dir=output_meds_dir,
+                medsconf=cfg['medsconf'],
+                tilename=tilename,
+                band=band),
+            footprints=make_ccd_footprints(
+                src_info=info['src_info'],
+                bounds_buffer_uv=BOUNDS_BUFFER_UV),
+            bounds_buffer_uv=BOUNDS_BUFFER_UV)
+
         fnames[band] = band_info_file.replace(output_meds_dir, '$MEDS_DIR')
 
     return fnames
+
+
+def make_psfex_fit_cache(*, tilename, bands, output_meds_dir, n_jobs=None):
+    """Fit the smooth PSF models of all of the SE images of a tile and
+    cache them on disk so that the later stages do not redo the fits.
+
+    See `des_psfex.DES_PSFEx_Deconv`. The band info files must have been
+    made with `make_band_info`.
+
+    Parameters
+    ----------
+    tilename : str
+        The DES coadd tilename (e.g., 'DES2122+0001').
+    bands : list of str
+        A list of bands to process (e.g., `['r', 'i', 'z']`).
+    output_meds_dir : str
+        The DESDATA/MEDS_DIR path where the info files are located. The
+        fits are written to `files.get_psfex_fit_cache_dir`.
+    n_jobs : int, optional
+        The number of processes to use. If None, use all of the CPUs as
+        determined by the `loky` package in `joblib.externals`.
+
+    Returns
+    -------
+    cache_dir : str
+        The directory with the fits.
+    """
+    if n_jobs is None:
+        n_jobs = joblib.externals.loky.cpu_count()
+
+    cache_dir = get_psfex_fit_cache_dir(
+        meds_dir=output_meds_dir,
+        medsconf=MEDSCONF,
+        tilename=tilename)
+
+    jobs = []
+    for band in bands:
+        fname = get_band_info_file(
+            meds_dir=output_meds_dir,
+            medsconf=MEDSCONF,
+            tilename=tilename,
+            band=band)
+        with open(fname, 'r') as fp:
+            info = yaml.load(fp, Loader=yaml.Loader)
+
+        for se_info in info['src_info']:
+            jobs.append(joblib.delayed(_fit_psfex_model)(
+                psfex_path=se_info['psfex_path'],
+                image_path=se_info['image_path'],
+                image_ext=se_info['image_ext'],
+                cache_dir=cache_dir))
+
+    logger.info(
+        ' fitting %d PSFEx models for coadd tile %s', len(jobs), tilename)
+    with joblib.Parallel(n_jobs=n_jobs, backend='loky', verbose=0) as p:
+        p(jobs)
+
+    return cache_dir
+
+
+def _fit_psfex_model(*, psfex_path, image_path, image_ext, cache_dir):
+    from des_psfex import DES_PSFEx_Deconv
+    wcs = get_galsim_wcs(image_path=image_path, image_ext=image_ext)
+    psf_model = DES_PSFEx_Deconv(
+        expand_path(psfex_path), wcs=wcs, fit_cache_dir=cache_dir)
+    if not os.path.exists(psf_model.get_fit_cache_path()):
+        psf_model._fit_smooth_model()
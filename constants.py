@@ -7,3 +7,7 @@ POSITION_OFFSET = 1
 # never change these
 MEDSCONF = 'y3v02'
 PIFF_RUN = 'y3a1-v29'
+
+# any object within a 128 coadd pixel buffer of the edge of a CCD
+# will be rendered for that CCD
+BOUNDS_BUFFER_UV = 128 * 0.263
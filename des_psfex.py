@@ -1,14 +1,217 @@
 import os
+import logging
+import hashlib
+import collections
 
 import numpy as np
 import galsim
-from galsim.des import DES_PSFEx
+import joblib
 import ngmix
 from ngmix.fitting import Fitter as LMSimple
 from ngmix.admom import AdmomFitter as Admom
 
 from scipy.interpolate import CloughTocher2DInterpolator
 
+from psfex_batching import DES_PSFExBatch
+
+logger = logging.getLogger(__name__)
+
+
+
+# bump this if the smooth model fit changes so that old caches are not used
+_FIT_VERSION = 2
+
+
+def _write_fit_cache(*, fname, xloc, yloc, pars):
+    # write to a temporary file first so that other processes never see
+    # a partial file
+    dirname = os.path.dirname(fname)
+    if len(dirname) > 0:
+        os.makedirs(dirname, exist_ok=True)
+    tmp_fname = fname[:-len('.npz')] + '.tmp%d.npz' % os.getpid()
+    np.savez(tmp_fname, xloc=xloc, yloc=yloc, pars=pars)
+    os.replace(tmp_fname, fname)
+
+
+def _fit_grid_chunk(*, psf_model, x, y, seeds):
+    # draw the whole chunk first and then fit it
+    images = psf_model._draw_grid_images(x=x, y=y)
+    return _fit_grid_images(images=images, seeds=seeds)
+
+
+def _fit_grid_images(*, images, seeds):
+    """Fit a 'turb' model to each of a stack of PSF images.
+
+    The fits start from the adaptive moments of the whole stack, measured
+    at once with `_admom_stack`. Images for which that fails are retried
+    with ngmix's adaptive moments from random starting points.
+
+    Parameters
+    ----------
+    images : np.ndarray, shape (n, 19, 19)
+        The PSF images at a pixel scale of 0.25 arcsec.
+    seeds : np.ndarray, shape (n,)
+        The seeds of the RNGs used to guess the starting point of the
+        retried adaptive moments for each image.
+
+    Returns
+    -------
+    pars : np.ndarray, shape (n, 3)
+        The g1, g2 and T of the fits. NaN if a fit failed.
+    """
+    # the noise level from the top and bottom rows of all images at once
+    nse = np.std(
+        np.concatenate([images[:, 0, :], images[:, -1, :]], axis=1), axis=1)
+    jac = ngmix.jacobian.DiagonalJacobian(x=9, y=9, scale=0.25)
+
+    # the adaptive moments of the whole stack give the starting points of
+    # the 'turb' fits
+    am_pars, am_flags = _admom_stack(images=images, cen=9, scale=0.25, T=0.3)
+
+    pars = np.full((images.shape[0], 3), np.nan, dtype=np.float64)
+    for i in range(images.shape[0]):
+        img = images[i]
+        obs = ngmix.Observation(
+            image=img,
+            weight=np.ones_like(img)/nse[i]**2,
+            jacobian=jac)
+
+        if am_flags[i] == 0:
+            try:
+                lm = LMSimple('turb')
+                lm_res = lm.go(obs, am_pars[i])
+                if lm_res['flags'] == 0:
+                    pars[i, :] = lm_res['pars'][2:5]
+                    continue
+            except ngmix.gexceptions.GMixRangeError:
+                pass
+
+        # fall back to ngmix's adaptive moments from random starting points
+        rng = np.random.RandomState(seed=seeds[i])
+        for count in range(5):
+            try:
+                am = Admom(rng=rng)
+                res = am.go(obs, 0.3)
+                if res['flags'] != 0:
+                    continue
+
+                lm = LMSimple('turb')
+                lm_res = lm.go(obs, res['pars'])
+                if lm_res['flags'] == 0:
+                    pars[i, :] = lm_res['pars'][2:5]
+                    break
+            except ngmix.gexceptions.GMixRangeError:
+                pass
+
+    return pars
+
+
+def _admom_stack(*, images, cen, scale, T, max_iter=100, tol=1e-4):
+    """Measure the adaptive moments of a stack of images at once.
+
+    Each image is weighted by the Gaussian with twice its weighted moments
+    until they stop changing, as in ngmix's adaptive moments.
+
+    Parameters
+    ----------
+    images : np.ndarray, shape (n, ny, nx)
+        The images.
+    cen : float
+        The pixel of the center of the coordinate system in both
+        directions.
+    scale : float
+        The pixel scale.
+    T : float
+        The starting size of the weight function.
+    max_iter : int, optional
+        The maximum number of iterations. Default is 100.
+    tol : float, optional
+        The tolerance on the relative change of the size and the change of
+        the ellipticity. Default is 1e-4.
+
+    Returns
+    -------
+    pars : np.ndarray, shape (n, 6)
+        The v, u, g1, g2, T and flux of the Gaussian with the adaptive
+        moments of each image.
+    flags : np.ndarray, shape (n,)
+        Zero where the moments converged.
+    """
+    n = images.shape[0]
+    rows, cols = np.mgrid[0:images.shape[1], 0:images.shape[2]]
+    v = (rows - cen) * scale
+    u = (cols - cen) * scale
+
+    v0 = np.zeros(n)
+    u0 = np.zeros(n)
+    Mvv = np.full(n, T / 2)
+    Muu = np.full(n, T / 2)
+    Muv = np.zeros(n)
+    flags = np.ones(n, dtype=np.int32)
+
+    def _sum(arr):
+        return np.sum(arr, axis=(1, 2))
+
+    for _ in range(max_iter):
+        det = Muu * Mvv - Muv**2
+        ok = det > 0
+        det[~ok] = 1
+
+        dv = v[np.newaxis] - v0[:, np.newaxis, np.newaxis]
+        du = u[np.newaxis] - u0[:, np.newaxis, np.newaxis]
+        chi2 = (
+            Mvv[:, np.newaxis, np.newaxis] * du**2
+            - 2 * Muv[:, np.newaxis, np.newaxis] * du * dv
+            + Muu[:, np.newaxis, np.newaxis] * dv**2
+        ) / det[:, np.newaxis, np.newaxis]
+        wim = np.exp(-0.5 * chi2) * images
+
+        wsum = _sum(wim)
+        ok &= wsum > 0
+        wsum[~ok] = 1
+        dv0 = _sum(wim * dv) / wsum
+        du0 = _sum(wim * du) / wsum
+        dv -= dv0[:, np.newaxis, np.newaxis]
+        du -= du0[:, np.newaxis, np.newaxis]
+        new_Mvv = 2 * _sum(wim * dv**2) / wsum
+        new_Muu = 2 * _sum(wim * du**2) / wsum
+        new_Muv = 2 * _sum(wim * du * dv) / wsum
+
+        T_old = Muu + Mvv
+        T_new = new_Muu + new_Mvv
+        ok &= T_new > 0
+        T_new[~ok] = 1
+        T_old[T_old <= 0] = 1
+        done = (
+            ok
+            & (np.abs(T_new / T_old - 1) < tol)
+            & (np.abs((new_Muu - new_Mvv) / T_new - (Muu - Mvv) / T_old) < tol)
+            & (np.abs(2 * new_Muv / T_new - 2 * Muv / T_old) < tol))
+
+        # freeze the images that converged or failed
+        upd = (flags != 0) & ok
+        v0[upd] += dv0[upd]
+        u0[upd] += du0[upd]
+        Mvv[upd] = new_Mvv[upd]
+        Muu[upd] = new_Muu[upd]
+        Muv[upd] = new_Muv[upd]
+        flags[(flags != 0) & done] = 0
+        flags[(flags != 0) & ~ok] = 2
+        if np.all(flags != 1):
+            break
+
+    T = Muu + Mvv
+    T_safe = np.where(T > 0, T, 1)
+    e1 = (Muu - Mvv) / T_safe
+    e2 = 2 * Muv / T_safe
+    e = np.sqrt(e1**2 + e2**2)
+    flags[e >= 1] = 3
+    # g = e / (1 + sqrt(1 - e^2))
+    gfac = 1 / (1 + np.sqrt(np.clip(1 - e**2, 0, 1)))
+
+    pars = np.stack(
+        [v0, u0, e1 * gfac, e2 * gfac, T, _sum(images)], axis=1)
+    return pars, flags
 
 
 class DES_PSFEx_Deconv(object):
@@ -18,73 +221,147 @@ class DES_PSFEx_Deconv(object):
     parameters of these models are then interpolated across the SE image
     and used to generate a smooth approximation to the PSF.
 
+    The fit is done on the first call to `getPSF`/`getPSFs`. Without a
+    cached fit, that call draws the 17x9 grid of PSF images one by one with
+    galsim and fits each of them with ngmix, which takes seconds per SE
+    image (divided by `fit_n_jobs` at best). Only the adaptive moments that
+    start the fits are computed for the whole grid at once. With a cached
+    fit, the call only reads the `.npz` file and builds the interpolants.
+
     Parameters
     ----------
     file_name : str
         The file with the Psfex psf solution.
+    wcs : galsim WCS object
+        The WCS of the SE image.
+    fit_cache_dir : str, optional
+        If not None, the fitted smooth model parameters are read from and
+        written to a `.npz` file in this directory, keyed by the checksum of
+        the PSFEx file and the WCS. See `get_fit_cache_path`.
+    fit_n_jobs : int, optional
+        The number of processes used to fit the smooth model. If None, use
+        all of the CPUs as determined by the `loky` package in
+        `joblib.externals`. Default is 1. Use 1 when the model is built
+        inside a worker of another process pool so the pools are not
+        nested.
+    psf_quantum : float, optional
+        If not None, the g1, g2 and T of the PSF model are rounded to a
+        multiple of this value and the PSF objects are kept in a LRU cache
+        keyed by the rounded values. Default is None.
     """
     _req_params = {'file_name': str}
     _opt_params = {}
     _single_params = []
     _takes_rng = False
 
-    def __init__(self, file_name, wcs):
+    def __init__(
+            self, file_name, wcs, fit_cache_dir=None, fit_n_jobs=1,
+            psf_quantum=None):
         self.file_name = file_name
         self.wcs = wcs
-        self._psfex = DES_PSFEx(os.path.expanduser(os.path.expandvars(file_name)), wcs = wcs)
+        self.fit_cache_dir = fit_cache_dir
+        self.fit_n_jobs = fit_n_jobs
+        self.psf_quantum = psf_quantum
+        self._psfs = collections.OrderedDict()
+        self._psfex = DES_PSFExBatch(os.path.expanduser(os.path.expandvars(file_name)), wcs = wcs)
         self._did_fit = False
 
+    def get_fit_cache_path(self):
+        """Get the path of the `.npz` file caching the smooth model fit.
+
+        The name is keyed by the checksum of the PSFEx file, the WCS and the
+        version of the fitting code, so a stale fit is never read.
+
+        Returns
+        -------
+        path : str or None
+            The path or None if there is no `fit_cache_dir`.
+        """
+        if self.fit_cache_dir is None:
+            return None
+
+        fname = os.path.expanduser(os.path.expandvars(self.file_name))
+        with open(fname, 'rb') as fp:
+            file_hash = hashlib.md5(fp.read()).hexdigest()
+        key = hashlib.sha1(repr((
+            file_hash, repr(self.wcs), _FIT_VERSION,
+        )).encode('utf-8')).hexdigest()[:16]
+
+        bname = os.path.basename(fname)
+        for ext in ['.fits.fz', '.fits']:
+            if bname.endswith(ext):
+                bname = bname[:-len(ext)]
+                break
+        return os.path.join(
+            os.path.expanduser(os.path.expandvars(self.fit_cache_dir)),
+            '%s_%s.npz' % (bname, key))
+
     def _fit_smooth_model(self):
+        cache_path = self.get_fit_cache_path()
+        if cache_path is not None and os.path.exists(cache_path):
+            data = np.load(cache_path)
+            xloc, yloc, pars = data['xloc'], data['yloc'], data['pars']
+        else:
+            xloc, yloc, pars = self._fit_pars()
+            if cache_path is not None:
+                _write_fit_cache(
+                    fname=cache_path, xloc=xloc, yloc=yloc, pars=pars)
+
+        self._make_interps(xloc=xloc, yloc=yloc, pars=pars)
+
+    def _fit_pars(self):
         dxy = 256
         ny = 4096 // dxy + 1
         nx = 2048 // dxy + 1
 
-        xloc = np.empty((ny, nx), dtype=np.float64)
-        yloc = np.empty((ny, nx), dtype=np.float64)
-        pars = np.empty((ny, nx, 3), dtype=np.float64)
-        for yi, yl in enumerate(np.linspace(1, 4096, ny)):
-            for xi, xl in enumerate(np.linspace(1, 2048, nx)):
-                rng = np.random.RandomState(seed=yi + nx * xi)
-                xloc[yi, xi] = xl
-                yloc[yi, xi] = yl
-
-                pos = galsim.PositionD(x=xl, y=yl)
-                img = self._draw(pos).drawImage(
-                    nx=19, ny=19, scale=0.25, method='sb').array
-                nse = np.std(
-                    np.concatenate([img[0, :], img[-1, :]]))
-                obs = ngmix.Observation(
-                    image=img,
-                    weight=np.ones_like(img)/nse**2,
-                    jacobian=ngmix.jacobian.DiagonalJacobian(
-                        x=9, y=9, scale=0.25))
-
-                _g1 = np.nan
-                _g2 = np.nan
-                _T = np.nan
-
-                
-                for count in range(5):
-                    try:
-                        am = Admom(rng=rng)
-                        res = am.go(obs, 0.3)
-                        if res['flags'] != 0:
-                            continue
-
-                        lm = LMSimple('turb')
-                        lm_res = lm.go(obs, res['pars'])
-                        if lm_res['flags'] == 0:
-                            _g1 = lm_res['pars'][2]
-                            _g2 = lm_res['pars'][3]
-                            _T = lm_res['pars'][4]
-                            break
-                    except ngmix.gexceptions.GMixRangeError:
-                        pass
-
-                pars[yi, xi, 0] = _g1
-                pars[yi, xi, 1] = _g2
-                pars[yi, xi, 2] = _T
-
+        yloc, xloc = np.meshgrid(
+            np.linspace(1, 4096, ny),
+            np.linspace(1, 2048, nx),
+            indexing='ij')
+        yi, xi = np.meshgrid(np.arange(ny), np.arange(nx), indexing='ij')
+        seeds = (yi + nx * xi).ravel()
+
+        # the grid points are fit in chunks so that they can be spread
+        # over a process pool
+        n_jobs = self.fit_n_jobs
+        if n_jobs is None:
+            n_jobs = joblib.externals.loky.cpu_count()
+        chunks = [
+            inds for inds in np.array_split(np.arange(ny * nx), max(n_jobs, 1))
+            if len(inds) > 0]
+        kwargs = [
+            dict(
+                psf_model=self,
+                x=xloc.ravel()[inds],
+                y=yloc.ravel()[inds],
+                seeds=seeds[inds])
+            for inds in chunks]
+        if n_jobs == 1:
+            outputs = [_fit_grid_chunk(**kws) for kws in kwargs]
+        else:
+            with joblib.Parallel(
+                    n_jobs=n_jobs, backend='loky', verbose=0) as p:
+                outputs = p(
+                    joblib.delayed(_fit_grid_chunk)(**kws) for kws in kwargs)
+
+        pars = np.concatenate(outputs, axis=0).reshape(ny, nx, 3)
+        return xloc, yloc, pars
+
+    def _draw_grid_images(self, *, x, y):
+        """Draw the 19x19 images of the deconvolved PSF at a set of image
+        positions into a single array of shape (len(x), 19, 19)."""
+        images = np.empty((len(x), 19, 19), dtype=np.float64)
+        image = galsim.ImageD(ncol=19, nrow=19, scale=0.25)
+        psfex_psfs = self.getPSFEx().getPSFs(x, y)
+        for i, (xl, yl) in enumerate(zip(x, y)):
+            pos = galsim.PositionD(x=xl, y=yl)
+            self._draw(pos, psfex_psf=psfex_psfs[i]).drawImage(
+                image=image, method='sb')
+            images[i] = image.array
+        return images
+
+    def _make_interps(self, *, xloc, yloc, pars):
+        pars = pars.copy()
         xloc = xloc.ravel()
         yloc = yloc.ravel()
         pos = np.stack([xloc, yloc], axis=1)
@@ -117,7 +394,9 @@ class DES_PSFEx_Deconv(object):
 
         self._did_fit = True
 
-    def _draw(self, image_pos, x_interpolant='lanczos15', gsparams=None):
+    def _draw(
+            self, image_pos, x_interpolant='lanczos15', gsparams=None,
+            psfex_psf=None):
         """Get an image of the PSF at the given location.
 
         Parameters
@@ -130,6 +409,8 @@ class DES_PSFEx_Deconv(object):
             The interpolant to use.
         gsparams : galsim.GSParams, optional
             Ootional galsim configuration data to pass along.
+        psfex_psf : galsim.GSObject, optional
+            The PSFEx model at `image_pos`, if it is already known.
 
         Returns
         -------
@@ -148,7 +429,9 @@ class DES_PSFEx_Deconv(object):
         dx = image_pos.x - int(image_pos.x + 0.5)
         dy = image_pos.y - int(image_pos.y + 0.5)
 
-        psf = self.getPSFEx().getPSF(image_pos).drawImage(
+        if psfex_psf is None:
+            psfex_psf = self.getPSFEx().getPSF(image_pos)
+        psf = psfex_psf.drawImage(
             #center=image_pos, #Dhayaa: Not using center here to drae image. PSF is already obtained at image_pos.
             image=image,
             offset=(-dx, -dy))
@@ -186,18 +469,67 @@ class DES_PSFEx_Deconv(object):
         psf : galsim.GSObject
             The PSF at the image position.
         """
+        return self.getPSFs(
+            np.array([image_pos.x]), np.array([image_pos.y]))[0]
+
+    def getPSFs(self, xs, ys):
+        """Get the PSFs at many image positions at once.
+
+        The smooth model is evaluated for all of the positions in one call
+        to each interpolator.
+
+        Parameters
+        ----------
+        xs : np.ndarray
+            The x image positions of the PSFs.
+        ys : np.ndarray
+            The y image positions of the PSFs.
+
+        Returns
+        -------
+        psfs : list of galsim.GSObject
+            The PSF at each image position.
+        """
         if not self._did_fit:
             self._fit_smooth_model()
 
-        arr = np.array([
-            np.clip(image_pos.x, 1, 2048),
-            np.clip(image_pos.y, 1, 4096)])
-
-        _g1 = self._g1int(arr)[0]
-        _g2 = self._g2int(arr)[0]
-        _T = self._Tint(arr)[0]
-        if np.any(np.isnan(np.array([_g1, _g2, _T]))):
-            print("\n\n\n", image_pos, _g1, _g2, _T, "\n\n\n", flush=True)
-        pars = np.array([0, 0, _g1, _g2, _T, 1])
-        obj = ngmix.gmix.make_gmix_model(pars, 'turb').make_galsim_object()
-        return obj.withFlux(1)
+        arr = np.stack([
+            np.clip(np.atleast_1d(xs), 1, 2048),
+            np.clip(np.atleast_1d(ys), 1, 4096)], axis=1)
+
+        g1 = self._g1int(arr)
+        g2 = self._g2int(arr)
+        T = self._Tint(arr)
+        bad = np.isnan(g1) | np.isnan(g2) | np.isnan(T)
+        if np.any(bad):
+            logger.warning(
+                'NaN PSF model parameters for %s at %d positions: %s',
+                self.file_name, np.sum(bad), arr[bad])
+
+        return [
+            self._get_turb_psf(_g1, _g2, _T)
+            for _g1, _g2, _T in zip(g1, g2, T)]
+
+    def _get_turb_psf(self, g1, g2, T):
+        if self.psf_quantum is None or not np.isfinite(g1 + g2 + T):
+            return _make_turb_psf(g1, g2, T)
+
+        key = (
+            int(np.round(g1 / self.psf_quantum)),
+            int(np.round(g2 / self.psf_quantum)),
+            int(np.round(T / self.psf_quantum)))
+        psf = self._psfs.get(key, None)
+        if psf is None:
+            psf = _make_turb_psf(*[k * self.psf_quantum for k in key])
+            self._psfs[key] = psf
+            if len(self._psfs) > 4096:
+                self._psfs.popitem(last=False)
+        else:
+            self._psfs.move_to_end(key)
+        return psf
+
+
+def _make_turb_psf(g1, g2, T):
+    pars = np.array([0, 0, g1, g2, T, 1])
+    obj = ngmix.gmix.make_gmix_model(pars, 'turb').make_galsim_object()
+    return obj.withFlux(1)
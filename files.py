@@ -146,6 +146,60 @@ def get_band_info_file(*, meds_dir, medsconf, tilename, band):
         '%s_%s_info.yaml' % (tilename, band))
 
 
+def get_ccd_footprint_file(*, meds_dir, medsconf, tilename, band):
+    """Get the path of the FITS file holding the rough sky footprints of
+    the SE images for the `tilename` and `band`.
+
+    Parameters
+    ----------
+    meds_dir : str
+        The DESDATA/MEDS_DIR path where the info file is located.
+    medsconf : str
+        The MEDS file version (e.g., 'y3v02').
+    tilename : str
+        The DES coadd tilename (e.g., 'DES2122+0001').
+    band : str
+        A band (e.g., 'r').
+
+    Returns
+    -------
+    footprint_file : str
+        The FITS file with the CCD footprints.
+    """
+    return os.path.join(
+        meds_dir,
+        'simple_des_y3_sims',
+        medsconf,
+        'band_info_files',
+        '%s_%s_footprints.fits' % (tilename, band))
+
+
+def get_psfex_fit_cache_dir(*, meds_dir, medsconf, tilename):
+    """Get the directory caching the smooth model fits of the PSFEx models
+    for the `tilename`. See `des_psfex.DES_PSFEx_Deconv`.
+
+    Parameters
+    ----------
+    meds_dir : str
+        The DESDATA/MEDS_DIR path where the cache is located.
+    medsconf : str
+        The MEDS file version (e.g., 'y3v02').
+    tilename : str
+        The DES coadd tilename (e.g., 'DES2122+0001').
+
+    Returns
+    -------
+    cache_dir : str
+        The directory with one `.npz` file per SE image.
+    """
+    return os.path.join(
+        meds_dir,
+        'simple_des_y3_sims',
+        medsconf,
+        'psfex_fits',
+        tilename)
+
+
 def get_piff_path_from_image_path(*, image_path, piff_run):
     """Get the piff path from the image path.
 
@@ -1,10 +1,12 @@
 import numpy as np
+import scipy.fft
 import galsim
 import joblib
 
 
 def render_sources_for_image(
-        *, image_shape, wcs, draw_method, src_inds, src_func, n_jobs=None):
+        *, image_shape, wcs, draw_method, src_inds, src_func, n_jobs=None,
+        n_variants=None, engine='stamp', use_templates=False):
     """Render a list of sources for a single image.
 
     Parameters
@@ -25,14 +27,36 @@ def render_sources_for_image(
             src : `galsim.GSObject` to be rendered.
             image_pos : `galsim.PositionD` the position of the object in the
                 image
+        If it has a method `stamp_size_key(src_ind)`, it is used to cache
+        the stamp sizes. See `StampSizeCache`. If it has a method
+        `prepare(src_inds)` returning lists of the image positions and local
+        WCS of the sources, it is called once for all of the sources instead
+        of computing the local WCS one by one. For the 'fft' engine, it must
+        also have the methods `constant_profiles()` and
+        `get_position(src_ind)`. See `render_stamps_fft`.
     n_jobs : int, optional
         The number of process to use. If None, then default to the number
         of CPUs as determined by the `loky` package in `joblib.externals`.
+    n_variants : int, optional
+        If not None, `src_func` returns a list of `n_variants` sources for
+        each object (e.g., the same galaxy with different shears). They are
+        all drawn at the same position with the same local WCS into
+        `n_variants` separate images.
+    engine : str, optional
+        Either 'stamp' to draw each source in its own stamp or 'fft' to
+        render all of the sources at once with `render_stamps_fft` if every
+        source has the same profile. The 'fft' engine falls back to 'stamp'
+        if `src_func.constant_profiles()` returns None. Default is 'stamp'.
+    use_templates : bool, optional
+        If True, sources with a `stamp_size_key` are interpolated from a
+        library of pre-rendered templates at sub-pixel offsets with the
+        'stamp' engine. See `StampTemplateCache`. Default is False.
 
     Returns
     -------
-    image : galsim.ImageD
-        The full image with all of the sources rendered.
+    image : galsim.ImageD or list of galsim.ImageD
+        The full image with all of the sources rendered. A list with one
+        image per variant is returned if `n_variants` is not None.
     """
 
     if n_jobs is None:
@@ -43,41 +67,702 @@ def render_sources_for_image(
     for job_ind in range(n_jobs):
         start = job_ind * n_srcs_per_job
         end = min(start + n_srcs_per_job, len(src_inds))
-        jobs.append(joblib.delayed(_render_list)(
-            src_inds[start:end], wcs, draw_method, image_shape, src_func))
+        jobs.append(joblib.delayed(render_stamps_for_image)(
+            image_shape=image_shape,
+            wcs=wcs,
+            draw_method=draw_method,
+            src_inds=src_inds[start:end],
+            src_func=src_func,
+            n_variants=n_variants,
+            engine=engine,
+            use_templates=use_templates))
 
     with joblib.Parallel(n_jobs=n_jobs, backend='loky', verbose=0) as p:
         outputs = p(jobs)
 
-    # sum the images
-    im = outputs[0]
-    if len(outputs) > 1:
-        for o in outputs[1:]:
-            im += o
+    # the jobs only send back their stamps so that there is only ever one
+    # full image per variant
+    ims = [
+        galsim.ImageD(nrow=image_shape[0], ncol=image_shape[1])
+        for _ in range(n_variants or 1)]
+    for o in outputs:
+        if n_variants is None:
+            o = [o]
+        for im, stamps in zip(ims, o):
+            add_stamps_to_image(image=im.array, stamps=stamps)
 
-    return im
+    if n_variants is None:
+        return ims[0]
+    else:
+        return ims
 
 
-def _render_list(inds, wcs, draw_method, image_shape, src_func):
-    im = galsim.ImageD(nrow=image_shape[0], ncol=image_shape[1])
-    for ind in inds:
+def render_stamps_for_image(
+        *, image_shape, wcs, draw_method, src_inds, src_func,
+        n_variants=None, engine='stamp', use_templates=False):
+    """Render a list of sources for a single image as a compact list of
+    stamps instead of a full image.
+
+    See `render_sources_for_image` for a description of the parameters.
+
+    Returns
+    -------
+    stamps : list of 3-tuples or list of lists of 3-tuples
+        The stamps as (row_start, col_start, array) with zero-indexed
+        offsets in the image and the float32 pixels of each stamp, already
+        cut to the image bounds. A list with one stamp list per variant is
+        returned if `n_variants` is not None. Use `add_stamps_to_image` to
+        add them to an image.
+    """
+    if engine == 'fft':
+        profiles = src_func.constant_profiles()
+        if profiles is not None:
+            if n_variants is None:
+                profiles = [profiles]
+            if hasattr(src_func, 'prepare'):
+                pos, _ = src_func.prepare(src_inds)
+            else:
+                pos = [src_func.get_position(ind) for ind in src_inds]
+            stamps = render_stamps_fft(
+                image_shape=image_shape,
+                wcs=wcs,
+                draw_method=draw_method,
+                profiles=profiles,
+                x=np.array([p.x for p in pos], dtype=np.float64),
+                y=np.array([p.y for p in pos], dtype=np.float64))
+            if n_variants is None:
+                return stamps[0]
+            else:
+                return stamps
+    elif engine != 'stamp':
+        raise ValueError("render engine '%s' not recognized!" % engine)
+
+    im_bounds = galsim.BoundsI(1, image_shape[1], 1, image_shape[0])
+    # sources can tell us which of them share a stamp size
+    get_key = getattr(src_func, 'stamp_size_key', None)
+    # sources can also do all of their WCS transforms at once
+    prepare = getattr(src_func, 'prepare', None)
+    if prepare is not None:
+        _, local_wcss = prepare(src_inds)
+    stamps = [[] for _ in range(n_variants or 1)]
+    for i, ind in enumerate(src_inds):
         # draw
-        src, pos = src_func(ind)
+        srcs, pos = src_func(ind)
+        if n_variants is None:
+            srcs = [srcs]
+        if prepare is not None:
+            local_wcs = local_wcss[i]
+        else:
+            local_wcs = wcs.local(image_pos=pos)
+        key = get_key(ind) if get_key is not None else None
+
+        for variant, (_stamps, src) in enumerate(zip(stamps, srcs)):
+            stamp = render_source_in_image(
+                source=src,
+                local_wcs=local_wcs,
+                image_pos=pos,
+                draw_method=draw_method,
+                stamp_size_key=(key, variant) if key is not None else None,
+                use_templates=use_templates,
+                wcs=wcs)
+
+            # intersect with the total image and keep only that part
+            overlap = stamp.bounds & im_bounds
+            if overlap.area() > 0:
+                _stamps.append((
+                    overlap.ymin - 1,
+                    overlap.xmin - 1,
+                    stamp[overlap].array.astype(np.float32)))
+
+    if n_variants is None:
+        return stamps[0]
+    else:
+        return stamps
+
+
+def add_stamps_to_image(*, image, stamps):
+    """Add a list of stamps from `render_stamps_for_image` to an image.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        The image to add the stamps to. It is modified in place.
+    stamps : list of 3-tuples
+        The stamps as (row_start, col_start, array).
+    """
+    for row_start, col_start, arr in stamps:
+        image[
+            row_start:row_start + arr.shape[0],
+            col_start:col_start + arr.shape[1]] += arr
+
+
+def render_stamps_fft(
+        *, image_shape, wcs, draw_method, profiles, x, y, patch_size=256):
+    """Render many copies of the same profiles at different positions with
+    one FFT convolution per patch of the image.
+
+    The image is split into square patches of `patch_size` pixels. In each
+    patch, the WCS is approximated by its local affine jacobian at the
+    patch center. The profile is drawn once there into a kernel image, and
+    the objects in the patch are placed as delta functions with exact
+    Fourier phase ramps for their sub-pixel positions. The phase ramps are
+    separable in rows and columns, so their sum is a single matrix product.
+    The kernel is then applied with one real FFT.
+
+    Compared to drawing each object in its own stamp (see
+    `compare_fft_to_stamps`), the differences are
+
+        - the sub-pixel shifts are band-limited (sinc) interpolations of the
+          pixelized kernel instead of exact draws of the shifted profile,
+          which is only accurate if the kernel is well sampled, and
+        - the local WCS is constant over each patch, so objects away from
+          the patch center are rendered with a slightly wrong jacobian.
+
+    Both are small for the well-sampled, smooth profiles used for grid
+    simulations with a Gaussian PSF. Use `compare_fft_to_stamps` to check a
+    given setup.
+
+    Parameters
+    ----------
+    image_shape : tuple of ints
+        The shape of the final image.
+    wcs : galsim WCS object
+        The WCS for the image.
+    draw_method : str
+        The method used to draw the image. See the docs of `GSObject.drawImage`
+        for details and options.
+    profiles : list of galsim.GSObject
+        The profiles to render, including the PSF. One list of stamps is
+        returned for each of them.
+    x : np.ndarray
+        The x positions of the objects in one-indexed, pixel centered image
+        coordinates.
+    y : np.ndarray
+        The y positions of the objects in one-indexed, pixel centered image
+        coordinates.
+    patch_size : int, optional
+        The size of the patches in pixels. Default is 256.
+
+    Returns
+    -------
+    stamps : list of lists of 3-tuples
+        One list of stamps per profile in the format of
+        `render_stamps_for_image`. There is one stamp per patch with
+        objects.
+    """
+    stamps = [[] for _ in profiles]
+    if len(x) == 0:
+        return stamps
+
+    # zero-indexed array coordinates
+    row = np.asarray(y, dtype=np.float64) - 1
+    col = np.asarray(x, dtype=np.float64) - 1
+
+    # the patches cover all of the objects, including those off the image
+    row_origin = int(np.floor(np.min(row) + 0.5))
+    col_origin = int(np.floor(np.min(col) + 0.5))
+    prow = np.floor((row + 0.5 - row_origin) / patch_size).astype(int)
+    pcol = np.floor((col + 0.5 - col_origin) / patch_size).astype(int)
+
+    for _prow, _pcol in sorted(set(zip(prow, pcol))):
+        msk = (prow == _prow) & (pcol == _pcol)
+        r0 = row_origin + _prow * patch_size
+        c0 = col_origin + _pcol * patch_size
+
+        local_wcs = wcs.local(image_pos=galsim.PositionD(
+            x=c0 + patch_size / 2 + 1,
+            y=r0 + patch_size / 2 + 1))
+
+        shifts = {}
+        for _stamps, profile in zip(stamps, profiles):
+            kernel = _draw_fft_kernel(
+                profile=profile, local_wcs=local_wcs, draw_method=draw_method)
+            half = kernel.shape[0] // 2
+
+            # the grid is big enough that no object wraps around
+            shape = (
+                scipy.fft.next_fast_len(patch_size + 2 * half + 1, real=True),
+                scipy.fft.next_fast_len(patch_size + 2 * half + 1, real=True))
+            g_r0 = r0 - half
+            g_c0 = c0 - half
+
+            # the shifts only depend on the grid shape, so profiles with the
+            # same kernel size share them
+            if shape not in shifts:
+                fy = np.fft.fftfreq(shape[0])
+                fx = np.fft.rfftfreq(shape[1])
+                ey = np.exp(-2j * np.pi * np.outer(row[msk] - g_r0, fy))
+                ex = np.exp(-2j * np.pi * np.outer(col[msk] - g_c0, fx))
+                shifts[shape] = ey.T @ ex
+
+            # put the kernel center at the origin of the grid
+            kpad = np.zeros(shape)
+            kpad[:kernel.shape[0], :kernel.shape[1]] = kernel
+            kpad = np.roll(kpad, (-half, -half), axis=(0, 1))
+
+            arr = scipy.fft.irfft2(
+                scipy.fft.rfft2(kpad) * shifts[shape], s=shape)
+
+            # cut to the image bounds
+            rs = max(g_r0, 0)
+            re = min(g_r0 + shape[0], image_shape[0])
+            cs = max(g_c0, 0)
+            ce = min(g_c0 + shape[1], image_shape[1])
+            if rs < re and cs < ce:
+                _stamps.append((
+                    rs,
+                    cs,
+                    arr[rs - g_r0:re - g_r0, cs - g_c0:ce - g_c0].astype(
+                        np.float32)))
+
+    return stamps
+
+
+def _draw_fft_kernel(*, profile, local_wcs, draw_method):
+    """Draw a profile centered in an odd-sized image for use as an FFT
+    kernel."""
+    n_pix = STAMP_SIZE_CACHE.get_stamp_size(
+        key=None,
+        source=profile,
+        local_wcs=local_wcs,
+        draw_method=draw_method)
+    if n_pix % 2 == 0:
+        n_pix += 1
+    return profile.drawImage(
+        nx=n_pix, ny=n_pix, wcs=local_wcs, method=draw_method).array
+
+
+def compare_fft_to_stamps(
+        *, image_shape, wcs, draw_method, profile, x, y, patch_size=256):
+    """Compare the rendering of `render_stamps_fft` to drawing each object in
+    its own stamp.
+
+    Parameters
+    ----------
+    image_shape : tuple of ints
+        The shape of the final image.
+    wcs : galsim WCS object
+        The WCS for the image.
+    draw_method : str
+        The method used to draw the image. See the docs of `GSObject.drawImage`
+        for details and options.
+    profile : galsim.GSObject
+        The profile to render, including the PSF.
+    x : np.ndarray
+        The x positions of the objects in one-indexed, pixel centered image
+        coordinates.
+    y : np.ndarray
+        The y positions of the objects in one-indexed, pixel centered image
+        coordinates.
+    patch_size : int, optional
+        The size of the patches in pixels for the FFT. Default is 256.
+
+    Returns
+    -------
+    stats : dict
+        A dictionary with
+            max_abs_diff : float
+                The largest absolute difference of the two images.
+            max_rel_diff : float
+                `max_abs_diff` relative to the peak of the stamp image.
+            flux_ratio : float
+                The total flux in the FFT image over that in the stamp image.
+    """
+    im_stamp = np.zeros(image_shape)
+    for _x, _y in zip(x, y):
+        pos = galsim.PositionD(x=_x, y=_y)
         stamp = render_source_in_image(
-            source=src,
-            local_wcs=wcs.local(image_pos=pos),
+            source=profile,
             image_pos=pos,
+            local_wcs=wcs.local(image_pos=pos),
             draw_method=draw_method)
-
-        # intersect and add to total image
-        overlap = stamp.bounds & im.bounds
+        overlap = stamp.bounds & galsim.BoundsI(
+            1, image_shape[1], 1, image_shape[0])
         if overlap.area() > 0:
-            im[overlap] += stamp[overlap]
+            im_stamp[
+                overlap.ymin - 1:overlap.ymax,
+                overlap.xmin - 1:overlap.xmax] += stamp[overlap].array
+
+    im_fft = np.zeros(image_shape)
+    stamps, = render_stamps_fft(
+        image_shape=image_shape,
+        wcs=wcs,
+        draw_method=draw_method,
+        profiles=[profile],
+        x=np.asarray(x),
+        y=np.asarray(y),
+        patch_size=patch_size)
+    add_stamps_to_image(image=im_fft, stamps=stamps)
+
+    max_abs_diff = np.max(np.abs(im_fft - im_stamp))
+    return {
+        'max_abs_diff': max_abs_diff,
+        'max_rel_diff': max_abs_diff / np.max(np.abs(im_stamp)),
+        'flux_ratio': np.sum(im_fft) / np.sum(im_stamp),
+    }
+
 
-    return im
+class StampSizeCache(object):
+    """A cache of the stamp sizes used to render sources.
 
+    Finding the stamp size of a source with `drawImage(setup_only=True)`
+    costs about as much python overhead as drawing it. For a given profile
+    the size only depends on the profile parameters and the local pixel
+    scale, so it is memoized here by a key supplied by the caller (which
+    should identify the profile and PSF parameters) together with the local
+    WCS jacobian quantized to `jac_quantum` arcsec per pixel.
 
-def render_source_in_image(*, source, image_pos, local_wcs, draw_method):
+    Parameters
+    ----------
+    jac_quantum : float, optional
+        The quantum used to round the local WCS jacobian for the cache key.
+        Default is 1e-3 arcsec per pixel.
+    max_size : int, optional
+        The maximum number of entries before the cache is cleared. Default
+        is 100000.
+
+    Attributes
+    ----------
+    hits : int
+        The number of lookups served from the cache.
+    misses : int
+        The number of lookups with a key that was not in the cache.
+    n_uncached : int
+        The number of lookups with no key, which always use `setup_only`.
+
+    Methods
+    -------
+    get_stamp_size(key, source, local_wcs, draw_method)
+        Get the stamp size for a source.
+    stats()
+        Get the hit/miss statistics of the cache.
+    """
+    def __init__(self, *, jac_quantum=1e-3, max_size=100_000):
+        self.jac_quantum = jac_quantum
+        self.max_size = max_size
+        self._sizes = {}
+        self.hits = 0
+        self.misses = 0
+        self.n_uncached = 0
+
+    def get_stamp_size(self, *, key, source, local_wcs, draw_method):
+        """Get the stamp size for a source.
+
+        Parameters
+        ----------
+        key : hashable or None
+            A key that identifies the profile of the source up to its
+            position. If None, the size is not cached.
+        source : galsim.GSObject
+            The source to render.
+        local_wcs : galsim.LocalWCS
+            The local WCS used to render the source.
+        draw_method : str
+            The method used to draw the image.
+
+        Returns
+        -------
+        stamp_size : int
+            The number of pixels on a side of the stamp.
+        """
+        if key is None:
+            self.n_uncached += 1
+            return _get_stamp_size(
+                source=source, local_wcs=local_wcs, draw_method=draw_method)
+
+        jac = np.round(
+            local_wcs.jacobian().getMatrix().ravel() / self.jac_quantum
+        ).astype(int)
+        full_key = (key, draw_method, tuple(jac))
+
+        stamp_size = self._sizes.get(full_key, None)
+        if stamp_size is None:
+            self.misses += 1
+            stamp_size = _get_stamp_size(
+                source=source, local_wcs=local_wcs, draw_method=draw_method)
+            if len(self._sizes) >= self.max_size:
+                self._sizes.clear()
+            self._sizes[full_key] = stamp_size
+        else:
+            self.hits += 1
+
+        return stamp_size
+
+    def stats(self):
+        """Get the hit/miss statistics of the cache.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary with the 'hits', 'misses', 'n_uncached', 'size' and
+            'hit_rate' of the cache. The hit rate is the fraction of all
+            lookups that were served from the cache.
+        """
+        n_tot = self.hits + self.misses + self.n_uncached
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'n_uncached': self.n_uncached,
+            'size': len(self._sizes),
+            'hit_rate': self.hits / n_tot if n_tot > 0 else 0.0,
+        }
+
+
+# one cache per process
+STAMP_SIZE_CACHE = StampSizeCache()
+
+
+def get_stamp_size_cache_stats():
+    """Get the hit/miss statistics of the stamp size cache of this process.
+    See `StampSizeCache.stats`."""
+    return STAMP_SIZE_CACHE.stats()
+
+
+class StampTemplateCache(object):
+    """A library of pre-rendered stamps of sources at sub-pixel offsets.
+
+    The image is split into square cells of `cell_size` pixels. For
+    sources that share a profile (given by a caller-supplied key), each
+    profile is drawn, with the local WCS jacobian at the center of the
+    cell, at a grid of `(n_sub + 1) x (n_sub + 1)` sub-pixel offsets. Any
+    source of the cell is then made by bilinear interpolation between the
+    four nearest templates instead of a new draw. The templates are drawn
+    as they are first needed.
+
+    The approximation error has two parts:
+
+        - the bilinear interpolation in the offset. It is measured for
+          every new profile and cell by drawing the source exactly at
+          the center of a template cell, where it is usually worst, and at
+          `n_err_test` random offsets, and comparing to the interpolated
+          stamps.
+        - the jacobian used to draw the templates is that of the cell
+          center instead of the source position. The largest difference of
+          an element of the jacobian of a source from that of its templates
+          is measured.
+
+    Both are reported by `stats`, along with the fraction of the stamps
+    made without drawing any new template. Larger cells give more reuse and
+    a larger jacobian error.
+
+    Parameters
+    ----------
+    n_sub : int, optional
+        The number of template cells per pixel in each direction. Default
+        is 8.
+    cell_size : int, optional
+        The size in pixels of the image cells sharing a jacobian. Default
+        is 512.
+    n_err_test : int, optional
+        The number of random offsets at which the interpolation error of a
+        new profile and cell is measured. Default is 4.
+    max_size : int, optional
+        The maximum number of template sets before the cache is cleared.
+        Default is 1000.
+
+    Methods
+    -------
+    get_stamp(key, source, image_pos, local_wcs, wcs, draw_method, n_pix)
+        Get the stamp for a source.
+    stats()
+        Get the hit/miss statistics and error budget of the cache.
+    """
+    def __init__(
+            self, *, n_sub=8, cell_size=512, n_err_test=4, max_size=1000):
+        self.n_sub = n_sub
+        self.cell_size = cell_size
+        self.n_err_test = n_err_test
+        self.max_size = max_size
+        self._entries = {}
+        self._wcs = None
+        self._cell_wcs = {}
+        self._rng = np.random.RandomState(seed=n_sub)
+        self.n_stamps = 0
+        self.hits = 0
+        self.misses = 0
+        self.max_interp_rel_err = 0.0
+        self.max_jac_err = 0.0
+
+    def get_stamp(
+            self, *, key, source, image_pos, local_wcs, wcs, draw_method,
+            n_pix):
+        """Get the stamp for a source.
+
+        Parameters
+        ----------
+        key : hashable
+            A key that identifies the profile of the source up to its
+            position.
+        source : galsim.GSObject
+            The source to render.
+        image_pos : galsim.PositionD
+            The center of the source in the image.
+        local_wcs : galsim.LocalWCS
+            The local WCS at the source.
+        wcs : galsim WCS object
+            The WCS of the image, used to get the jacobian at the cell
+            center.
+        draw_method : str
+            The method used to draw the image.
+        n_pix : int
+            The number of pixels on a side of the stamp.
+
+        Returns
+        -------
+        stamp : galsim.ImageD
+            The rendered object in the stamp.
+        """
+        cell = (
+            int(np.floor((image_pos.x - 1) / self.cell_size)),
+            int(np.floor((image_pos.y - 1) / self.cell_size)))
+        cell_wcs = self._get_cell_wcs(wcs, cell)
+        full_key = (key, draw_method, n_pix, cell, repr(cell_wcs))
+
+        entry = self._entries.get(full_key, None)
+        if entry is None:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            entry = {
+                'source': source,
+                'local_wcs': cell_wcs,
+                'draw_method': draw_method,
+                'n_pix': n_pix,
+                'templates': {},
+            }
+            self._entries[full_key] = entry
+            self._measure_interp_err(entry)
+
+        self.max_jac_err = max(self.max_jac_err, float(np.max(np.abs(
+            local_wcs.jacobian().getMatrix() -
+            cell_wcs.jacobian().getMatrix()))))
+
+        # here the offset is always in [0, 1)
+        x_ll = int(np.floor(image_pos.x - (n_pix - 1)/2))
+        y_ll = int(np.floor(image_pos.y - (n_pix - 1)/2))
+        dx = image_pos.x - (x_ll + (n_pix - 1)/2)
+        dy = image_pos.y - (y_ll + (n_pix - 1)/2)
+
+        self.n_stamps += 1
+        stamp = galsim.ImageD(
+            self._interp(entry, dx, dy), wcs=cell_wcs, xmin=x_ll, ymin=y_ll)
+        return stamp
+
+    def _get_cell_wcs(self, wcs, cell):
+        # keep a reference to the WCS so the cell jacobians are for it
+        if wcs is not self._wcs:
+            self._wcs = wcs
+            self._cell_wcs = {}
+
+        cell_wcs = self._cell_wcs.get(cell, None)
+        if cell_wcs is None:
+            cen = galsim.PositionD(
+                x=1 + (cell[0] + 0.5) * self.cell_size,
+                y=1 + (cell[1] + 0.5) * self.cell_size)
+            cell_wcs = galsim.JacobianWCS(
+                *wcs.local(cen).jacobian().getMatrix().ravel())
+            self._cell_wcs[cell] = cell_wcs
+        return cell_wcs
+
+    def _interp(self, entry, dx, dy):
+        fx = dx * self.n_sub
+        fy = dy * self.n_sub
+        ix = min(int(fx), self.n_sub - 1)
+        iy = min(int(fy), self.n_sub - 1)
+        tx = fx - ix
+        ty = fy - iy
+
+        n_drawn = len(entry['templates'])
+        arr = (
+            (1 - tx) * (1 - ty) * self._template(entry, ix, iy)
+            + tx * (1 - ty) * self._template(entry, ix + 1, iy)
+            + (1 - tx) * ty * self._template(entry, ix, iy + 1)
+            + tx * ty * self._template(entry, ix + 1, iy + 1))
+        if len(entry['templates']) == n_drawn:
+            self.hits += 1
+
+        return arr
+
+    def _template(self, entry, ix, iy):
+        arr = entry['templates'].get((ix, iy), None)
+        if arr is None:
+            self.misses += 1
+            arr = self._draw(entry, ix / self.n_sub, iy / self.n_sub)
+            entry['templates'][(ix, iy)] = arr
+        return arr
+
+    def _draw(self, entry, dx, dy):
+        return entry['source'].drawImage(
+            nx=entry['n_pix'],
+            ny=entry['n_pix'],
+            wcs=entry['local_wcs'],
+            method=entry['draw_method'],
+            offset=galsim.PositionD(x=dx, y=dy)).array
+
+    def _measure_interp_err(self, entry):
+        # the bilinear interpolation is usually worst at the center of a
+        # cell, but we check some random offsets as well
+        half = 0.5 / self.n_sub
+        offsets = [(half, half)] + [
+            tuple(self._rng.uniform(size=2))
+            for _ in range(self.n_err_test)]
+
+        n_hits = self.hits
+        for dx, dy in offsets:
+            exact = self._draw(entry, dx, dy)
+            interp = self._interp(entry, dx, dy)
+            err = np.max(np.abs(interp - exact)) / np.max(np.abs(exact))
+            self.max_interp_rel_err = max(self.max_interp_rel_err, err)
+        self.hits = n_hits
+
+    def stats(self):
+        """Get the hit/miss statistics and error budget of the cache.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary with the number of stamps made, 'n_stamps', the
+            'hits' (stamps made only from templates that were already
+            drawn), the 'hit_rate' (hits over stamps), 'misses' (templates
+            drawn), 'size' (the number of template sets),
+            'max_interp_rel_err' (the largest interpolation error measured,
+            relative to the peak of the stamp) and 'max_jac_err' (the
+            largest difference of an element of the jacobian of a source
+            from that of its templates in arcsec per pixel).
+        """
+        return {
+            'n_stamps': self.n_stamps,
+            'hits': self.hits,
+            'hit_rate': (
+                self.hits / self.n_stamps if self.n_stamps > 0 else 0.0),
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_interp_rel_err': self.max_interp_rel_err,
+            'max_jac_err': self.max_jac_err,
+        }
+
+
+# one template library per process
+STAMP_TEMPLATE_CACHE = StampTemplateCache()
+
+
+def get_stamp_template_cache_stats():
+    """Get the hit/miss statistics and error budget of the stamp template
+    cache of this process. See `StampTemplateCache.stats`."""
+    return STAMP_TEMPLATE_CACHE.stats()
+
+
+def _get_stamp_size(*, source, local_wcs, draw_method):
+    _im = source.drawImage(
+        wcs=local_wcs,
+        method=draw_method,
+        setup_only=True).array
+    assert _im.shape[0] == _im.shape[1]
+    return _im.shape[0]
+
+
+def render_source_in_image(
+        *, source, image_pos, local_wcs, draw_method, stamp_size_key=None,
+        use_templates=False, wcs=None):
     """Render a source in a stamp in a larger image.
 
     Parameters
@@ -92,37 +777,57 @@ def render_source_in_image(*, source, image_pos, local_wcs, draw_method):
         The method used to draw the image. See the docs of `GSObject.drawImage`
         for details and options. Usually 'auto' is correct unless using a
         PSF with the pixel in which case 'no_pixel' is the right choice.
+    stamp_size_key : hashable, optional
+        A key that identifies the profile of the source up to its position.
+        If given, the stamp size is looked up in `STAMP_SIZE_CACHE` instead
+        of being found with a setup-only draw every time.
+    use_templates : bool, optional
+        If True and `stamp_size_key` is given, the stamp is interpolated from
+        the pre-rendered templates in `STAMP_TEMPLATE_CACHE` instead of being
+        drawn. Default is False.
+    wcs : galsim WCS object, optional
+        The WCS of the image. Required if `use_templates` is True.
 
     Returns
     -------
     stamp : galsim.ImageD
         The rendered object in the stamp.
     """
-    # pre-draw to get size
-    _im = source.drawImage(
-        wcs=local_wcs,
-        method=draw_method,
-        setup_only=True).array
-    assert _im.shape[0] == _im.shape[1]
+    # get the size, pre-drawing only if we have to
+    n_pix = STAMP_SIZE_CACHE.get_stamp_size(
+        key=stamp_size_key,
+        source=source,
+        local_wcs=local_wcs,
+        draw_method=draw_method)
+
+    if use_templates and stamp_size_key is not None:
+        return STAMP_TEMPLATE_CACHE.get_stamp(
+            key=stamp_size_key,
+            source=source,
+            image_pos=image_pos,
+            local_wcs=local_wcs,
+            wcs=wcs,
+            draw_method=draw_method,
+            n_pix=n_pix)
 
     # lower-left corner
     # the extact math here doesn't matter so much
     # the offset computation takes care of this relative to any x_ll, y_ll
     # we only need to make sure the full object fits on the image
-    x_ll = int(image_pos.x - (_im.shape[1] - 1)/2)
-    y_ll = int(image_pos.y - (_im.shape[0] - 1)/2)
+    x_ll = int(image_pos.x - (n_pix - 1)/2)
+    y_ll = int(image_pos.y - (n_pix - 1)/2)
 
     # get the offset of the center
     # this is the offset of the image center from the object center
     # galsim renders objects at the image center, so we have to add this
     # offset when rendering
-    dx = image_pos.x - (x_ll + (_im.shape[1] - 1)/2)
-    dy = image_pos.y - (y_ll + (_im.shape[0] - 1)/2)
+    dx = image_pos.x - (x_ll + (n_pix - 1)/2)
+    dy = image_pos.y - (y_ll + (n_pix - 1)/2)
 
     # draw for real
     stamp = source.drawImage(
-        nx=_im.shape[1],
-        ny=_im.shape[0],
+        nx=n_pix,
+        ny=n_pix,
         wcs=local_wcs,
         method=draw_method,
         offset=galsim.PositionD(x=dx, y=dy))
@@ -1,6 +1,10 @@
+import time
+
 import numpy as np
 import galsim
 
+from psf_caching import PIXEL_PSF_CACHE
+
 
 class GaussPixPSF(object):
     """A pixelized Gaussian PSF.
@@ -15,16 +19,35 @@ class GaussPixPSF(object):
     s2n : float, optional
         If not `None`, this option forces the code to add noise to the PSF
         image so that it has total S/N `s2n`.
+    cache_dir : str, optional
+        If not None, the PSF images are also cached in this directory. See
+        `psf_caching.PixelPSFCache`.
+    cache_id : str, optional
+        An identifier of the CCD. Not used since the PSF does not depend on
+        the WCS, but accepted so that all pixelized PSFs are built the same
+        way.
+    analytic : bool, optional
+        If True, return the sheared analytic Gaussian instead of an
+        interpolated image of it. This requires `s2n` to be None. See
+        `compare_analytic_psf` for how much the two differ. Default is False.
 
     Methods
     -------
     getPSF(image_pos)
         Get the PSF represented as an interpolated image at a point.
     """
-    def __init__(self, *, gstd=0.01, fwhm_frac_std=0.1, s2n=None):
+    def __init__(self, *, gstd=0.01, fwhm_frac_std=0.1, s2n=None,
+                 cache_dir=None, cache_id=None, analytic=False):
         self.gstd = gstd
         self.fwhm_frac_std = fwhm_frac_std
         self.s2n = s2n
+        self.cache_dir = cache_dir
+        self.cache_id = cache_id
+        self.analytic = analytic
+
+        if self.analytic and self.s2n is not None:
+            raise ValueError(
+                "The analytic PSF cannot be used with a PSF s2n!")
 
     def getPSF(self, image_pos, wcs):
         """Get the PSF as an InterpolatedImage
@@ -41,10 +64,22 @@ class GaussPixPSF(object):
         psf : galsim.InterpolatedImage
             The PSF model.
         """
-        wcs = wcs.local(image_pos)
+        # the PSF only depends on the nearest pixel, so it is memoized
+        ix = int(image_pos.x + 0.5)
+        iy = int(image_pos.y + 0.5)
+        if self.analytic:
+            return self._make_analytic_psf(ix, iy)[0]
 
+        return PIXEL_PSF_CACHE.get(
+            table_key=('gauss-pix', self.gstd, self.fwhm_frac_std, self.s2n),
+            pixel=(ix, iy),
+            make_image=lambda: self._draw_psf_image(ix, iy),
+            make_psf=self._make_psf,
+            cache_dir=self.cache_dir)
+
+    def _make_analytic_psf(self, ix, iy):
         # we seed with the nearest pixel to make things reproducible
-        seed = int(image_pos.x + 0.5) * 4096 + int(image_pos.y + 0.5)
+        seed = ix * 4096 + iy
         seed = seed % 2**30
         rng = np.random.RandomState(seed=seed)
 
@@ -54,6 +89,10 @@ class GaussPixPSF(object):
             rng.uniform(low=-self.fwhm_frac_std, high=self.fwhm_frac_std) +
             1.0) * 0.9
         psf = galsim.Gaussian(fwhm=fwhm).shear(g1=g1, g2=g2).withFlux(1.0)
+        return psf, rng
+
+    def _draw_psf_image(self, ix, iy):
+        psf, rng = self._make_analytic_psf(ix, iy)
         psf_im = psf.drawImage(
             nx=69, ny=69, scale=0.125, method='no_pixel').array
 
@@ -61,8 +100,96 @@ class GaussPixPSF(object):
             noise_std = np.sqrt(np.sum(psf_im**2)/self.s2n**2)
             psf_im += (rng.normal(size=psf_im.shape) * noise_std)
 
-        psf = galsim.InterpolatedImage(
+        return psf_im
+
+    def _make_psf(self, psf_im):
+        return galsim.InterpolatedImage(
             galsim.ImageD(psf_im),
             scale=0.125,
             ).withFlux(1.0)
-        return psf
+
+
+def compare_analytic_psf(
+        *, psf_class, psf_kws, image_pos, wcs, n_pix=53, n_repeat=3):
+    """Benchmark the analytic PSF of a pixelized PSF class against its
+    interpolated image and measure the pixel-level differences.
+
+    Each PSF is made at every position and drawn with the local WCS there,
+    as is done for the MEDS PSF images and, through the convolutions, for
+    rendering. The memoization of the interpolated PSFs is bypassed so that
+    the timing is that of making them.
+
+    Parameters
+    ----------
+    psf_class : type
+        Either `GaussPixPSF` or `NonGaussPixPSF`.
+    psf_kws : dict
+        The keyword arguments for `psf_class`. `s2n` must be None.
+    image_pos : list of galsim.PositionD
+        The image positions to test.
+    wcs : galsim WCS object
+        The WCS of the image.
+    n_pix : int, optional
+        The size of the PSF images. Default is 53.
+    n_repeat : int, optional
+        The number of times to repeat the timing. The fastest is kept.
+        Default is 3.
+
+    Returns
+    -------
+    stats : dict
+        A dictionary with
+            max_abs_diff : float
+                The largest absolute difference of a pixel of the unit flux
+                PSF images.
+            max_rel_diff : float
+                The largest absolute difference relative to the peak of the
+                interpolated image.
+            time_interpolated : float
+                The time in seconds per PSF to make and draw the interpolated
+                image PSF.
+            time_analytic : float
+                The time in seconds per PSF to make and draw the analytic PSF.
+    """
+    psf_interp = psf_class(**dict(psf_kws, analytic=False))
+    psf_analytic = psf_class(**dict(psf_kws, analytic=True))
+
+    def _draw(psf_model, pos, use_cache):
+        local_wcs = wcs.local(pos)
+        ix = int(pos.x + 0.5)
+        iy = int(pos.y + 0.5)
+        if use_cache:
+            psf = psf_model.getPSF(pos, wcs)
+        elif isinstance(psf_model, GaussPixPSF):
+            psf = psf_model._make_psf(psf_model._draw_psf_image(ix, iy))
+        else:
+            psf = psf_model._make_psf(
+                psf_model._draw_psf_image(ix, iy, local_wcs), local_wcs)
+        return psf.drawImage(nx=n_pix, ny=n_pix, wcs=local_wcs).array
+
+    max_abs_diff = 0.0
+    max_rel_diff = 0.0
+    for pos in image_pos:
+        im_interp = _draw(psf_interp, pos, False)
+        im_analytic = _draw(psf_analytic, pos, True)
+        abs_diff = np.max(np.abs(im_analytic - im_interp))
+        max_abs_diff = max(max_abs_diff, abs_diff)
+        max_rel_diff = max(max_rel_diff, abs_diff / np.max(im_interp))
+
+    times = {}
+    for name, psf_model, use_cache in [
+            ('time_interpolated', psf_interp, False),
+            ('time_analytic', psf_analytic, True)]:
+        best = np.inf
+        for _ in range(n_repeat):
+            t0 = time.perf_counter()
+            for pos in image_pos:
+                _draw(psf_model, pos, use_cache)
+            best = min(best, time.perf_counter() - t0)
+        times[name] = best / max(len(image_pos), 1)
+
+    return {
+        'max_abs_diff': max_abs_diff,
+        'max_rel_diff': max_rel_diff,
+        **times,
+    }
@@ -3,6 +3,7 @@ import os
 import logging
 import tempfile
 
+import joblib
 import numpy as np
 import meds.util
 import fitsio
@@ -14,16 +15,20 @@ import desmeds.util
 
 from constants import MAGZP_REF, MEDSCONF
 from psf_wrapper import PSFWrapper
-from wcsing import get_galsim_wcs
+from psf_caching import flush_pixel_psf_cache, get_pixel_psf_cache_stats
+from wcsing import get_galsim_wcs, get_wcs_surrogate
 from files import (
-    get_band_info_file, get_meds_file_path, expand_path, make_dirs_for_file)
+    get_band_info_file, get_meds_file_path, get_psfex_fit_cache_dir,
+    expand_path, make_dirs_for_file)
 
 logger = logging.getLogger(__name__)
 
 
 TMP_DIR = os.environ['TMPDIR']
 
-def make_meds_files(*, tilename, bands, output_meds_dir, psf_kws, meds_config):
+def make_meds_files(
+        *, tilename, bands, output_meds_dir, psf_kws, meds_config,
+        wcs_kws=None):
     """Make a MEDS file for a given band and tilename.
 
     Parameters
@@ -39,6 +44,31 @@ def make_meds_files(*, tilename, bands, output_meds_dir, psf_kws, meds_config):
     meds_config : dict
         The MEDS making configuration file. See the default one in
         `work/simple_des_y3_sims/default_configs/meds.yaml`.
+    wcs_kws : dict, optional
+        The WCS surrogate options. If `surrogate` is True, the PSF images
+        of the SE images are drawn with the local WCS from a
+        piecewise-affine approximation to the WCS with a position error
+        of at most `max_pos_err` pixels (default 1e-3) and a jacobian error
+        of at most `max_jac_err` arcsec per pixel (default 1e-5). See
+        `wcsing.AffineGridWCS`.
+
+    Notes
+    -----
+    If `meds_config` has a `psf_lattice_spacing`, the PSF images of the SE
+    images are interpolated from a lattice of PSF images with that spacing
+    in pixels instead of being drawn for each cutout and the largest pixel
+    residual of each CCD is logged. See `psf_wrapper.PSFWrapper`. The
+    lattice is not used for the 'gauss-pix' and 'nongauss-pix' PSFs, which
+    vary randomly from pixel to pixel.
+
+    The bands are made in parallel in a process pool. The number of
+    processes is `n_band_jobs` from `meds_config` if given. Otherwise it is
+    the number of bands, limited by the number of CPUs and by the available
+    memory divided by `band_memory_gb` from `meds_config` (default 4).
+    The object data and box sizes are made once and shared by all bands.
+    The MEDSMaker only uses its own process pool when the bands are made
+    one at a time. The PSF stats of each band are logged by the parent
+    process.
     """
 
     logger.info(' making meds files for coadd tile %s', tilename)
@@ -46,7 +76,20 @@ def make_meds_files(*, tilename, bands, output_meds_dir, psf_kws, meds_config):
     # force this
     meds_config['magzp_ref'] = MAGZP_REF
     meds_config['psf'] = {'type': 'psfex'}
-    meds_config['use_joblib'] = True
+
+    # these are ours and not for the MEDSMaker
+    psf_lattice_spacing = meds_config.pop('psf_lattice_spacing', None)
+    n_band_jobs = meds_config.pop('n_band_jobs', None)
+    band_memory_gb = meds_config.pop('band_memory_gb', 4.0)
+
+    # reuse the PSFEx smooth model fits from the earlier stages
+    if psf_kws['type'] == 'des_psfex' and 'fit_cache_dir' not in psf_kws:
+        psf_kws = dict(
+            psf_kws,
+            fit_cache_dir=get_psfex_fit_cache_dir(
+                meds_dir=output_meds_dir,
+                medsconf=MEDSCONF,
+                tilename=tilename))
 
     # read info files
     info = {}
@@ -66,111 +109,278 @@ def make_meds_files(*, tilename, bands, output_meds_dir, psf_kws, meds_config):
     cat = fitsio.read(info['r']['cat_path'].replace(
         TMP_DIR, output_meds_dir))
 
-    for band in bands:
-        logger.info(' doing band %s', band)
-
-        # get all of the components for the file
-        obj_data = _make_meds_input_data_struct(
-            cat=cat,
-            allowed_box_sizes=meds_config['allowed_box_sizes'],
-            min_box_size=meds_config['min_box_size'],
-            max_box_size=meds_config['max_box_size'],
-            sigma_fac=meds_config['sigma_fac'])
-        image_info = _make_meds_image_info_struct(
-            info=info[band], output_meds_dir=output_meds_dir)
-        meta_data = _make_meds_metadata(band=band, tilename=tilename)
-        psf_data = _build_psf_data(
+    # the objects and their box sizes are the same for all bands
+    obj_data = _make_meds_input_data_struct(
+        cat=cat,
+        allowed_box_sizes=meds_config['allowed_box_sizes'],
+        min_box_size=meds_config['min_box_size'],
+        max_box_size=meds_config['max_box_size'],
+        sigma_fac=meds_config['sigma_fac'])
+
+    n_jobs = _get_n_band_jobs(
+        n_bands=len(bands),
+        n_band_jobs=n_band_jobs,
+        band_memory_gb=band_memory_gb)
+    logger.info(' making %d meds files with %d processes', len(bands), n_jobs)
+
+    # the MEDSMaker has its own process pool, which we only use when the
+    # bands are made one at a time so the pools do not fight for the CPUs.
+    # The same goes for the PSFEx smooth model fits.
+    meds_config['use_joblib'] = n_jobs == 1
+    if n_jobs > 1 and psf_kws['type'] == 'des_psfex':
+        psf_kws = dict(psf_kws, fit_n_jobs=1)
+
+    kwargs = [
+        dict(
+            tilename=tilename,
+            band=band,
             info=info[band],
+            obj_data=obj_data,
+            output_meds_dir=output_meds_dir,
             psf_kws=psf_kws,
-            output_meds_dir=output_meds_dir)
-
-        # make the file in a tmp dir and then stage out
-        maker = MEDSMaker(
-            obj_data,
-            image_info,
-            psf_data=psf_data,
-            config=meds_config,
-            meta_data=meta_data)
-
-        final_meds_file = get_meds_file_path(
-            meds_dir=output_meds_dir,
-            medsconf=MEDSCONF,
-            tilename=tilename,
-            band=band)
-        make_dirs_for_file(final_meds_file)
-
-        with tempfile.TemporaryDirectory() as tmpdir:
-            with StagedOutFile(final_meds_file, tmpdir=tmpdir) as sf:
-                uncompressed_file = sf.path.replace('.fits.fz', '.fits')
-                make_dirs_for_file(uncompressed_file)
-                maker.write(uncompressed_file)
-
-                # make sure to remove the destination file when fpacking
-                try:
-                    os.remove(sf.path)
-                except Exception:
-                    pass
-                desmeds.util.fpack_file(uncompressed_file)
-                try:
-                    os.remove(uncompressed_file)
-                except Exception:
-                    pass
-
-
-def _build_psf_data(*, info, psf_kws, output_meds_dir):
-    def _load_psf_data(_info, force_gauss=False):
+            meds_config=meds_config,
+            wcs_kws=wcs_kws,
+            psf_lattice_spacing=psf_lattice_spacing)
+        for band in bands]
+    if n_jobs == 1:
+        all_stats = [_make_meds_file_for_band(**kws) for kws in kwargs]
+    else:
+        with joblib.Parallel(n_jobs=n_jobs, backend='loky', verbose=0) as p:
+            all_stats = p(
+                joblib.delayed(_make_meds_file_for_band)(**kws)
+                for kws in kwargs)
+
+    # the workers do not log to our handlers, so we log their stats here
+    for band, stats in zip(bands, all_stats):
+        _log_band_stats(band=band, stats=stats)
+
+
+def _get_n_band_jobs(*, n_bands, n_band_jobs, band_memory_gb):
+    """Get the number of processes for the bands, at most one per band and
+    as many as fit in the available memory if not given."""
+    if n_band_jobs is not None:
+        return max(1, min(n_bands, n_band_jobs))
+
+    n_jobs = min(n_bands, joblib.externals.loky.cpu_count())
+    try:
+        avail_gb = (
+            os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES') /
+            1024**3)
+        n_jobs = min(n_jobs, int(avail_gb / band_memory_gb))
+    except (ValueError, OSError, AttributeError):
+        pass
+    return max(1, n_jobs)
+
+
+def _make_meds_file_for_band(
+        *, tilename, band, info, obj_data, output_meds_dir, psf_kws,
+        meds_config, wcs_kws, psf_lattice_spacing):
+    logger.info(' doing band %s', band)
+
+    # get all of the components for the file
+    image_info = _make_meds_image_info_struct(
+        info=info, output_meds_dir=output_meds_dir)
+    meta_data = _make_meds_metadata(band=band, tilename=tilename)
+    psf_data = _build_psf_data(
+        info=info,
+        psf_kws=psf_kws,
+        output_meds_dir=output_meds_dir,
+        wcs_kws=wcs_kws,
+        lattice_spacing=psf_lattice_spacing,
+        obj_data=obj_data,
+        margin=meds_config['max_box_size'] / 2)
+
+    # make the file in a tmp dir and then stage out
+    # copy since the same object data is used for every band
+    maker = MEDSMaker(
+        obj_data.copy(),
+        image_info,
+        psf_data=psf_data,
+        config=meds_config,
+        meta_data=meta_data)
+
+    final_meds_file = get_meds_file_path(
+        meds_dir=output_meds_dir,
+        medsconf=MEDSCONF,
+        tilename=tilename,
+        band=band)
+    make_dirs_for_file(final_meds_file)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with StagedOutFile(final_meds_file, tmpdir=tmpdir) as sf:
+            uncompressed_file = sf.path.replace('.fits.fz', '.fits')
+            make_dirs_for_file(uncompressed_file)
+            maker.write(uncompressed_file)
+
+            # make sure to remove the destination file when fpacking
+            try:
+                os.remove(sf.path)
+            except Exception:
+                pass
+            desmeds.util.fpack_file(uncompressed_file)
+            try:
+                os.remove(uncompressed_file)
+            except Exception:
+                pass
+
+    stats = {'psf_lattice_errors': None, 'pixel_psf_cache': None}
+    if psf_lattice_spacing is not None:
+        stats['psf_lattice_errors'] = _get_psf_lattice_errors(
+            info=info, psf_data=psf_data)
+
+    if psf_kws['type'] in ['gauss-pix', 'nongauss-pix']:
+        flush_pixel_psf_cache()
+        stats['pixel_psf_cache'] = get_pixel_psf_cache_stats()
+
+    return stats
+
+
+def _get_psf_lattice_errors(*, info, psf_data):
+    # the first entry is the coadd which is always drawn exactly
+    errors = {}
+    for se_info, psf_wrap in zip(info['src_info'], psf_data[1:]):
+        err = psf_wrap.get_lattice_error(seed=0)
+        if err is not None:
+            errors[os.path.basename(se_info['image_path'])] = err
+    return errors
+
+
+def _log_band_stats(*, band, stats):
+    errors = stats['psf_lattice_errors']
+    if errors:
+        for image_name, err in errors.items():
+            logger.info(' PSF lattice error for %s: %s', image_name, err)
+        logger.info(
+            ' largest relative PSF lattice residual for band %s: %g',
+            band, max(err['max_rel_resid'] for err in errors.values()))
+
+    if stats['pixel_psf_cache'] is not None:
+        logger.info(
+            ' pixel PSF cache for band %s: %s',
+            band, stats['pixel_psf_cache'])
+
+
+def _build_psf_data(
+        *, info, psf_kws, output_meds_dir, wcs_kws=None,
+        lattice_spacing=None, obj_data=None, margin=0):
+    def _load_psf_data(
+            _info, force_gauss=False, use_surrogate=False,
+            use_lattice=False):
         wcs = get_galsim_wcs(
             image_path=_info['image_path'].replace(
                 TMP_DIR, output_meds_dir),
             image_ext=_info['image_ext'])
+
+        # the PSF models need the real WCS, but the wrapper only needs local
+        # jacobians when drawing the PSF images, which the surrogate gives
+        # much faster
+        if use_surrogate:
+            wrap_wcs = get_wcs_surrogate(
+                image_path=_info['image_path'].replace(
+                    TMP_DIR, output_meds_dir),
+                image_ext=_info['image_ext'],
+                image_shape=tuple(_info['image_shape']),
+                max_pos_err=wcs_kws.get('max_pos_err', 1e-3),
+                max_jac_err=wcs_kws.get('max_jac_err', 1e-5))
+        else:
+            wrap_wcs = wcs
+
+        if use_lattice:
+            wrap_kws = {
+                'lattice_spacing': lattice_spacing,
+                'image_shape': tuple(_info['image_shape'])}
+        else:
+            wrap_kws = {}
         
         if psf_kws['type'] == 'gauss' or force_gauss:
-            return PSFWrapper(galsim.Gaussian(fwhm=0.9), wcs)
+            return PSFWrapper(galsim.Gaussian(fwhm=0.9), wrap_wcs, **wrap_kws)
         
         #elif psf_kws['type'] == 'piff':
         #    from ..des_piff import DES_Piff
         #    piff_model = DES_Piff(expand_path(_info['piff_path']))
-        #    return PSFWrapper(piff_model, wcs)
+        #    return PSFWrapper(piff_model, wrap_wcs)
         
         elif psf_kws['type'] == 'gauss-pix':
             from gauss_pix_psf import GaussPixPSF
             kwargs = {k: psf_kws[k] for k in psf_kws if k != 'type'}
-            psf_model = GaussPixPSF(**kwargs)
-            return PSFWrapper(psf_model, wcs)
+            psf_model = GaussPixPSF(cache_id=_info['image_path'], **kwargs)
+            return PSFWrapper(psf_model, wrap_wcs, **wrap_kws)
 
         elif psf_kws['type'] == 'nongauss-pix':
             from nongauss_pix_psf import NonGaussPixPSF
             kwargs = {k: psf_kws[k] for k in psf_kws if k != 'type'}
-            psf_model = NonGaussPixPSF(**kwargs)
-            return PSFWrapper(psf_model, wcs)
+            psf_model = NonGaussPixPSF(cache_id=_info['image_path'], **kwargs)
+            return PSFWrapper(psf_model, wrap_wcs, **wrap_kws)
         
         elif psf_kws['type'] == 'psfex':
-            from galsim.des import DES_PSFEx
-            psfex_model = DES_PSFEx(expand_path(_info['psfex_path']), wcs = wcs)
-            return PSFWrapper(psfex_model, wcs)
+            from psfex_batching import DES_PSFExBatch
+            psfex_model = DES_PSFExBatch(expand_path(_info['psfex_path']), wcs = wcs)
+            return PSFWrapper(psfex_model, wrap_wcs, **wrap_kws)
         
         elif psf_kws['type'] == 'des_psfex':
             from des_psfex import DES_PSFEx_Deconv
-            psfex_model = DES_PSFEx_Deconv(expand_path(_info['psfex_path']), wcs = wcs)
-            return PSFWrapper(psfex_model, wcs)
+            psfex_model = DES_PSFEx_Deconv(
+                expand_path(_info['psfex_path']), wcs = wcs,
+                fit_cache_dir=psf_kws.get('fit_cache_dir', None),
+                fit_n_jobs=psf_kws.get('fit_n_jobs', 1),
+                psf_quantum=psf_kws.get('psf_quantum', None))
+            return PSFWrapper(psfex_model, wrap_wcs, **wrap_kws)
         
         
         elif psf_kws['type'] == 'psfex_deconvolved':
             from psfex_deconvolved import PSFEx_Deconv
             psfex_model = PSFEx_Deconv(expand_path(_info['psfex_path']), wcs = wcs)
-            return PSFWrapper(psfex_model, wcs)
+            return PSFWrapper(psfex_model, wrap_wcs, **wrap_kws)
         
         else:
             raise ValueError("psf type '%s' is not valid!" % psf_kws['type'])
 
+    # the pixelized PSFs are drawn at random for each pixel, so there is
+    # nothing smooth to interpolate between the lattice nodes
+    use_lattice = lattice_spacing is not None
+    if use_lattice and psf_kws['type'] in ['gauss-pix', 'nongauss-pix']:
+        logger.warning(
+            ' not using a PSF lattice for psf type %s since it varies '
+            'randomly from pixel to pixel', psf_kws['type'])
+        use_lattice = False
+
     force_gauss = psf_kws['type'] in ['psfex', 'psfex_deconvolved', 'des_psfex', 'piff']
     psf_data = [_load_psf_data(info, force_gauss=force_gauss)] #QUESTION FOR MATT: Do we force gaussian because we don't care about coadd image?
+    use_surrogate = wcs_kws is not None and wcs_kws.get('surrogate', False)
     for se_info in info['src_info']:
         #print(se_info.keys())
-        psf_data.append(_load_psf_data(se_info))
+        psf_data.append(_load_psf_data(
+            se_info, use_surrogate=use_surrogate, use_lattice=use_lattice))
+
+        # the objects on each CCD are known, so their PSF images can be
+        # drawn in batches as the MEDS maker asks for them
+        if obj_data is not None:
+            rows, cols = _get_object_rows_cols(
+                obj_data=obj_data,
+                wcs=get_galsim_wcs(
+                    image_path=se_info['image_path'].replace(
+                        TMP_DIR, output_meds_dir),
+                    image_ext=se_info['image_ext']),
+                image_shape=se_info['image_shape'],
+                margin=margin)
+            psf_data[-1].set_positions(rows, cols)
+
     return psf_data
 
 
+def _get_object_rows_cols(*, obj_data, wcs, image_shape, margin):
+    """Get the zero-offset rows and cols of the objects within `margin`
+    pixels of an image, in the order of `obj_data`."""
+    x, y = wcs.radecToxy(
+        obj_data['ra'], obj_data['dec'], units=galsim.degrees)
+    rows = np.atleast_1d(y) - 1
+    cols = np.atleast_1d(x) - 1
+    msk = (
+        (rows > -margin) & (rows < image_shape[0] - 1 + margin) &
+        (cols > -margin) & (cols < image_shape[1] - 1 + margin))
+    return rows[msk], cols[msk]
+
+
 def _make_meds_metadata(*, band, tilename):
     meta = np.zeros(1, dtype=[
         ('magzp_ref', 'f8'),
@@ -1,6 +1,8 @@
 import numpy as np
 import galsim
 
+from psf_caching import PIXEL_PSF_CACHE
+
 
 class NonGaussPixPSF(object):
     """A pixelized non-Gaussian PSF (galsim's Moffat profile).
@@ -19,19 +21,39 @@ class NonGaussPixPSF(object):
     s2n : float, optional
         If not `None`, this option forces the code to add noise to the PSF
         image so that it has total S/N `s2n`.
+    cache_dir : str, optional
+        If not None, the PSF images are also cached in this directory. See
+        `psf_caching.PixelPSFCache`.
+    cache_id : str, optional
+        An identifier of the CCD (e.g., its image path) used in the cache
+        key when `draw_with_wcs` is True, since the PSF then depends on the
+        WCS of the CCD.
+    analytic : bool, optional
+        If True, return the sheared analytic Moffat profile instead of an
+        interpolated image of it. This requires `s2n` to be None. See
+        `gauss_pix_psf.compare_analytic_psf` for how much the two differ.
+        Default is False.
 
     Methods
     -------
     getPSF(image_pos)
         Get the PSF represented as an interpolated image at a point.
     """
-    def __init__(self, *,draw_with_wcs,gstd=0.01, beta=3.0, scale_radius=0.9,fwhm_frac_std=0.1, s2n=None):
+    def __init__(self, *,draw_with_wcs,gstd=0.01, beta=3.0, scale_radius=0.9,fwhm_frac_std=0.1, s2n=None,
+                 cache_dir=None, cache_id=None, analytic=False):
         self.gstd = gstd
         self.beta = beta
         self.scale_radius = scale_radius
         self.fwhm_frac_std = fwhm_frac_std
         self.s2n = s2n
         self.draw_with_wcs = draw_with_wcs
+        self.cache_dir = cache_dir
+        self.cache_id = cache_id
+        self.analytic = analytic
+
+        if self.analytic and self.s2n is not None:
+            raise ValueError(
+                "The analytic PSF cannot be used with a PSF s2n!")
         #print('\nFrom nongauss_pix_psf/NonGaussPixPSF: draw_with_wcs=',draw_with_wcs,'\n')
 
     def getPSF(self, image_pos, wcs):
@@ -51,8 +73,29 @@ class NonGaussPixPSF(object):
         """
         wcs = wcs.local(image_pos)
 
+        # the PSF only depends on the nearest pixel (and the CCD if it is
+        # drawn with the WCS), so it is memoized. With the WCS, the cached
+        # image is drawn with the local WCS of the first request for the
+        # pixel.
+        ix = int(image_pos.x + 0.5)
+        iy = int(image_pos.y + 0.5)
+        if self.analytic:
+            return self._make_analytic_psf(ix, iy)[0]
+
+        table_key = (
+            'nongauss-pix', self.gstd, self.beta, self.scale_radius,
+            self.fwhm_frac_std, self.s2n, self.draw_with_wcs,
+            self.cache_id if self.draw_with_wcs else None)
+        return PIXEL_PSF_CACHE.get(
+            table_key=table_key,
+            pixel=(ix, iy),
+            make_image=lambda: self._draw_psf_image(ix, iy, wcs),
+            make_psf=lambda psf_im: self._make_psf(psf_im, wcs),
+            cache_dir=self.cache_dir)
+
+    def _make_analytic_psf(self, ix, iy):
         # we seed with the nearest pixel to make things reproducible
-        seed = int(image_pos.x + 0.5) * 4096 + int(image_pos.y + 0.5)
+        seed = ix * 4096 + iy
         seed = seed % 2**30
         rng = np.random.RandomState(seed=seed)
 
@@ -63,6 +106,10 @@ class NonGaussPixPSF(object):
             1.0) * self.scale_radius
         #psf = galsim.Gaussian(fwhm=fwhm).shear(g1=g1, g2=g2).withFlux(1.0)
         psf = galsim.Moffat(beta=self.beta,scale_radius=fwhm).shear(g1=g1, g2=g2).withFlux(1.0)
+        return psf, rng
+
+    def _draw_psf_image(self, ix, iy, wcs):
+        psf, rng = self._make_analytic_psf(ix, iy)
         
         if self.draw_with_wcs==False:
             psf_im = psf.drawImage(
@@ -75,6 +122,9 @@ class NonGaussPixPSF(object):
             noise_std = np.sqrt(np.sum(psf_im**2)/self.s2n**2)
             psf_im += (rng.normal(size=psf_im.shape) * noise_std)
 
+        return psf_im
+
+    def _make_psf(self, psf_im, wcs):
         if self.draw_with_wcs==False:
             psf = galsim.InterpolatedImage(
                 galsim.ImageD(psf_im),
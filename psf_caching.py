@@ -0,0 +1,237 @@
+import os
+import fcntl
+import hashlib
+import collections
+
+import numpy as np
+
+
+class PixelPSFCache(object):
+    """A bounded LRU cache of pixel-seeded PSFs with an optional on-disk
+    cache of their images.
+
+    The pixelized PSFs (see `GaussPixPSF` and `NonGaussPixPSF`) are a
+    deterministic function of the nearest pixel, their keyword arguments
+    and, if drawn with the WCS, the CCD. The PSF objects are kept in memory
+    in a LRU cache. Their images can also be written to a directory so that
+    they are shared between processes and between the galsim and MEDS
+    stages.
+
+    On disk, the images of each table (i.e., one PSF configuration and,
+    if needed, one CCD) are stored in a single memory-mapped `.npy` table
+    keyed by pixel. New images are kept in memory and merged into the table
+    every `flush_size` images and when `flush` is called.
+
+    Parameters
+    ----------
+    max_size : int, optional
+        The maximum number of PSFs kept in memory. Default is 4096.
+    flush_size : int, optional
+        The number of new images of a table kept in memory before they are
+        written to disk. Default is 1024.
+
+    Attributes
+    ----------
+    hits : int
+        The number of PSFs found in memory.
+    disk_hits : int
+        The number of PSFs whose image was read from disk.
+    misses : int
+        The number of PSFs that had to be drawn.
+
+    Methods
+    -------
+    get(table_key, pixel, make_image, make_psf, cache_dir=None)
+        Get a PSF from the cache, making it if needed.
+    flush()
+        Write the new images of all of the tables to disk.
+    stats()
+        Get the hit/miss statistics of the cache.
+    """
+    def __init__(self, *, max_size=4096, flush_size=1024):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self._psfs = collections.OrderedDict()
+        self._tables = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, *, table_key, pixel, make_image, make_psf, cache_dir=None):
+        """Get a PSF from the cache, making it if needed.
+
+        Parameters
+        ----------
+        table_key : tuple
+            A key made of python scalars and strings that identifies the
+            PSF configuration and, if the PSF depends on it, the CCD.
+        pixel : 2-tuple of ints
+            The pixel of the PSF.
+        make_image : callable
+            A function with no arguments returning the image of the PSF as
+            a np.ndarray.
+        make_psf : callable
+            A function that takes the image of the PSF and returns the PSF
+            object.
+        cache_dir : str, optional
+            If not None, the images are read from and written to a table in
+            this directory.
+
+        Returns
+        -------
+        psf : galsim.GSObject
+            The PSF.
+        """
+        key = (table_key, pixel)
+        psf = self._psfs.get(key, None)
+        if psf is not None:
+            self._psfs.move_to_end(key)
+            self.hits += 1
+            return psf
+
+        psf_im = None
+        if cache_dir is not None:
+            table = self._get_table(table_key, cache_dir)
+            psf_im = table.get(pixel)
+            if psf_im is not None:
+                self.disk_hits += 1
+
+        if psf_im is None:
+            self.misses += 1
+            psf_im = make_image()
+            if cache_dir is not None:
+                table.add(pixel, psf_im)
+                if len(table.pending) >= self.flush_size:
+                    table.flush()
+
+        psf = make_psf(psf_im)
+        self._psfs[key] = psf
+        if len(self._psfs) > self.max_size:
+            self._psfs.popitem(last=False)
+
+        return psf
+
+    def _get_table(self, table_key, cache_dir):
+        fname = os.path.join(
+            cache_dir,
+            hashlib.sha1(repr(table_key).encode('utf-8')).hexdigest() +
+            '.npy')
+        table = self._tables.get(fname, None)
+        if table is None:
+            table = _PixelTable(fname)
+            self._tables[fname] = table
+        return table
+
+    def flush(self):
+        """Write the new images of all of the tables to disk."""
+        for table in self._tables.values():
+            table.flush()
+
+    def stats(self):
+        """Get the hit/miss statistics of the cache.
+
+        Returns
+        -------
+        stats : dict
+            A dictionary with the 'hits', 'disk_hits', 'misses' and 'size'
+            of the cache and the number of on-disk tables used, 'n_tables'.
+        """
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self._psfs),
+            'n_tables': len(self._tables),
+        }
+
+
+class _PixelTable(object):
+    """The images of one table of the pixel PSF cache, stored in a `.npy`
+    file of records with the pixel ('ix', 'iy') and its 'image'."""
+    def __init__(self, fname):
+        self.fname = fname
+        self.pending = {}
+        self._data = None
+        self._index = {}
+        self._mtime = None
+
+    def get(self, pixel):
+        if pixel in self.pending:
+            return self.pending[pixel]
+
+        # another process may have added to the table since we read it
+        if pixel not in self._index:
+            self._load()
+        ind = self._index.get(pixel, None)
+        if ind is None:
+            return None
+        return np.array(self._data['image'][ind])
+
+    def add(self, pixel, psf_im):
+        self.pending[pixel] = psf_im
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.fname).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+
+        self._data = np.load(self.fname, mmap_mode='r')
+        self._index = {
+            (int(ix), int(iy)): i
+            for i, (ix, iy) in enumerate(
+                zip(self._data['ix'], self._data['iy']))}
+        self._mtime = mtime
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+
+        os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+        # merge under a lock so that processes do not drop each other's
+        # images, and write to a temporary file first so that other
+        # processes never see a partial table
+        with open(self.fname + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            new = [
+                (pixel, psf_im) for pixel, psf_im in self.pending.items()
+                if pixel not in self._index]
+
+            if len(new) > 0:
+                shape = new[0][1].shape
+                n_old = 0 if self._data is None else len(self._data)
+                data = np.zeros(n_old + len(new), dtype=[
+                    ('ix', 'i4'), ('iy', 'i4'), ('image', 'f8', shape)])
+                if n_old > 0:
+                    data[:n_old] = self._data
+                for i, (pixel, psf_im) in enumerate(new):
+                    data['ix'][n_old + i] = pixel[0]
+                    data['iy'][n_old + i] = pixel[1]
+                    data['image'][n_old + i] = psf_im
+
+                tmp_fname = self.fname[:-len('.npy')] + (
+                    '.tmp%d.npy' % os.getpid())
+                np.save(tmp_fname, data)
+                os.replace(tmp_fname, self.fname)
+                self._load()
+
+        self.pending = {}
+
+
+# one cache per process
+PIXEL_PSF_CACHE = PixelPSFCache()
+
+
+def get_pixel_psf_cache_stats():
+    """Get the hit/miss statistics of the pixel-seeded PSF cache of this
+    process. See `PixelPSFCache.stats`."""
+    return PIXEL_PSF_CACHE.stats()
+
+
+def flush_pixel_psf_cache():
+    """Write the new PSF images of the pixel-seeded PSF cache of this
+    process to disk. See `PixelPSFCache.flush`."""
+    PIXEL_PSF_CACHE.flush()
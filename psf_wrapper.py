@@ -1,3 +1,6 @@
+import collections
+
+import numpy as np
 import galsim
 import galsim.des
 
@@ -7,6 +10,8 @@ from nongauss_pix_psf import NonGaussPixPSF
 from galsim.des import DES_PSFEx
 from des_psfex import DES_PSFEx_Deconv
 from psfex_deconvolved import PSFEx_Deconv
+from psfex_batching import DES_PSFExBatch
+from wcsing import AffineGridWCS, get_local_jacobians
 
 class PSFWrapper(object):
     """Wrapper to interface galsim objects.
@@ -25,24 +30,61 @@ class PSFWrapper(object):
     n_pix : int
         The number of pixels on a side for PSF image. Make sure to make it
         an odd number.
+    lattice_spacing : int, optional
+        If not None, `get_rec` interpolates bilinearly between PSF images
+        drawn on a lattice of nodes with this spacing in pixels over the
+        image instead of drawing the PSF at each position. The nodes are
+        drawn on first use. Default is None, which draws every PSF image
+        exactly.
+    image_shape : tuple of ints, optional
+        The shape of the image the lattice covers. Default is a DES CCD,
+        (4096, 2048).
+    chunk_size : int, optional
+        The number of positions from `set_positions` drawn together by
+        `get_rec`. Default is 256.
 
     Methods
     -------
     get_rec(row, col)
         Get a reconstruction of the PSF.
+    get_recs(rows, cols)
+        Get reconstructions of the PSF at many positions at once.
+    set_positions(rows, cols)
+        Set the positions `get_rec` will be asked for so it can draw them
+        in batches.
+    fill_lattice()
+        Draw all of the nodes of the lattice at once.
+    get_lattice_error(n_test=16, seed=None)
+        Get the largest pixel residual of the lattice interpolation.
     get_rec_shape(row, col)
         Get the image shape of a reconstruction of the PSF.
     getPSF(image_pos)
         Get the PSF as a galsim.GSObject at a given image position.
+    getPSFs(image_pos)
+        Get the PSFs as galsim.GSObjects at many image positions at once.
     get_center(row, col)
         Get the center of the PSF in the stamp/cutout.
     get_sigma(row, col)
         Raises a `NotImplementedError`. Here to make sure no code is using it.
     """
-    def __init__(self, psf, wcs, n_pix=53):
+    def __init__(
+            self, psf, wcs, n_pix=53, lattice_spacing=None,
+            image_shape=(4096, 2048), chunk_size=256):
         self.psf = psf
         self.wcs = wcs
         self.n_pix = n_pix
+        self.lattice_spacing = lattice_spacing
+        self.image_shape = image_shape
+        self.chunk_size = chunk_size
+        self._pos_rows = None
+        self._pos_index = {}
+        self._chunks = collections.OrderedDict()
+        if lattice_spacing is not None:
+            self._lattice_rows = _make_lattice_nodes(
+                image_shape[0], lattice_spacing)
+            self._lattice_cols = _make_lattice_nodes(
+                image_shape[1], lattice_spacing)
+        self._lattice = {}
 
     def get_rec_shape(self, row, col):
         """Get the shape of the PSF image at a position.
@@ -63,13 +105,16 @@ class PSFWrapper(object):
         """
         return (self.n_pix, self.n_pix)
 
-    def getPSF(self, image_pos):
+    def getPSF(self, image_pos, local_wcs=None):
         """Get the PSF as a galsim.GSObject at a given image position.
 
         Parameters
         ----------
         image_pos : galsim.PositionD
             The image position in one-indexed, pixel centered coordinates.
+        local_wcs : galsim.LocalWCS, optional
+            The local WCS at `image_pos`, if it is already known. It is
+            computed from the WCS of the wrapper otherwise.
 
         Returns
         -------
@@ -84,31 +129,70 @@ class PSFWrapper(object):
         #    return self.psf.getPSF(image_pos, wcs)
 
         elif isinstance(self.psf, NonGaussPixPSF):
-            wcs = self.wcs.local(image_pos)
+            wcs = self._local_wcs(image_pos, local_wcs)
             return self.psf.getPSF(image_pos, wcs)
         
         elif isinstance(self.psf, GaussPixPSF):
-            wcs = self.wcs.local(image_pos)
+            wcs = self._local_wcs(image_pos, local_wcs)
             return self.psf.getPSF(image_pos, wcs)
         
         elif isinstance(self.psf, DES_PSFEx):
             return self.psf.getPSF(image_pos) #Wrapper doesn't take wcs. Need to pass it when reading file.
         
         elif isinstance(self.psf, DES_PSFEx_Deconv):
-            wcs = self.wcs.local(image_pos)
+            wcs = self._local_wcs(image_pos, local_wcs)
             return self.psf.getPSF(image_pos, wcs)
         
         elif isinstance(self.psf, PSFEx_Deconv):
-            wcs = self.wcs.local(image_pos)
+            wcs = self._local_wcs(image_pos, local_wcs)
             return self.psf.getPSF(image_pos, wcs)
         
         else:
             raise ValueError(
                 'We did not recognize the PSF type! %s' % self.psf)
 
+    def getPSFs(self, image_pos, local_wcs=None):
+        """Get the PSFs as galsim.GSObjects at many image positions at once.
+
+        Parameters
+        ----------
+        image_pos : list of galsim.PositionD
+            The image positions in one-indexed, pixel centered coordinates.
+        local_wcs : list of galsim.LocalWCS, optional
+            The local WCS at each of `image_pos`, if they are already known.
+
+        Returns
+        -------
+        psfs : list of galsim.GSObject
+            The PSF at each position.
+        """
+        xs = np.array([pos.x for pos in image_pos])
+        ys = np.array([pos.y for pos in image_pos])
+        if isinstance(self.psf, DES_PSFEx_Deconv):
+            return self.psf.getPSFs(xs, ys)
+
+        elif isinstance(self.psf, (DES_PSFExBatch, PSFEx_Deconv)):
+            return self.psf.getPSFs(xs, ys, local_wcs=local_wcs)
+
+        if local_wcs is None:
+            local_wcs = [None] * len(image_pos)
+        return [
+            self.getPSF(pos, local_wcs=wcs)
+            for pos, wcs in zip(image_pos, local_wcs)]
+
+    def _local_wcs(self, image_pos, local_wcs):
+        if local_wcs is None:
+            return self.wcs.local(image_pos)
+        return local_wcs
+
     def get_rec(self, row, col):
         """Get the PSF at a position.
 
+        If `lattice_spacing` was given, the image is interpolated from the
+        PSF images at the nearest lattice nodes. If the position was given
+        to `set_positions`, the image is drawn together with the rest of
+        its chunk of positions.
+
         Parameters
         ----------
         row : float
@@ -121,52 +205,216 @@ class PSFWrapper(object):
         Returns
         -------
         psf : np.ndarray, shape (npix, npix)
-            An image of the PSF.
+            An image of the PSF as float32.
+        """
+        ind = self._find_position(row, col)
+        if ind is None:
+            return self.get_recs([row], [col])[0]
+
+        chunk = ind // self.chunk_size
+        psfs = self._chunks.get(chunk, None)
+        if psfs is None:
+            start = chunk * self.chunk_size
+            end = start + self.chunk_size
+            psfs = self.get_recs(
+                self._pos_rows[start:end], self._pos_cols[start:end])
+            self._chunks[chunk] = psfs
+            # the MEDS maker goes through the objects in order, so only a
+            # few chunks are needed at once
+            if len(self._chunks) > 4:
+                self._chunks.popitem(last=False)
+        else:
+            self._chunks.move_to_end(chunk)
+        return psfs[ind - chunk * self.chunk_size]
+
+    def set_positions(self, rows, cols):
+        """Set the positions `get_rec` will be asked for.
+
+        The PSF images at these positions are drawn by `get_rec` in chunks
+        of `chunk_size` consecutive positions with `get_recs`, so the
+        positions should be in the order they will be asked for. Only a few
+        chunks are kept at once. Any other position is drawn on its own.
+
+        Parameters
+        ----------
+        rows : array-like
+            The rows in zero-offset image coordinates.
+        cols : array-like
+            The cols in zero-offset image coordinates.
+        """
+        self._pos_rows = np.atleast_1d(np.asarray(rows, dtype=np.float64))
+        self._pos_cols = np.atleast_1d(np.asarray(cols, dtype=np.float64))
+        self._pos_index = {}
+        for i, (row, col) in enumerate(zip(
+                np.round(self._pos_rows).astype(int),
+                np.round(self._pos_cols).astype(int))):
+            self._pos_index.setdefault((row, col), []).append(i)
+        self._chunks.clear()
+
+    def _find_position(self, row, col, tol=1e-3):
+        # the MEDS maker computes the positions with its own WCS code, so
+        # they can differ slightly from ours
+        inds = self._pos_index.get(
+            (int(np.round(row)), int(np.round(col))), [])
+        for ind in inds:
+            if (
+                    abs(self._pos_rows[ind] - row) < tol and
+                    abs(self._pos_cols[ind] - col) < tol):
+                return ind
+        return None
+
+    def get_recs(self, rows, cols):
+        """Get the PSF images at many positions at once.
+
+        The local WCS and the PSF models are evaluated for all of the
+        positions together. See `get_rec`.
+
+        Parameters
+        ----------
+        rows : array-like
+            The rows at which to get the PSF images in zero-offset image
+            coordinates.
+        cols : array-like
+            The cols at which to get the PSF images in zero-offset image
+            coordinates.
+
+        Returns
+        -------
+        psfs : np.ndarray, shape (n, npix, npix)
+            The images of the PSF as float32.
+        """
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.float64))
+        cols = np.atleast_1d(np.asarray(cols, dtype=np.float64))
+        if self.lattice_spacing is not None:
+            return self._get_lattice_recs(rows, cols)
+        return self._draw_recs(rows, cols)
+
+    def _get_lattice_recs(self, rows, cols):
+        # bilinear interpolation between the four nearest lattice nodes
+        irow, frow = _get_lattice_weight(self._lattice_rows, rows)
+        icol, fcol = _get_lattice_weight(self._lattice_cols, cols)
+        self._fill_lattice(set(
+            (ir + dr, ic + dc)
+            for ir, ic in zip(irow, icol)
+            for dr in [0, 1] for dc in [0, 1]))
+
+        def _nodes(_irow, _icol):
+            return np.stack([
+                self._lattice[key] for key in zip(_irow, _icol)])
+
+        frow = frow[:, np.newaxis, np.newaxis]
+        fcol = fcol[:, np.newaxis, np.newaxis]
+        psfs = (
+            (1 - frow) * (1 - fcol) * _nodes(irow, icol) +
+            (1 - frow) * fcol * _nodes(irow, icol+1) +
+            frow * (1 - fcol) * _nodes(irow+1, icol) +
+            frow * fcol * _nodes(irow+1, icol+1))
+        return psfs.astype(np.float32)
+
+    def _fill_lattice(self, keys):
+        keys = sorted(key for key in keys if key not in self._lattice)
+        if len(keys) == 0:
+            return
+
+        psfs = self._draw_recs(
+            self._lattice_rows[[key[0] for key in keys]],
+            self._lattice_cols[[key[1] for key in keys]])
+        for key, psf_im in zip(keys, psfs):
+            self._lattice[key] = psf_im
+
+    def fill_lattice(self):
+        """Draw all of the nodes of the lattice at once.
+
+        The nodes are otherwise drawn only when a PSF image next to them is
+        asked for, which is usually cheaper since the objects of a tile
+        only cover part of most CCDs. Does nothing if there is no lattice.
         """
+        if self.lattice_spacing is None:
+            return
+
+        self._fill_lattice(set(
+            (ir, ic)
+            for ir in range(len(self._lattice_rows))
+            for ic in range(len(self._lattice_cols))))
+
+    def get_lattice_error(self, n_test=16, seed=None):
+        """Get the largest pixel residual of the lattice interpolation.
+
+        The PSF images at `n_test` random positions over the image are drawn
+        exactly and compared to the lattice interpolation.
+
+        Parameters
+        ----------
+        n_test : int, optional
+            The number of positions to test. Default is 16.
+        seed : int, optional
+            The seed for the RNG drawing the positions.
+
+        Returns
+        -------
+        stats : dict or None
+            A dictionary with the 'max_abs_resid' of the pixels, the
+            'max_rel_resid' relative to the peak of the PSF image and the
+            number of lattice nodes drawn, 'n_nodes'. None if there is no
+            lattice.
+        """
+        if self.lattice_spacing is None:
+            return None
+
+        rng = np.random.RandomState(seed=seed)
+        rows = rng.uniform(size=n_test) * (self.image_shape[0] - 1)
+        cols = rng.uniform(size=n_test) * (self.image_shape[1] - 1)
+
+        exact = self._draw_recs(rows, cols)
+        resid = np.max(
+            np.abs(self._get_lattice_recs(rows, cols) - exact), axis=(1, 2))
+
+        return {
+            'max_abs_resid': float(np.max(resid)),
+            'max_rel_resid': float(np.max(
+                resid / np.max(exact, axis=(1, 2)))),
+            'n_nodes': len(self._lattice),
+        }
+
+    def _get_local_wcs_list(self, image_pos):
+        if isinstance(self.wcs, AffineGridWCS) or self.wcs.isCelestial():
+            jac = get_local_jacobians(
+                wcs=self.wcs,
+                x=np.array([pos.x for pos in image_pos]),
+                y=np.array([pos.y for pos in image_pos]))
+            return [galsim.JacobianWCS(*_jac) for _jac in jac]
+
+        return [self.wcs.local(pos) for pos in image_pos]
+
+    def _draw_recs(self, rows, cols):
         # we add 1 to the positions here since the MEDS code uses
         # zero offset positions and galsim + DES stuff expects one-offset
-        im_pos = galsim.PositionD(x=col+1, y=row+1)
-        wcs = self.wcs.local(im_pos)
-        
-        if isinstance(self.psf, galsim.GSObject):
-            psf_im = self.psf.drawImage(
-                nx=self.n_pix, ny=self.n_pix,
-                wcs=wcs).array
-        
-        #elif isinstance(self.psf, DES_Piff):
-        #    psf_at_pos = self.psf.getPSF(im_pos, wcs)
-        #    psf_im = psf_at_pos.drawImage(
-        #        wcs=wcs, nx=self.n_pix, ny=self.n_pix).array
- 
-        elif isinstance(self.psf, NonGaussPixPSF):
-            psf_at_pos = self.psf.getPSF(im_pos, wcs)
-            psf_im = psf_at_pos.drawImage(
-                wcs=wcs, nx=self.n_pix, ny=self.n_pix).array      
+        image_pos = [
+            galsim.PositionD(x=col+1, y=row+1) for row, col in zip(rows, cols)]
+        local_wcs = self._get_local_wcs_list(image_pos)
 
-        elif isinstance(self.psf, GaussPixPSF):
-            psf_at_pos = self.psf.getPSF(im_pos, wcs)
-            psf_im = psf_at_pos.drawImage(
-                wcs=wcs, nx=self.n_pix, ny=self.n_pix).array
-        
-        elif isinstance(self.psf, DES_PSFEx):
-            psf_at_pos = self.psf.getPSF(im_pos) #No wcs passed here. Need to pass when reading file.
-            psf_im = psf_at_pos.drawImage(
-                wcs=wcs, nx=self.n_pix, ny=self.n_pix, method = 'no_pixel').array #Need to use no_pixel because PSF is already convolved with pixel scale
-        
-        elif isinstance(self.psf, DES_PSFEx_Deconv):
-            psf_at_pos = self.psf.getPSF(im_pos) #No wcs passed here. Need to pass when reading file.
-            psf_im = psf_at_pos.drawImage(
-                wcs=wcs, nx=self.n_pix, ny=self.n_pix).array 
-            
-        elif isinstance(self.psf, PSFEx_Deconv):
-            psf_at_pos = self.psf.getPSF(im_pos, self.wcs) #Need to pass wcs here in order to get local jacobian and transform pixel scale
-            psf_im = psf_at_pos.drawImage(
-                wcs=wcs, nx=self.n_pix, ny=self.n_pix).array 
-        
-        else:
+        #if isinstance(self.psf, DES_Piff):
+        #    the Piff model takes the local WCS like the pixelized PSFs
+
+        if not isinstance(self.psf, (
+                galsim.GSObject, NonGaussPixPSF, GaussPixPSF, DES_PSFEx,
+                DES_PSFEx_Deconv, PSFEx_Deconv)):
             raise ValueError(
                 'We did not recognize the PSF type! %s' % self.psf)
 
+        psfs = self.getPSFs(image_pos, local_wcs=local_wcs)
+
+        # the PSFEx models are already convolved with the pixel
+        if isinstance(self.psf, DES_PSFEx):
+            method = 'no_pixel'
+        else:
+            method = 'auto'
+
+        psf_ims = np.zeros((len(psfs), self.n_pix, self.n_pix), dtype=np.float32)
+        for psf_at_pos, wcs, psf_im in zip(psfs, local_wcs, psf_ims):
+            psf_at_pos.drawImage(
+                image=galsim.Image(psf_im, wcs=wcs), method=method)
+
         # commented out to make sure this is never done
         # usually this does not help anything
         # leaving notes here for the scientists of the future
@@ -178,7 +426,7 @@ class PSFWrapper(object):
         #     noise = np.random.normal(scale=sigma, size=psf_im.shape)
         #     psf_im += noise
 
-        return psf_im
+        return psf_ims
 
     def get_center(self, row, col):
         """Get the center of the PSF in the stamp/cutout.
@@ -202,3 +450,16 @@ class PSFWrapper(object):
     def get_sigma(self, row, col):
         # note this used to return -99
         raise NotImplementedError()
+
+
+def _make_lattice_nodes(n, spacing):
+    # nodes at both edges of the image, at most `spacing` pixels apart
+    n_nodes = int(np.ceil((n - 1) / spacing)) + 1
+    return np.linspace(0, n - 1, n_nodes)
+
+
+def _get_lattice_weight(nodes, val):
+    ind = np.clip(
+        np.searchsorted(nodes, val, side='right') - 1, 0, len(nodes) - 2)
+    frac = (val - nodes[ind]) / (nodes[ind+1] - nodes[ind])
+    return ind, np.clip(frac, 0, 1)
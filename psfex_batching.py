@@ -0,0 +1,168 @@
+import numpy as np
+import galsim
+from galsim.des import DES_PSFEx
+
+
+class DES_PSFExBatch(DES_PSFEx):
+    """A galsim DES_PSFEx model that evaluates the PSFEx polynomial for many
+    positions at once.
+
+    The file is read by `galsim.des.DES_PSFEx`. The polynomial terms of all
+    of the positions are stacked into a single matrix so that the PSF
+    images are made with one matrix multiply against the PSFEx basis
+    instead of one `tensordot` per object. The PSF objects are built
+    exactly as in `galsim.des.DES_PSFEx.getPSF`.
+
+    Parameters
+    ----------
+    file_name : str
+        The file with the Psfex psf solution.
+    wcs : galsim WCS object, optional
+        The WCS of the SE image, used to bring the PSF from image to world
+        coordinates.
+
+    Methods
+    -------
+    getPSFArrays(xs, ys)
+        Get the PSFEx images at many image positions.
+    getPSFs(xs, ys, local_wcs=None)
+        Get the PSFs at many image positions.
+    """
+    def __init__(self, file_name, wcs=None):
+        super().__init__(file_name, wcs=wcs)
+        self._flat_basis = np.ascontiguousarray(
+            self.basis.reshape(self.fit_size, -1), dtype=np.float64)
+
+    def _get_poly_terms(self, xs, ys):
+        # same ordering of the terms as DES_PSFEx.getPSFArray
+        order = self.fit_order
+        xto = np.power.outer(
+            (np.atleast_1d(xs) - self.x_zero) / self.x_scale,
+            np.arange(order+1))
+        yto = np.power.outer(
+            (np.atleast_1d(ys) - self.y_zero) / self.y_scale,
+            np.arange(order+1))
+        return np.stack([
+            xto[:, nx] * yto[:, ny]
+            for ny in range(order+1) for nx in range(order+1-ny)], axis=1)
+
+    def getPSFArrays(self, xs, ys):
+        """Get the PSFEx images at many image positions.
+
+        Parameters
+        ----------
+        xs : np.ndarray
+            The x image positions.
+        ys : np.ndarray
+            The y image positions.
+
+        Returns
+        -------
+        arrays : np.ndarray, shape (len(xs), ny, nx)
+            The PSFEx image at each position, in PSFEx pixels.
+        """
+        P = self._get_poly_terms(xs, ys)
+        return np.dot(P, self._flat_basis).astype(np.float32).reshape(
+            (P.shape[0],) + self.basis.shape[1:])
+
+    def getPSF(self, image_pos, gsparams=None):
+        """Get the PSF at the image position `image_pos`.
+
+        See `getPSFs`.
+        """
+        return self.getPSFs(
+            np.array([image_pos.x]), np.array([image_pos.y]),
+            gsparams=gsparams)[0]
+
+    def getPSFs(self, xs, ys, local_wcs=None, gsparams=None):
+        """Get the PSFs at many image positions.
+
+        Parameters
+        ----------
+        xs : np.ndarray
+            The x image positions.
+        ys : np.ndarray
+            The y image positions.
+        local_wcs : list of galsim.LocalWCS, optional
+            The local WCS at each position, if it is already known. It is
+            computed from the WCS of the model otherwise.
+        gsparams : galsim.GSParams, optional
+            The galsim configuration to pass to the PSF objects.
+
+        Returns
+        -------
+        psfs : list of galsim.GSObject
+            The PSF at each position.
+        """
+        arrays = self.getPSFArrays(xs, ys)
+
+        psfs = []
+        for i, (x, y) in enumerate(zip(np.atleast_1d(xs), np.atleast_1d(ys))):
+            psf = galsim.InterpolatedImage(
+                galsim.Image(arrays[i]), scale=self.sample_scale, flux=1,
+                x_interpolant=galsim.Lanczos(3), gsparams=gsparams)
+
+            if local_wcs is not None and local_wcs[i] is not None:
+                psf = local_wcs[i].toWorld(psf)
+            elif self.wcs:
+                psf = self.wcs.toWorld(
+                    psf, image_pos=galsim.PositionD(x=x, y=y))
+
+            psfs.append(psf)
+
+        return psfs
+
+
+def compare_psfex_batch(*, file_name, wcs, xs, ys, n_pix=53):
+    """Compare the batched PSFEx model to galsim's implementation.
+
+    Parameters
+    ----------
+    file_name : str
+        The file with the Psfex psf solution.
+    wcs : galsim WCS object
+        The WCS of the SE image.
+    xs : np.ndarray
+        The x image positions at which to compare.
+    ys : np.ndarray
+        The y image positions at which to compare.
+    n_pix : int, optional
+        The size of the PSF images drawn with the local WCS. Default is 53.
+
+    Returns
+    -------
+    stats : dict
+        A dictionary with
+            max_abs_array_diff : float
+                The largest absolute difference of the PSFEx images.
+            max_rel_image_diff : float
+                The largest absolute difference of the PSF images drawn
+                with the local WCS, relative to the peak of the image.
+    """
+    batch = DES_PSFExBatch(file_name, wcs=wcs)
+    ref = DES_PSFEx(file_name, wcs=wcs)
+
+    arrays = batch.getPSFArrays(xs, ys)
+    psfs = batch.getPSFs(xs, ys)
+
+    max_array_diff = 0.0
+    max_image_diff = 0.0
+    for i, (x, y) in enumerate(zip(xs, ys)):
+        pos = galsim.PositionD(x=x, y=y)
+        max_array_diff = max(
+            max_array_diff,
+            np.max(np.abs(arrays[i] - ref.getPSFArray(pos))))
+
+        local_wcs = wcs.local(pos)
+        im = psfs[i].drawImage(
+            nx=n_pix, ny=n_pix, wcs=local_wcs, method='no_pixel').array
+        ref_im = ref.getPSF(pos).drawImage(
+            nx=n_pix, ny=n_pix, wcs=local_wcs, method='no_pixel').array
+        max_image_diff = max(
+            max_image_diff,
+            np.max(np.abs(im - ref_im)) / np.max(np.abs(ref_im)))
+
+    return {
+        'max_abs_array_diff': max_array_diff,
+        'max_rel_image_diff': max_image_diff,
+    }
@@ -2,7 +2,8 @@ import os
 
 import numpy as np
 import galsim
-from galsim.des import DES_PSFEx
+
+from psfex_batching import DES_PSFExBatch
 
 class PSFEx_Deconv(object):
     """A wrapper for PSFEx to use with Galsim. Main use is deconvolving pixel scale.
@@ -23,7 +24,7 @@ class PSFEx_Deconv(object):
     def __init__(self, file_name, wcs):
         self.file_name = file_name
         self.wcs = wcs
-        self._psfex = DES_PSFEx(os.path.expanduser(os.path.expandvars(file_name)), wcs = wcs)
+        self._psfex = DES_PSFExBatch(os.path.expanduser(os.path.expandvars(file_name)), wcs = wcs)
 
     def getPSFEx(self):
         return self._psfex
@@ -49,8 +50,40 @@ class PSFEx_Deconv(object):
         
         psf = self.getPSFEx().getPSF(image_pos) #Get galsim PSF object
         
-        wcs = wcs.jacobian(image_pos=image_pos)
-        pixel = wcs.toWorld(galsim.Pixel(scale=1)) #Get pixel profile in correct wcs
+        return self._deconvolve_pixel(psf, wcs.jacobian(image_pos=image_pos))
+
+    def getPSFs(self, xs, ys, local_wcs=None):
+        """Get the deconvolved PSFs at many image positions.
+
+        The PSFEx images for all of the positions are made at once. See
+        `psfex_batching.DES_PSFExBatch`.
+
+        Parameters
+        ----------
+        xs : np.ndarray
+            The x image positions.
+        ys : np.ndarray
+            The y image positions.
+        local_wcs : list of galsim.LocalWCS, optional
+            The local WCS at each position, if it is already known. It is
+            computed from the WCS of the model otherwise.
+
+        Returns
+        -------
+        psfs : list of galsim.GSObject
+            The PSF at each position.
+        """
+        if local_wcs is None:
+            local_wcs = [
+                self.wcs.local(galsim.PositionD(x=x, y=y))
+                for x, y in zip(xs, ys)]
+        psfs = self.getPSFEx().getPSFs(xs, ys, local_wcs=local_wcs)
+        return [
+            self._deconvolve_pixel(psf, wcs.jacobian())
+            for psf, wcs in zip(psfs, local_wcs)]
+
+    def _deconvolve_pixel(self, psf, jac):
+        pixel = jac.toWorld(galsim.Pixel(scale=1)) #Get pixel profile in correct wcs
 
         deconvolution_kernel = galsim.Deconvolve(pixel) #Create kernel to deconvolve pixel window
         
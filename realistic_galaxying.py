@@ -1,25 +1,118 @@
 import os
+import hashlib
 import functools
 import collections
 import numpy as np
 
 import galsim
 import fitsio
+import yaml
 
 WLDeblendData = collections.namedtuple(
     'WLDeblendData',
     [
         'cat', 'rand_rot', 'survey_name', 'bands', 'surveys',
         'builders', 'total_sky', 'noise', 'ngal_per_arcmin2',
-        'psf_fwhm', 'pixel_scale',
+        'psf_fwhm', 'pixel_scale', 'params',
     ],
 )
 
+# the parameters of the galsim profiles of the descwl galaxies, summed over
+# bands, see `make_descwl_params`
+DESCWL_PARAMS_DTYPE = [
+    ('disk_flux', 'f8'), ('disk_hlr', 'f8'), ('disk_q', 'f8'),
+    ('bulge_flux', 'f8'), ('bulge_hlr', 'f8'), ('bulge_q', 'f8'),
+    ('agn_flux', 'f8'), ('beta', 'f8'),
+]
 
-# @functools.lru_cache(maxsize=8)
-def _cached_catalog_read():
+
+# the columns of the OneDegSq catalog used by `make_descwl_params` and the
+# descwl galaxy builders
+DESCWL_CATALOG_COLUMNS = [
+    'galtileid', 'redshift',
+    'fluxnorm_disk', 'fluxnorm_bulge', 'fluxnorm_agn',
+    'a_d', 'b_d', 'a_b', 'b_b', 'pa_disk', 'pa_bulge',
+    'u_ab', 'g_ab', 'r_ab', 'i_ab', 'z_ab', 'y_ab',
+]
+
+
+def _cached_catalog_read(*, max_size=0.5):
+    """Read the OneDegSq catalog, cut to galaxies with a disk and bulge
+    semi-major axis less than `max_size` arcsec.
+
+    The first call converts the needed columns of the cut catalog to a
+    `.npy` file in `$DESCWL_CACHE_DIR` (default `$CATSIM_DIR`). The file
+    name is keyed by the size, modification time and checksum of the
+    catalog and by the cut, so it is remade if any of them change. Later
+    calls memory-map it copy-on-write, so that every process shares the
+    pages through the OS cache and can still edit its own copy.
+
+    Parameters
+    ----------
+    max_size : float, optional
+        The cut on the semi-major axes in arcsec. Default is 0.5.
+
+    Returns
+    -------
+    cat : np.ndarray
+        The cut catalog.
+    n_full : int
+        The number of objects in the catalog before the cut.
+    """
     fname = os.path.join(os.environ.get('CATSIM_DIR', '.'), 'OneDegSq.fits',)
-    return fitsio.read(fname)
+    cache_dir = os.environ.get(
+        'DESCWL_CACHE_DIR', os.path.dirname(os.path.abspath(fname)))
+
+    stat = os.stat(fname)
+    hdr = fitsio.read_header(fname, ext=1)
+    key = hashlib.sha1(repr((
+        stat.st_size, stat.st_mtime_ns, hdr.get('DATASUM', None),
+        hdr.get('CHECKSUM', None), max_size, DESCWL_CATALOG_COLUMNS,
+    )).encode('utf-8')).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, 'OneDegSq_%s.npy' % key)
+    meta_path = os.path.join(cache_dir, 'OneDegSq_%s.yaml' % key)
+
+    if not (os.path.exists(cache_path) and os.path.exists(meta_path)):
+        _write_catalog_cache(
+            fname=fname,
+            cache_path=cache_path,
+            meta_path=meta_path,
+            max_size=max_size)
+
+    with open(meta_path, 'r') as fp:
+        meta = yaml.load(fp, Loader=yaml.Loader)
+
+    return np.load(cache_path, mmap_mode='c'), meta['n_full']
+
+
+def _write_catalog_cache(*, fname, cache_path, meta_path, max_size):
+    # only read the columns that exist in this version of the catalog
+    with fitsio.FITS(fname) as fits:
+        colnames = fits[1].get_colnames()
+        n_full = fits[1].get_nrows()
+    columns = [c for c in DESCWL_CATALOG_COLUMNS if c in colnames]
+    cat = fitsio.read(fname, ext=1, columns=columns)
+
+    #CUT OUT LARGE GALAXIES FROM DATASET
+    #Check largest axis size and remove galaxy based on that size
+    size = np.max([cat['a_d'], cat['a_b']], axis=0)
+    cat = cat[size < max_size]
+
+    # write to temporary files first so that other processes never see
+    # partial files
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    pid = os.getpid()
+    tmp_cache_path = cache_path[:-len('.npy')] + '.tmp%d.npy' % pid
+    tmp_meta_path = meta_path + '.tmp%d' % pid
+    np.save(tmp_cache_path, cat)
+    with open(tmp_meta_path, 'w') as fp:
+        yaml.dump({
+            'catalog': os.path.abspath(fname),
+            'n_full': int(n_full),
+            'max_size': float(max_size),
+            'columns': columns}, fp)
+    os.replace(tmp_cache_path, cache_path)
+    os.replace(tmp_meta_path, meta_path)
 
 
 # @functools.lru_cache(maxsize=8)
@@ -44,6 +137,62 @@ def init_descwl_catalog(*, survey_bands, rng):
     survey_name, bands = survey_bands.split("-")
     bands = [b for b in bands]
 
+    if survey_name not in ["des", "lsst"]:
+        raise RuntimeError(
+            "Survey for wldeblend must be one of 'des' or 'lsst'"
+            " - got %s!" % survey_name
+        )
+
+    # the catalog comes back with large galaxies already cut out
+    wldeblend_cat, n_full = _cached_catalog_read(max_size=0.5)
+
+    # when we sample from the catalog, we need to pull the right number
+    # of objects. Since the default catalog is one square degree
+    # and we fill a fraction of the image, we need to set the
+    # base source density `ngal`. This is in units of number per
+    # square arcminute.
+    ngal_per_arcmin2 = n_full / (60 * 60)
+
+    #If rng not supplied then don't do random rotation
+    if rng is None:
+        angle = None
+    else:
+        angle = rng.uniform(low = 0, high = 1, size = len(wldeblend_cat))*360
+    
+    return make_descwl_data(
+        survey_bands=survey_bands,
+        cat=wldeblend_cat,
+        rand_rot=angle,
+        ngal_per_arcmin2=ngal_per_arcmin2)
+
+
+def make_descwl_data(*, survey_bands, cat, rand_rot, ngal_per_arcmin2):
+    """Build the weak lensing deblending survey data around a catalog.
+
+    This function does not read anything from disk, so it can be used to
+    rebuild the data in a worker process from arrays that were already
+    loaded (e.g., memory-mapped) elsewhere.
+
+    Parameters
+    ----------
+    survey_bands : str
+        The name of the survey followed by the bands like 'des-riz', 'lsst-iz', etc.
+    cat : np.ndarray
+        The (cut) weak lensing deblending catalog.
+    rand_rot : np.ndarray or None
+        The random rotation in degrees of each galaxy in `cat`.
+    ngal_per_arcmin2 : float
+        The base source density in number per square arcminute.
+
+    Returns
+    -------
+    data : WLDeblendData
+        Namedtuple with data for making galaxies via the weak lesning
+        deblending package.
+    """
+    survey_name, bands = survey_bands.split("-")
+    bands = [b for b in bands]
+
     if survey_name not in ["des", "lsst"]:
         raise RuntimeError(
             "Survey for wldeblend must be one of 'des' or 'lsst'"
@@ -64,8 +213,6 @@ def init_descwl_catalog(*, survey_bands, rng):
     else:
         exptime = None
 
-    wldeblend_cat = _cached_catalog_read()
-
     surveys = []
     builders = []
     total_sky = 0.0
@@ -113,35 +260,74 @@ def init_descwl_catalog(*, survey_bands, rng):
     elif survey_name == "des":
         psf_fwhm = 1.1
 
-    # when we sample from the catalog, we need to pull the right number
-    # of objects. Since the default catalog is one square degree
-    # and we fill a fraction of the image, we need to set the
-    # base source density `ngal`. This is in units of number per
-    # square arcminute.
-    ngal_per_arcmin2 = wldeblend_cat.size / (60 * 60)
+    params = make_descwl_params(cat=cat, rand_rot=rand_rot, surveys=surveys)
 
-    
-    #CUT OUT LARGE GALAXIES FROM DATASET
-    #Check largest axis size and remove galaxy based on that size
-#     size = np.max([wldeblend_cat['a_d'], wldeblend_cat['b_d'], wldeblend_cat['a_b'], wldeblend_cat['b_b']], axis = 0)
-    size = np.max([wldeblend_cat['a_d'],wldeblend_cat['a_b']], axis = 0)
-#     wldeblend_cat['size'] = size
-#     wldeblend_cat = wldeblend_cat[size < 0.8]
-    wldeblend_cat = wldeblend_cat[size < 0.5]
-    
-    #If rng not supplied then don't do random rotation
-    if rng is None:
-        angle = None
-    else:
-        angle = rng.uniform(low = 0, high = 1, size = len(wldeblend_cat))*360
-    
     return WLDeblendData(
-        wldeblend_cat, angle, survey_name, bands, surveys,
+        cat, rand_rot, survey_name, bands, surveys,
         builders, total_sky, noise, ngal_per_arcmin2,
-        psf_fwhm, scale,
+        psf_fwhm, scale, params,
     )
 
 
+def make_descwl_params(*, cat, rand_rot, surveys):
+    """Compute the galsim profile parameters of all of the galaxies in a
+    weak lensing deblending catalog at once.
+
+    This follows `descwl.model.GalaxyBuilder.from_catalog` with the disk,
+    bulge and AGN all turned on and no cosmic shear. The shapes of the
+    components do not depend on the band, so the fluxes are summed over the
+    bands and each galaxy is a single sum of a disk, a bulge and an AGN.
+    The random rotation is added to the position angle.
+
+    This must be called again if the shape columns of `cat` are changed.
+
+    Parameters
+    ----------
+    cat : np.ndarray
+        The (cut) weak lensing deblending catalog.
+    rand_rot : np.ndarray or None
+        The random rotation in degrees of each galaxy in `cat`. No rotation
+        is applied if None.
+    surveys : list of descwl.survey.Survey
+        The surveys for each band, used to convert magnitudes to fluxes.
+
+    Returns
+    -------
+    params : np.ndarray
+        A structured array with the fields in `DESCWL_PARAMS_DTYPE`. The
+        half light radii are in arcsec and the position angle `beta` is
+        in degrees.
+    """
+    params = np.zeros(len(cat), dtype=DESCWL_PARAMS_DTYPE)
+
+    total_fluxnorm = (
+        cat['fluxnorm_disk'] + cat['fluxnorm_bulge'] + cat['fluxnorm_agn'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for survey in surveys:
+            total_flux = survey.get_flux(
+                np.asarray(cat[survey.filter_band + '_ab']))
+            for comp in ['disk', 'bulge', 'agn']:
+                params[comp + '_flux'] += np.where(
+                    total_fluxnorm > 0,
+                    cat['fluxnorm_' + comp] / total_fluxnorm * total_flux,
+                    0.0)
+
+        # hlr = sqrt(a*b) and q = b/a of the Sersic components
+        for comp, sfx in [('disk', 'd'), ('bulge', 'b')]:
+            has_flux = params[comp + '_flux'] > 0
+            a = cat['a_' + sfx]
+            b = cat['b_' + sfx]
+            params[comp + '_hlr'] = np.where(has_flux, np.sqrt(a * b), 0.0)
+            params[comp + '_q'] = np.where(has_flux, b / a, 0.0)
+
+    params['beta'] = np.where(
+        params['disk_flux'] == 0, cat['pa_bulge'], cat['pa_disk'])
+    if rand_rot is not None:
+        params['beta'] += rand_rot
+
+    return params
+
+
 def get_descwl_galaxy(*, descwl_ind, rng, data):
     """Draw a galaxy from the weak lensing deblending package.
 
@@ -151,41 +337,104 @@ def get_descwl_galaxy(*, descwl_ind, rng, data):
         Index of galaxy in descwl catalog. Needed so galaxy in
         every band/exposure looks the same.
     rng : np.random.RandomState
-        An RNG to use for galaxy orientation
+        Not used. The orientation comes from `data.rand_rot`.
     data : WLDeblendData
         Namedtuple with data for making galaxies via the weak lesning
-        deblending package.
+        deblending package. The galaxy is built from its `params` table,
+        see `make_descwl_params`.
 
     Returns
     -------
     gal : galsim Object
         The galaxy as a galsim object.
     """
-    
-    #Overriding rng because we need rotation to be
-    #the same for every band for a given galaxy
-    
-#     rng      = np.random.default_rng(seed = descwl_ind)
-
-#     angle    = rng.uniform() * 360
-#     pa_angle = rng.uniform() * 360
-
-#     angle = 0
-#     print(data.cat['pa_disk'].flags)
-#     print(data.cat['pa_bulge'].flags)
-#     data.cat['pa_disk'][rind] = pa_angle
-#     data.cat['pa_bulge'][rind] = pa_angle
-
-
+    pars = data.params[descwl_ind]
+    beta = pars['beta'] * galsim.degrees
+
+    components = []
+    if pars['disk_flux'] > 0:
+        components.append(galsim.Exponential(
+            flux=pars['disk_flux'],
+            half_light_radius=pars['disk_hlr']).shear(
+                q=pars['disk_q'], beta=beta))
+    if pars['bulge_flux'] > 0:
+        components.append(galsim.DeVaucouleurs(
+            flux=pars['bulge_flux'],
+            half_light_radius=pars['bulge_hlr']).shear(
+                q=pars['bulge_q'], beta=beta))
+    if pars['agn_flux'] > 0:
+        components.append(galsim.Gaussian(flux=pars['agn_flux'], sigma=1e-8))
+
+    if len(components) == 0:
+        # the builders raise the right error for invisible sources
+        return _get_descwl_galaxy_from_builders(
+            descwl_ind=descwl_ind, data=data)
+
+    return galsim.Add(components)
+
+
+def _get_descwl_galaxy_from_builders(*, descwl_ind, data):
+    """Draw a galaxy with the `descwl` galaxy builders of each band. This
+    is much slower than `get_descwl_galaxy` and is kept as a reference."""
+    rot = 0.0 if data.rand_rot is None else data.rand_rot[descwl_ind]
     return galsim.Sum([
         data.builders[band].from_catalog(
             data.cat[descwl_ind], 0, 0,
             data.surveys[band].filter_band).model.rotate(
-                data.rand_rot[descwl_ind] * galsim.degrees)
+                rot * galsim.degrees)
         for band in range(len(data.builders))
     ])
 
 
+def check_descwl_galaxy_parity(*, data, inds, rtol=1e-5):
+    """Check that the galaxies from the vectorized parameter table match
+    those from the `descwl` galaxy builders.
+
+    Both versions of each galaxy are drawn without a PSF on the same grid
+    at the pixel scale of the survey.
+
+    Parameters
+    ----------
+    data : WLDeblendData
+        Namedtuple with data for making galaxies via the weak lesning
+        deblending package.
+    inds : array-like of ints
+        The indices of the galaxies in the catalog to check.
+    rtol : float, optional
+        The maximum absolute difference of the images relative to the
+        peak of the builder image. Default is 1e-5.
+
+    Returns
+    -------
+    max_rel_diff : float
+        The largest relative difference over all of the galaxies.
+
+    Raises
+    ------
+    RuntimeError
+        If any galaxy differs by more than `rtol`.
+    """
+    max_rel_diff = 0.0
+    for ind in inds:
+        gal_ref = _get_descwl_galaxy_from_builders(descwl_ind=ind, data=data)
+        im_ref = gal_ref.drawImage(
+            scale=data.pixel_scale, method='no_pixel').array
+        nx, ny = im_ref.shape[1], im_ref.shape[0]
+
+        gal = get_descwl_galaxy(descwl_ind=ind, rng=None, data=data)
+        im = gal.drawImage(
+            nx=nx, ny=ny, scale=data.pixel_scale, method='no_pixel').array
+
+        rel_diff = np.max(np.abs(im - im_ref)) / np.max(np.abs(im_ref))
+        if rel_diff > rtol:
+            raise RuntimeError(
+                "descwl galaxy %d differs from the builder output by %g "
+                "relative to its peak!" % (ind, rel_diff))
+        max_rel_diff = max(max_rel_diff, rel_diff)
+
+    return max_rel_diff
+
+
 def get_psf_config_wldeblend(*, data):
     """Get a config dict for a the PSF model for the weak lensing deblending
     objects.
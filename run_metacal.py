@@ -191,8 +191,11 @@ def _strip_coadd(mbobs, mcal_config):
     for ol in mbobs:
         _ol = ObsList()
         _ol.update_meta_data(ol.meta)
-        for i in range(1, len(ol)):
-            _ol.append(ol[i])
+        # the coadd is the image with file_id 0 in the MEDS file, which is
+        # not always the first obs if it could not be read
+        for obs in ol:
+            if obs.meta.get('file_id', None) != 0:
+                _ol.append(obs)
         _mbobs.append(_ol)
     return _mbobs
 
@@ -7,11 +7,12 @@ import sys
 import click
 import yaml
 
-from band_infoing import make_band_info
-from simulating import End2EndSimulation
+from band_infoing import make_band_info, make_psfex_fit_cache
+from simulating import End2EndSimulation, add_noise_to_cached_images
 from true_detecting import make_true_detections
 from medsing import make_meds_files
 from run_metacal import run_metacal
+from scratch_running import run_galsim_and_meds_in_scratch
 
 for lib in ['matts_misc.simple_des_y3_sims']:
     lgr = logging.getLogger(lib)
@@ -45,6 +46,25 @@ def prep(tilename, bands, output_desdata, n_files):
         output_meds_dir=output_desdata,
         n_files=n_files)
 
+
+@cli.command('psfex-fits')
+@click.option('--tilename', type=str, required=True,
+              help='the coadd tile to simulate')
+@click.option('--bands', type=str, required=True,
+              help=('a list of bands to fit the PSFEx models for as '
+                    'a concatnated string (e.g., "riz")'))
+@click.option('--output-desdata', type=str, required=True,
+              help='the output DESDATA directory')
+@click.option('--n-jobs', type=int, default=None,
+              help='the number of processes to use (default is all CPUs)')
+def psfex_fits(tilename, bands, output_desdata, n_jobs):
+    """Fit and cache the smooth PSFEx models of a tile after `prep`."""
+    make_psfex_fit_cache(
+        tilename=tilename,
+        bands=[b for b in bands],
+        output_meds_dir=output_desdata,
+        n_jobs=n_jobs)
+
 @cli.command()
 @click.option('--tilename', type=str, required=True,
               help='the coadd tile to simulate')
@@ -57,19 +77,71 @@ def prep(tilename, bands, output_desdata, n_files):
               help='the base RNG seed')
 @click.option('--config-file', type=str, required=True,
               help='the YAML config file')
-def galsim(tilename, bands, output_desdata, seed, config_file):
+@click.option('--shear-output-desdata', type=str, multiple=True,
+              help=('the output DESDATA directory for each entry of '
+                    '`gal_kws.shears` in the config, in the same order'))
+def galsim(tilename, bands, output_desdata, seed, config_file,
+           shear_output_desdata):
     with open(config_file, 'r') as fp:
         config = yaml.load(fp, Loader=yaml.Loader)
+
+    # render several shears in one pass if asked
+    if 'shears' in config['gal_kws']:
+        if len(shear_output_desdata) != len(config['gal_kws']['shears']):
+            raise click.BadParameter(
+                'you must give one --shear-output-desdata per entry '
+                'in gal_kws.shears',
+                param_hint='--shear-output-desdata')
+        shears = [
+            {'g1': g1, 'g2': g2, 'output_meds_dir': odir}
+            for (g1, g2), odir in zip(
+                config['gal_kws']['shears'], shear_output_desdata)]
+    else:
+        shears = None
+
     sim = End2EndSimulation(
         seed=seed,
         output_meds_dir=output_desdata,
         tilename=tilename,
         bands=[b for b in bands],
         gal_kws=config['gal_kws'],
-        psf_kws=config['psf_kws'])
+        psf_kws=config['psf_kws'],
+        shears=shears,
+        wcs_kws=config.get('wcs_kws', None))
     sim.run()
 
 
+@cli.command('add-noise')
+@click.option('--tilename', type=str, required=True,
+              help='the coadd tile to simulate')
+@click.option('--bands', type=str, required=True,
+              help=('a list of bands to simulate as '
+                    'a concatnated string (e.g., "riz")'))
+@click.option('--output-desdata', type=str, required=True,
+              help=('the output DESDATA directory of a galsim run made '
+                    'with `cache_noiseless: True`'))
+@click.option('--seed', type=int, required=True,
+              help='the base RNG seed for the noise')
+@click.option('--config-file', type=str, required=True,
+              help='the YAML config file')
+@click.option('--noisy-output-desdata', type=str, default=None,
+              help=('the output DESDATA directory for the noisy images '
+                    '(defaults to --output-desdata)'))
+def add_noise(
+        tilename, bands, output_desdata, seed, config_file,
+        noisy_output_desdata):
+    """Make a new noise realization from cached noiseless images."""
+    with open(config_file, 'r') as fp:
+        config = yaml.load(fp, Loader=yaml.Loader)
+    add_noise_to_cached_images(
+        seed=seed,
+        noiseless_meds_dir=output_desdata,
+        output_meds_dir=noisy_output_desdata or output_desdata,
+        tilename=tilename,
+        bands=[b for b in bands],
+        gal_kws=config['gal_kws'])
+
+
 @cli.command('true-detection')
 @click.option('--tilename', type=str, required=True,
               help='the coadd tile to simulate')
@@ -123,7 +195,48 @@ def meds(tilename, bands, output_desdata, config_file, meds_config_file):
         bands=[b for b in bands],
         output_meds_dir=output_desdata,
         psf_kws=config['psf_kws'],
-        meds_config=meds_config)
+        meds_config=meds_config,
+        wcs_kws=config.get('wcs_kws', None))
+
+
+@cli.command('galsim-meds-scratch')
+@click.option('--tilename', type=str, required=True,
+              help='the coadd tile to simulate')
+@click.option('--bands', type=str, required=True,
+              help=('a list of bands to simulate as '
+                    'a concatnated string (e.g., "riz")'))
+@click.option('--output-desdata', type=str, required=True,
+              help='the output DESDATA directory')
+@click.option('--seed', type=int, required=True,
+              help='the base RNG seed')
+@click.option('--config-file', type=str, required=True,
+              help='the YAML config file')
+@click.option('--meds-config-file', type=str, required=True,
+              help='the YAML config file for MEDS making')
+@click.option('--scratch-dir', type=str, default=None,
+              help=('the directory for the SE images (defaults to '
+                    '/dev/shm if it exists, otherwise the system temporary '
+                    'directory, which is usually on disk)'))
+@click.option('--keep-se-images', is_flag=True,
+              help='keep the SE images in the output DESDATA directory')
+def galsim_meds_scratch(
+        tilename, bands, output_desdata, seed, config_file,
+        meds_config_file, scratch_dir, keep_se_images):
+    """Run the galsim, true-detection and meds steps in a scratch
+    directory."""
+    with open(config_file, 'r') as fp:
+        config = yaml.load(fp, Loader=yaml.Loader)
+    with open(meds_config_file, 'r') as fp:
+        meds_config = yaml.load(fp, Loader=yaml.Loader)
+    run_galsim_and_meds_in_scratch(
+        tilename=tilename,
+        bands=[b for b in bands],
+        output_meds_dir=output_desdata,
+        seed=seed,
+        config=config,
+        meds_config=meds_config,
+        scratch_dir=scratch_dir,
+        keep_se_images=keep_se_images)
 
 
 @cli.command()
@@ -0,0 +1,238 @@
+import os
+import shutil
+import logging
+import tempfile
+
+import numpy as np
+import yaml
+
+from constants import MEDSCONF
+from files import (
+    get_band_info_file,
+    get_ccd_footprint_file,
+    get_psfex_fit_cache_dir,
+    expand_path,
+    make_dirs_for_file)
+from simulating import End2EndSimulation
+from true_detecting import make_true_detections
+from medsing import make_meds_files
+
+logger = logging.getLogger(__name__)
+
+TMP_DIR = os.environ['TMPDIR']
+
+
+def get_default_scratch_dir():
+    """Get the default scratch directory for the SE images of
+    `run_galsim_and_meds_in_scratch`.
+
+    This is the shared memory file system if there is one, so that the SE
+    images stay in memory, and the system temporary directory otherwise, in
+    which case they are written to whatever disk that is on.
+    """
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+def run_galsim_and_meds_in_scratch(
+        *, tilename, bands, output_meds_dir, seed, config, meds_config,
+        scratch_dir=None, keep_se_images=False):
+    """Run the galsim, true detection and MEDS steps of a tile in a scratch
+    directory, without writing the SE images to the output directory.
+
+    This is not a fused rendering and MEDS making step: the three stages
+    run as they do on their own and the MEDS maker reads the SE images back
+    from the FITS files. Only where those files live changes.
+
+    The galsim, true detection and MEDS steps are run as usual but in a
+    scratch copy of the output directory, by default on the shared memory
+    file system. The SE images are still written as full FITS files, but
+    only there. At the end, the other data products (truth catalog,
+    detection catalogs, coadd data and MEDS files) are moved to
+    `output_meds_dir` and the scratch copy is removed. The SE image paths
+    recorded in the MEDS files then point to the removed scratch copy
+    unless `keep_se_images` is True.
+
+    Before rendering, the space the SE images need is estimated from the
+    size of the input SE files and an error is raised if the scratch
+    directory does not have that much free. A warning is logged if the
+    scratch directory is not in memory (e.g., the fallback to the system
+    temporary directory), since the SE images then go to disk after all.
+
+    Parameters
+    ----------
+    tilename : str
+        The DES coadd tilename (e.g., 'DES2122+0001').
+    bands : list of str
+        A list of bands to process (e.g., `['r', 'i', 'z']`).
+    output_meds_dir : str
+        The DESDATA/MEDS_DIR path of a tile that has been prepped.
+    seed : int
+        The base RNG seed for the simulation.
+    config : dict
+        The simulation config, as for the galsim and true-detection steps.
+    meds_config : dict
+        The MEDS making config.
+    scratch_dir : str, optional
+        The directory in which to make the scratch copy. The default is
+        from `get_default_scratch_dir`.
+    keep_se_images : bool, optional
+        If True, move the SE images to `output_meds_dir` as well. Default
+        is False.
+    """
+    if 'shears' in config['gal_kws']:
+        raise ValueError(
+            'The scratch galsim and MEDS run does not support '
+            '`gal_kws.shears`!')
+
+    # keep the PSF fits with the output and not in the scratch copy
+    psf_kws = config['psf_kws']
+    if psf_kws['type'] == 'des_psfex' and 'fit_cache_dir' not in psf_kws:
+        psf_kws = dict(
+            psf_kws,
+            fit_cache_dir=get_psfex_fit_cache_dir(
+                meds_dir=output_meds_dir,
+                medsconf=MEDSCONF,
+                tilename=tilename))
+
+    if scratch_dir is None:
+        scratch_dir = get_default_scratch_dir()
+    if not _is_memory_fs(scratch_dir):
+        logger.warning(
+            ' scratch directory %s is not in memory so the SE images '
+            'will be written to disk', scratch_dir)
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as work_dir:
+        logger.info(
+            ' running galsim and MEDS steps for coadd tile %s in %s',
+            tilename, work_dir)
+
+        info = {}
+        for band in bands:
+            info[band] = _copy_band_info(
+                tilename=tilename,
+                band=band,
+                src_meds_dir=output_meds_dir,
+                dest_meds_dir=work_dir)
+        _check_scratch_space(info=info, scratch_dir=scratch_dir)
+
+        sim = End2EndSimulation(
+            seed=seed,
+            output_meds_dir=work_dir,
+            tilename=tilename,
+            bands=bands,
+            gal_kws=config['gal_kws'],
+            psf_kws=psf_kws,
+            wcs_kws=config.get('wcs_kws', None))
+        sim.run()
+
+        make_true_detections(
+            tilename=tilename,
+            bands=bands,
+            output_meds_dir=work_dir,
+            box_size=config['true_detection']['box_size'],
+            config=config)
+
+        make_meds_files(
+            tilename=tilename,
+            bands=bands,
+            output_meds_dir=work_dir,
+            psf_kws=psf_kws,
+            meds_config=meds_config,
+            wcs_kws=config.get('wcs_kws', None))
+
+        if not keep_se_images:
+            for band in bands:
+                _remove_se_images(info=info[band], meds_dir=work_dir)
+
+        _move_tree(src=work_dir, dest=output_meds_dir)
+
+
+def _copy_band_info(*, tilename, band, src_meds_dir, dest_meds_dir):
+    """Copy the band info file and CCD footprints of a band, returning the
+    band info."""
+    for get_file in [get_band_info_file, get_ccd_footprint_file]:
+        src = get_file(
+            meds_dir=src_meds_dir,
+            medsconf=MEDSCONF,
+            tilename=tilename,
+            band=band)
+        if not os.path.exists(src):
+            continue
+        dest = get_file(
+            meds_dir=dest_meds_dir,
+            medsconf=MEDSCONF,
+            tilename=tilename,
+            band=band)
+        make_dirs_for_file(dest)
+        shutil.copy(src, dest)
+
+    with open(get_band_info_file(
+            meds_dir=src_meds_dir,
+            medsconf=MEDSCONF,
+            tilename=tilename,
+            band=band), 'r') as fp:
+        return yaml.load(fp, Loader=yaml.Loader)
+
+
+def _check_scratch_space(*, info, scratch_dir):
+    """Raise if the scratch directory cannot hold the SE images of all of
+    the bands."""
+    n_bytes = 0
+    for band_info in info.values():
+        for se_info in band_info['src_info']:
+            for key in ['image_path', 'bkg_path']:
+                fname = expand_path(se_info[key])
+                if os.path.exists(fname):
+                    n_bytes += os.path.getsize(fname)
+                else:
+                    # image, weight, mask and background at 4 bytes each
+                    n_bytes += 4 * 4 * int(np.prod(se_info['image_shape']))
+
+    free = shutil.disk_usage(scratch_dir).free
+    logger.info(
+        ' SE images need about %.1f GB in %s which has %.1f GB free',
+        n_bytes / 1024**3, scratch_dir, free / 1024**3)
+    if n_bytes > free:
+        raise RuntimeError(
+            'The scratch directory %s has %.1f GB free but the SE images '
+            'need about %.1f GB! Use `scratch_dir` to pick another one.' % (
+                scratch_dir, free / 1024**3, n_bytes / 1024**3))
+
+
+def _is_memory_fs(path):
+    """Check if `path` is on a tmpfs or ramfs file system."""
+    path = os.path.realpath(path)
+    try:
+        with open('/proc/mounts', 'r') as fp:
+            mounts = [line.split()[1:3] for line in fp]
+    except OSError:
+        return False
+
+    fstype = None
+    mount_len = -1
+    for mount, _fstype in mounts:
+        if (
+                (path == mount or path.startswith(mount.rstrip('/') + '/'))
+                and len(mount) > mount_len):
+            fstype = _fstype
+            mount_len = len(mount)
+    return fstype in ['tmpfs', 'ramfs']
+
+
+def _remove_se_images(*, info, meds_dir):
+    for se_info in info['src_info']:
+        for key in ['image_path', 'bkg_path']:
+            fname = se_info[key].replace(TMP_DIR, meds_dir)
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
+def _move_tree(*, src, dest):
+    for root, _, fnames in os.walk(src):
+        dest_root = os.path.join(dest, os.path.relpath(root, src))
+        for fname in fnames:
+            dest_fname = os.path.join(dest_root, fname)
+            make_dirs_for_file(dest_fname)
+            shutil.move(os.path.join(root, fname), dest_fname)
@@ -1,4 +1,8 @@
 import logging
+import functools
+import pickle
+import collections
+import concurrent.futures
 import shutil
 import tempfile
 import os
@@ -12,16 +16,37 @@ from esutil.ostools import StagedOutFile
 
 from files import (
     get_band_info_file,
+    get_ccd_footprint_file,
     make_dirs_for_file,
     get_truth_catalog_path,
+    get_psfex_fit_cache_dir,
     expand_path)
-from constants import MEDSCONF
+from constants import MEDSCONF, BOUNDS_BUFFER_UV
 from truthing import make_coadd_grid_radec
-from sky_bounding import get_rough_sky_bounds, radec_to_uv
-from wcsing import get_esutil_wcs, get_galsim_wcs
-from galsiming import render_sources_for_image
+from sky_bounding import (
+    get_rough_sky_bounds,
+    radec_to_uv,
+    make_ccd_footprints,
+    read_ccd_footprints,
+    write_ccd_footprints,
+    SkyIndex)
+from wcsing import (
+    get_esutil_wcs,
+    get_galsim_wcs,
+    get_wcs_surrogate,
+    get_image_positions_and_jacobians)
+from galsiming import (
+    render_stamps_for_image,
+    add_stamps_to_image,
+    get_stamp_size_cache_stats,
+    get_stamp_template_cache_stats)
 from psf_wrapper import PSFWrapper
-from realistic_galaxying import init_descwl_catalog, get_descwl_galaxy
+from psf_caching import flush_pixel_psf_cache, get_pixel_psf_cache_stats
+from realistic_galaxying import (
+    init_descwl_catalog,
+    make_descwl_data,
+    make_descwl_params,
+    get_descwl_galaxy)
 
 logger = logging.getLogger(__name__)
 
@@ -50,11 +75,81 @@ class End2EndSimulation(object):
                 The true shear on the one-axis.
             g2 : float
                 The true shear on the two-axis.
+        Optionally, it can include:
+            cache_noiseless : bool
+                If True, write the noiseless rendered SE images as float32
+                `.npy` files next to the simulated SE images so that new
+                noise realizations can be made with
+                `add_noise_to_cached_images`. Default is False.
+            render_engine : str
+                Either 'stamp' or 'fft'. With 'fft', if every object has
+                the same profile and the PSF is constant (i.e.,
+                `gal_source: simple` with a 'gauss' PSF), each SE image is
+                rendered with FFT convolutions over patches of the image
+                instead of one stamp per object. See
+                `galsiming.render_stamps_fft`. Default is 'stamp'.
+            stamp_templates : bool
+                If True and every object has the same profile and a
+                constant PSF (i.e., `gal_source: simple` with a 'gauss'
+                PSF), the objects are interpolated from stamps pre-rendered
+                at sub-pixel offsets instead of being drawn one by one. It
+                is ignored for the other sources, whose profiles vary from
+                object to object so that nothing would be reused. The
+                interpolation error budget is logged at debug level. See
+                `galsiming.StampTemplateCache`. Default is False.
     psf_kws : dict
         Kyword arguments to control the PSF used for the simulation.
         Right now these should include:
             type : str
                 One of 'gauss' and that's it.
+        The 'gauss-pix' and 'nongauss-pix' PSFs can also take
+            cache_dir : str
+                A directory to cache the PSF images in so that they are
+                shared between processes and with the MEDS step. There is
+                one table of images per PSF configuration (and CCD, if the
+                PSF depends on it). See `psf_caching.PixelPSFCache`.
+        The 'des_psfex' PSF can also take
+            fit_cache_dir : str
+                A directory to cache the smooth model fits in. The default
+                is `files.get_psfex_fit_cache_dir` in `output_meds_dir`.
+                See `des_psfex.DES_PSFEx_Deconv`.
+            fit_n_jobs : int
+                The number of processes used to fit the smooth model of an
+                SE image that is not in the cache. Default is 1. The fits
+                made before rendering are spread over the render pool
+                instead and always use 1.
+            psf_quantum : float
+                If set, the PSF model parameters are rounded to multiples
+                of this value and the PSF objects are cached. Default is
+                None.
+    shears : list of dicts, optional
+        If given, render every SE image once per entry in a single pass,
+        sharing the object lookup, PSFs, background/weight/mask reads and
+        noise field between them. Each entry has the keys
+            g1 : float
+                The true shear on the one-axis.
+            g2 : float
+                The true shear on the two-axis.
+            output_meds_dir : str
+                The output DESDATA/MEDS_DIR for this shear. The band info
+                files and the truth catalog are copied there so that the
+                later stages can be run on it as usual.
+        The default is to render `g1` and `g2` from `gal_kws` into
+        `output_meds_dir`.
+    wcs_kws : dict, optional
+        Keyword arguments to control the WCS used for rendering. These can
+        include:
+            surrogate : bool
+                If True, use a piecewise-affine approximation to the WCS of
+                each SE image for the object positions and local jacobians.
+                See `wcsing.AffineGridWCS`. Default is False.
+            max_pos_err : float
+                The largest allowed position error of the surrogate in
+                pixels. Default is 1e-3.
+            max_jac_err : float
+                The largest allowed error of an element of the local
+                jacobians of the surrogate in arcsec per pixel. Default is
+                1e-5.
 
     Methods
     -------
@@ -63,16 +158,39 @@ class End2EndSimulation(object):
     """
     def __init__(self, *,
                  seed, output_meds_dir, tilename, bands,
-                 gal_kws, psf_kws):
+                 gal_kws, psf_kws, shears=None, wcs_kws=None):
         self.output_meds_dir = output_meds_dir
         self.tilename = tilename
         self.bands = bands
         self.gal_kws = gal_kws
         self.psf_kws = psf_kws
+        if (self.psf_kws['type'] == 'des_psfex' and
+                'fit_cache_dir' not in self.psf_kws):
+            self.psf_kws = dict(
+                self.psf_kws,
+                fit_cache_dir=get_psfex_fit_cache_dir(
+                    meds_dir=self.output_meds_dir,
+                    medsconf=MEDSCONF,
+                    tilename=self.tilename))
+        self.wcs_kws = wcs_kws
         self.seed = seed
+
+        if (self.gal_kws.get('stamp_templates', False) and
+                not _use_stamp_templates(self.gal_kws)):
+            logger.warning(
+                " not using stamp templates for gal_source %s since the "
+                "objects do not share a profile", self.gal_kws['gal_source'])
+
+        if shears is None:
+            shears = [{
+                'g1': self.gal_kws['g1'],
+                'g2': self.gal_kws['g2'],
+                'output_meds_dir': self.output_meds_dir}]
+        self.shears = shears
+
         # any object within a 128 coadd pixel buffer of the edge of a CCD
         # will be rendered for that CCD
-        self.bounds_buffer_uv = 128 * 0.263
+        self.bounds_buffer_uv = BOUNDS_BUFFER_UV
         
         if self.psf_kws['type'] == 'psfex':
             self.draw_method = 'no_pixel'
@@ -80,7 +198,7 @@ class End2EndSimulation(object):
             self.draw_method = 'auto'
 
         # make the RNGS. Extra initial seeds in case we need even more multiple random generators in future
-        seeds = np.random.RandomState(seed=seed).randint(low=1, high=2**30, size=10)
+        seeds = _make_base_seeds(seed)
         
         # one for galaxies (dither) in the truth catalog
         # one for noise in the images
@@ -111,98 +229,302 @@ class End2EndSimulation(object):
         
         # step 2 - make the truth catalog
         truth_cat = self._make_truth_catalog()
-        
-
-        # step 3 - per band, write the images to a tile
-        for band in self.bands:
-            self._run_band(band=band, truth_cat=truth_cat)
-
-    def _run_band(self, *, band, truth_cat):
-        """Run a simulation of a truth cat for a given band."""
-
-        logger.info(" rendering images in band %s", band)
+        self._copy_band_info_to_shear_outputs()
+
+        # step 3 - index the truth catalog on the sky once for all bands
+        sky_index = SkyIndex(ra=truth_cat['ra'], dec=truth_cat['dec'])
+
+        # step 4 - put the catalogs in memory-mapped files once so that the
+        # workers attach to them read-only instead of getting a pickled copy
+        # per SE image
+        with tempfile.TemporaryDirectory(dir=TMP_DIR) as payload_dir:
+            payload = self._write_shared_payload(
+                payload_dir=payload_dir, truth_cat=truth_cat)
+
+            # step 5 - find the objects on every SE image of every band
+            se_tasks = []
+            for band in self.bands:
+                se_tasks.extend(self._plan_band(
+                    band=band, truth_cat=truth_cat, sky_index=sky_index))
+
+            # step 6 - build the galaxy profiles once for the whole tile
+            # instead of once per epoch, if they are expensive to build
+            if self.gal_kws['gal_source'] == 'descwl':
+                payload = self._write_galaxy_cache(
+                    payload_dir=payload_dir,
+                    payload=payload,
+                    truth_cat=truth_cat,
+                    se_tasks=se_tasks)
+
+            # step 7 - render all of the bands at once in a single pool
+            self._render_se_tasks(se_tasks=se_tasks, payload=payload)
+
+    def _plan_band(self, *, band, truth_cat, sky_index):
+        """Get the objects to render and the noise seed for each SE image
+        of a band."""
+
+        logger.info(" planning images in band %s", band)
 
         noise_seeds = self.noise_rng.randint(
             low=1, high=2**30, size=len(self.info[band]['src_info']))
-        
-        jobs = []
-        for noise_seed, se_info in zip(
-                noise_seeds, self.info[band]['src_info']):
 
-            src_func = LazySourceCat(
+        footprints = self._load_ccd_footprints(band=band)
+
+        se_tasks = []
+        for noise_seed, se_info, footprint in zip(
+                noise_seeds, self.info[band]['src_info'], footprints):
+
+            # get the set of good objects for the CCD
+            msk_inds = _cut_tuth_cat_to_se_image(
                 truth_cat=truth_cat,
-                wcs=get_galsim_wcs(
-                    image_path=se_info['image_path'],
-                    image_ext=se_info['image_ext']),
-                psf=self._make_psf_wrapper(se_info=se_info),
-                g1=self.gal_kws['g1'],
-                g2=self.gal_kws['g2'],
-                gal_mag = self.gal_kws['gal_mag'],
-                gal_source = self.gal_kws['gal_source'],
-                galsource_rng = self.galsource_rng,
-                simulated_catalog = self.simulated_catalog)
-
-            jobs.append(joblib.delayed(_render_se_image)(
                 se_info=se_info,
-                band=band,
-                truth_cat=truth_cat,
                 bounds_buffer_uv=self.bounds_buffer_uv,
+                sky_index=sky_index,
+                footprint=footprint)
+
+            se_tasks.append({
+                'band': band,
+                'se_info': se_info,
+                'msk_inds': msk_inds,
+                'noise_seed': noise_seed})
+
+        return se_tasks
+
+    def _render_se_tasks(self, *, se_tasks, payload):
+        """Render the SE images in `se_tasks` with one worker pool.
+
+        Each SE image is split into chunks of objects so that all of the
+        workers stay busy even if there are fewer SE images than workers
+        or some of them have many more objects. The chunks are sent out
+        largest SE image first. They come back as compact lists of stamps
+        which are added to one image per SE image and shear. Once all of
+        the chunks of an SE image are back, the noise, background and mask
+        are added and the image is written by a thread of this process so
+        that the full images are never sent to the workers.
+
+        With the 'des_psfex' PSF, the smooth PSF models of the SE images
+        that are not in the fit cache are fit first, one SE image per
+        worker, so that the workers rendering the chunks of an SE image
+        all read the same fit from the cache instead of each redoing it.
+        """
+        n_workers = joblib.externals.loky.cpu_count()
+        executor = joblib.externals.loky.get_reusable_executor(
+            max_workers=n_workers)
+
+        if (self.psf_kws['type'] == 'des_psfex' and
+                self.psf_kws.get('fit_cache_dir', None) is not None):
+            psf_futures = [
+                executor.submit(
+                    _prefill_psfex_fit_cache,
+                    se_info=task['se_info'],
+                    psf_kws=self.psf_kws,
+                    draw_method=self.draw_method)
+                for task in se_tasks if len(task['msk_inds']) > 0]
+            logger.info(
+                " fitting PSF models for %d SE images", len(psf_futures))
+            for fut in psf_futures:
+                fut.result()
+
+        units = _make_render_units(
+            n_objs=[len(t['msk_inds']) for t in se_tasks],
+            n_workers=n_workers)
+        logger.info(
+            " rendering %d SE images in %d chunks with %d workers",
+            len(se_tasks), len(units), n_workers)
+
+        n_left = collections.Counter(task_ind for task_ind, _ in units)
+        ims = {}
+
+        render_futures = {}
+        for task_ind, inds in units:
+            task = se_tasks[task_ind]
+            fut = executor.submit(
+                _render_se_chunk,
+                se_info=task['se_info'],
+                band=task['band'],
+                msk_inds=task['msk_inds'][inds],
                 draw_method=self.draw_method,
-                noise_seed=noise_seed,
-                output_meds_dir=self.output_meds_dir,
-                src_func=src_func,
-                gal_kws = self.gal_kws))
+                shears=self.shears,
+                payload=payload,
+                psf_kws=self.psf_kws,
+                gal_kws=self.gal_kws,
+                wcs_kws=self.wcs_kws)
+            render_futures[fut] = task_ind
+
+        # the noise, mask and write step is mostly I/O and numpy which
+        # release the GIL, so a few threads are enough
+        finisher = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(4, n_workers))
+        finish_futures = []
+        for fut in concurrent.futures.as_completed(render_futures):
+            task_ind = render_futures.pop(fut)
+            # the chunks come back as lists of stamps which are added to a
+            # single image per shear for the SE image
+            if task_ind not in ims:
+                ims[task_ind] = [
+                    np.zeros(se_tasks[task_ind]['se_info']['image_shape'])
+                    for _ in self.shears]
+            for im, stamps in zip(ims[task_ind], fut.result()):
+                add_stamps_to_image(image=im, stamps=stamps)
+
+            n_left[task_ind] -= 1
+            if n_left[task_ind] == 0:
+                task = se_tasks[task_ind]
+                finish_futures.append(finisher.submit(
+                    _finish_se_image,
+                    ims=ims.pop(task_ind),
+                    se_info=task['se_info'],
+                    noise_seed=task['noise_seed'],
+                    shears=self.shears,
+                    gal_kws=self.gal_kws))
+
+        for i, fut in enumerate(
+                concurrent.futures.as_completed(finish_futures)):
+            fut.result()
+            logger.info(
+                " wrote SE image %d of %d", i + 1, len(finish_futures))
+        finisher.shutdown()
+
+    def _write_shared_payload(self, *, payload_dir, truth_cat):
+        """Write the catalogs needed to render the objects to `.npy` files
+        in `payload_dir` and return a small descriptor of them that is cheap
+        to send to the workers. See `_attach_shared_payload`."""
+        payload = {
+            'truth_cat_path': os.path.join(payload_dir, 'truth_cat.npy'),
+            'sim_cat_path': None,
+            'sim_rot_path': None,
+            'survey_bands': None,
+            'ngal_per_arcmin2': None,
+            'gal_profiles_path': None,
+            'gal_offsets_path': None,
+        }
+        np.save(payload['truth_cat_path'], truth_cat)
+
+        if self.simulated_catalog is None:
+            pass
 
-        with joblib.Parallel(
-                n_jobs=-1, backend='loky', verbose=50, max_nbytes=None) as p:
-            p(jobs)
-
-    def _make_psf_wrapper(self, *, se_info):
-        
-        wcs = get_galsim_wcs(image_path=se_info['image_path'], image_ext=se_info['image_ext'])
+        elif self.gal_kws['gal_source'] == 'descwl':
+            data = self.simulated_catalog
+            payload['sim_cat_path'] = os.path.join(payload_dir, 'sim_cat.npy')
+            np.save(payload['sim_cat_path'], data.cat)
+            if data.rand_rot is not None:
+                payload['sim_rot_path'] = os.path.join(
+                    payload_dir, 'sim_rot.npy')
+                np.save(payload['sim_rot_path'], data.rand_rot)
+            payload['survey_bands'] = '%s-%s' % (
+                data.survey_name, ''.join(data.bands))
+            payload['ngal_per_arcmin2'] = data.ngal_per_arcmin2
 
-        if self.psf_kws['type'] == 'gauss':
-            psf_model = galsim.Gaussian(fwhm=0.9)
-        
-        #elif self.psf_kws['type'] == 'piff':
-        #    from ..des_piff import DES_Piff
-        #    psf_model = DES_Piff(expand_path(se_info['piff_path']))
-        #    assert self.draw_method == 'auto'
-        
-        elif self.psf_kws['type'] == 'gauss-pix':
-            from gauss_pix_psf import GaussPixPSF
-            kwargs = {k: self.psf_kws[k] for k in self.psf_kws if k != 'type'}
-            psf_model = GaussPixPSF(**kwargs)
-            assert self.draw_method == 'auto'
-        
-        elif self.psf_kws['type'] == 'nongauss-pix':
-            from nongauss_pix_psf import NonGaussPixPSF
-            kwargs = {k: self.psf_kws[k] for k in self.psf_kws if k != 'type'}
-            psf_model = NonGaussPixPSF(**kwargs)
-            assert self.draw_method == 'auto'
-
-        elif self.psf_kws['type'] == 'psfex':
-            from galsim.des import DES_PSFEx
-            psf_model = DES_PSFEx(expand_path(se_info['psfex_path']), wcs = wcs) #Need to pass wcs when reading file
-            assert self.draw_method == 'no_pixel'
-        
-        elif self.psf_kws['type'] == 'des_psfex':
-            from des_psfex import DES_PSFEx_Deconv
-            psf_model = DES_PSFEx_Deconv(expand_path(se_info['psfex_path']), wcs = wcs) #Need to pass wcs when reading file
-            assert self.draw_method == 'auto' #Don't need no_pixel since psf already deconvolved
-            
-        elif self.psf_kws['type'] == 'psfex_deconvolved':
-            from psfex_deconvolved import PSFEx_Deconv
-            psf_model = PSFEx_Deconv(expand_path(se_info['psfex_path']), wcs = wcs) #Need to pass wcs when reading file
-            assert self.draw_method == 'auto' #Don't need no_pixel since psf already deconvolved
-        
         else:
-            raise ValueError(
-                "psf type '%s' not recognized!" % self.psf_kws['type'])
-
-        psf_wrap = PSFWrapper(psf_model, wcs)
-
-        return psf_wrap
+            payload['sim_cat_path'] = os.path.join(payload_dir, 'sim_cat.npy')
+            np.save(payload['sim_cat_path'], self.simulated_catalog)
+
+        return payload
+
+    def _write_galaxy_cache(self, *, payload_dir, payload, truth_cat, se_tasks):
+        """Build the pre-PSF galaxy profile of every object that lands on
+        an SE image and write them to the shared payload.
+
+        The profiles are built in the worker pool and pickled. They are
+        written in order of truth catalog index to a single byte array with
+        an array of offsets into it. See `GalaxyProfileCache`. A new payload
+        descriptor with the paths of these files is returned.
+        """
+        inds = np.unique(np.concatenate(
+            [np.zeros(0, dtype=np.int64)]
+            + [task['msk_inds'] for task in se_tasks]))
+        if len(inds) == 0:
+            return payload
+
+        n_workers = joblib.externals.loky.cpu_count()
+        chunks = np.array_split(
+            inds, max(1, min(n_workers * 4, len(inds) // 25)))
+        logger.info(
+            " building %d galaxy profiles in %d chunks",
+            len(inds), len(chunks))
+
+        executor = joblib.externals.loky.get_reusable_executor(
+            max_workers=n_workers)
+        futures = [
+            executor.submit(
+                _make_pickled_galaxies,
+                inds=chunk,
+                payload=payload,
+                gal_kws=self.gal_kws)
+            for chunk in chunks]
+
+        # the chunks are in index order so the profiles can be concatenated
+        # as they come back
+        lengths = np.zeros(len(truth_cat), dtype=np.int64)
+        profiles = []
+        for chunk, fut in zip(chunks, futures):
+            pickled = fut.result()
+            lengths[chunk] = [len(p) for p in pickled]
+            profiles.extend(pickled)
+
+        payload = dict(payload)
+        payload['gal_profiles_path'] = os.path.join(
+            payload_dir, 'gal_profiles.npy')
+        payload['gal_offsets_path'] = os.path.join(
+            payload_dir, 'gal_offsets.npy')
+        np.save(
+            payload['gal_profiles_path'],
+            np.frombuffer(b''.join(profiles), dtype=np.uint8))
+        np.save(
+            payload['gal_offsets_path'],
+            np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+
+        return payload
+
+    def _copy_band_info_to_shear_outputs(self):
+        """Copy the band info files and CCD footprints to the output
+        directory of each shear so that the later stages find them there."""
+        for shear in self.shears:
+            if shear['output_meds_dir'] == self.output_meds_dir:
+                continue
+
+            for band in self.bands:
+                for get_file in [get_band_info_file, get_ccd_footprint_file]:
+                    src = get_file(
+                        meds_dir=self.output_meds_dir,
+                        medsconf=MEDSCONF,
+                        tilename=self.tilename,
+                        band=band)
+                    if not os.path.exists(src):
+                        continue
+                    dest = get_file(
+                        meds_dir=shear['output_meds_dir'],
+                        medsconf=MEDSCONF,
+                        tilename=self.tilename,
+                        band=band)
+                    make_dirs_for_file(dest)
+                    shutil.copy(src, dest)
+
+    def _load_ccd_footprints(self, *, band):
+        """Load the CCD footprints written with the band info, making and
+        writing them if they are missing or out of date."""
+        fname = get_ccd_footprint_file(
+            meds_dir=self.output_meds_dir,
+            medsconf=MEDSCONF,
+            tilename=self.tilename,
+            band=band)
+        footprints = read_ccd_footprints(
+            filename=fname,
+            bounds_buffer_uv=self.bounds_buffer_uv,
+            n_se=len(self.info[band]['src_info']))
+
+        if footprints is None:
+            logger.info(" making CCD footprints for band %s", band)
+            footprints = make_ccd_footprints(
+                src_info=self.info[band]['src_info'],
+                bounds_buffer_uv=self.bounds_buffer_uv)
+            make_dirs_for_file(fname)
+            write_ccd_footprints(
+                filename=fname,
+                footprints=footprints,
+                bounds_buffer_uv=self.bounds_buffer_uv)
+
+        return footprints
 
     def _make_truth_catalog(self):
         """Make the truth catalog."""
@@ -239,13 +561,19 @@ class End2EndSimulation(object):
             truth_cat['size']    = np.sqrt(truth_cat['a_world']*truth_cat['b_world'])
             
 
-        truth_cat_path = get_truth_catalog_path(
-            meds_dir=self.output_meds_dir,
-            medsconf=MEDSCONF,
-            tilename=self.tilename)
+        meds_dirs = [self.output_meds_dir]
+        for shear in self.shears:
+            if shear['output_meds_dir'] not in meds_dirs:
+                meds_dirs.append(shear['output_meds_dir'])
+
+        for meds_dir in meds_dirs:
+            truth_cat_path = get_truth_catalog_path(
+                meds_dir=meds_dir,
+                medsconf=MEDSCONF,
+                tilename=self.tilename)
 
-        make_dirs_for_file(truth_cat_path)
-        fitsio.write(truth_cat_path, truth_cat, clobber=True)
+            make_dirs_for_file(truth_cat_path)
+            fitsio.write(truth_cat_path, truth_cat, clobber=True)
 
         return truth_cat
 
@@ -279,6 +607,13 @@ class End2EndSimulation(object):
             self.simulated_catalog.cat['b_d'] = self.simulated_catalog.cat['a_d']
             self.simulated_catalog.cat['a_b'] = self.simulated_catalog.cat['a_b']
             self.simulated_catalog.cat['b_b'] = self.simulated_catalog.cat['a_b']
+
+            # the galaxy parameters have to be remade after changing shapes
+            self.simulated_catalog = self.simulated_catalog._replace(
+                params=make_descwl_params(
+                    cat=self.simulated_catalog.cat,
+                    rand_rot=self.simulated_catalog.rand_rot,
+                    surveys=self.simulated_catalog.surveys))
             
             #temporarily induce ellipticity
 #             self.simulated_catalog.cat['a_d'] = self.simulated_catalog.cat['a_d']
@@ -296,12 +631,188 @@ class End2EndSimulation(object):
 
         return self.simulated_catalog
 
-def _render_se_image(
-        *, se_info, band, truth_cat, bounds_buffer_uv,
-        draw_method, noise_seed, output_meds_dir, src_func, gal_kws):
-    """Render an SE image.
+def _make_base_seeds(seed):
+    """Make the seeds for the RNGs of a simulation from its global seed."""
+    return np.random.RandomState(seed=seed).randint(
+        low=1, high=2**30, size=10)
+
 
-    This function renders a full image and writes it to disk.
+def add_noise_to_cached_images(
+        *, seed, noiseless_meds_dir, output_meds_dir, tilename, bands,
+        gal_kws):
+    """Make a new noise realization of a simulation from the noiseless SE
+    images cached by the galsim stage, without rendering any objects.
+
+    The galsim stage must have been run with `cache_noiseless: True` in
+    `gal_kws`. The noise seeds are derived from `seed` exactly as in
+    `End2EndSimulation`, so using the galsim seed reproduces its noise.
+
+    Parameters
+    ----------
+    seed : int
+        The seed for the global RNG.
+    noiseless_meds_dir : str
+        The output DEADATA/MEDS_DIR of the galsim stage with the cache.
+    output_meds_dir : str
+        The output DEADATA/MEDS_DIR for the noisy data products. The band
+        info files, CCD footprints and truth catalog are copied here if it
+        is not `noiseless_meds_dir`.
+    tilename : str
+        The DES coadd tile to simulate.
+    bands : str
+        The bands to simulate.
+    gal_kws : dict
+        Dictionary containing the keywords passed to the
+        the simulating code
+    """
+    logger.info(' adding noise to coadd tile %s', tilename)
+
+    noise_rng = np.random.RandomState(seed=_make_base_seeds(seed)[1])
+
+    if output_meds_dir != noiseless_meds_dir:
+        src = get_truth_catalog_path(
+            meds_dir=noiseless_meds_dir, medsconf=MEDSCONF, tilename=tilename)
+        dest = get_truth_catalog_path(
+            meds_dir=output_meds_dir, medsconf=MEDSCONF, tilename=tilename)
+        make_dirs_for_file(dest)
+        shutil.copy(src, dest)
+
+    for band in bands:
+        fname = get_band_info_file(
+            meds_dir=noiseless_meds_dir,
+            medsconf=MEDSCONF,
+            tilename=tilename,
+            band=band)
+        with open(fname, 'r') as fp:
+            info = yaml.load(fp, Loader=yaml.Loader)
+
+        if output_meds_dir != noiseless_meds_dir:
+            for get_file in [get_band_info_file, get_ccd_footprint_file]:
+                src = get_file(
+                    meds_dir=noiseless_meds_dir,
+                    medsconf=MEDSCONF,
+                    tilename=tilename,
+                    band=band)
+                if not os.path.exists(src):
+                    continue
+                dest = get_file(
+                    meds_dir=output_meds_dir,
+                    medsconf=MEDSCONF,
+                    tilename=tilename,
+                    band=band)
+                make_dirs_for_file(dest)
+                shutil.copy(src, dest)
+
+        noise_seeds = noise_rng.randint(
+            low=1, high=2**30, size=len(info['src_info']))
+
+        jobs = []
+        for noise_seed, se_info in zip(noise_seeds, info['src_info']):
+            jobs.append(joblib.delayed(_add_noise_to_cached_se_image)(
+                se_info=se_info,
+                noise_seed=noise_seed,
+                noiseless_meds_dir=noiseless_meds_dir,
+                output_meds_dir=output_meds_dir,
+                gal_kws=gal_kws))
+
+        logger.info(" adding noise to images in band %s", band)
+        with joblib.Parallel(
+                n_jobs=-1, backend='loky', verbose=50, max_nbytes=None) as p:
+            p(jobs)
+
+
+def _add_noise_to_cached_se_image(
+        *, se_info, noise_seed, noiseless_meds_dir, output_meds_dir, gal_kws):
+    im = np.load(_get_noiseless_image_path(
+        se_info=se_info, output_meds_dir=noiseless_meds_dir))
+    im = im.astype(np.float64)
+
+    im, wgt, bkg, bmask = _add_noise_mask_background(
+        image=im,
+        se_info=se_info,
+        noise_seed=noise_seed,
+        gal_kws=gal_kws)
+
+    _write_se_img_wgt_bkg(
+        image=im,
+        weight=wgt,
+        background=bkg,
+        bmask=bmask,
+        se_info=se_info,
+        output_meds_dir=output_meds_dir)
+
+
+def _get_noiseless_image_path(*, se_info, output_meds_dir):
+    """Get the path of the cached noiseless image for an SE image. It sits
+    next to where the simulated SE image is written."""
+    image_file = se_info['image_path'].replace(TMP_DIR, output_meds_dir)
+    for ext in ['.fits.fz', '.fits']:
+        if image_file.endswith(ext):
+            image_file = image_file[:-len(ext)]
+            break
+    return image_file + '_noiseless.npy'
+
+
+def _write_noiseless_image(*, image, se_info, output_meds_dir):
+    """Write a noiseless SE image as float32 to the cache."""
+    fname = _get_noiseless_image_path(
+        se_info=se_info, output_meds_dir=output_meds_dir)
+    make_dirs_for_file(fname)
+
+    # write to a temporary file first so that readers never see a
+    # partial file
+    tmp_fname = fname[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_fname, image.astype(np.float32))
+    os.replace(tmp_fname, fname)
+
+
+def _make_render_units(*, n_objs, n_workers, chunks_per_worker=4,
+                       min_chunk_size=25):
+    """Split the objects of a set of SE images into chunks for rendering.
+
+    The chunk size is set so that there are about `chunks_per_worker`
+    chunks per worker over all images. Bigger images are split into more
+    chunks. The chunks are ordered by the number of objects in their image,
+    largest first, with the chunks of an image next to each other, so that
+    the longest work starts first and only a few images are partially
+    rendered at any time.
+
+    Parameters
+    ----------
+    n_objs : list of ints
+        The number of objects to render for each SE image.
+    n_workers : int
+        The number of workers.
+    chunks_per_worker : int, optional
+        The target number of chunks per worker. Default is 4.
+    min_chunk_size : int, optional
+        The smallest chunk to make. Default is 25.
+
+    Returns
+    -------
+    units : list of 2-tuples
+        A list of (index of the SE image, slice of its objects).
+    """
+    n_tot = sum(n_objs)
+    chunk_size = max(
+        min_chunk_size,
+        int(np.ceil(n_tot / max(n_workers * chunks_per_worker, 1))))
+
+    units = []
+    for task_ind in np.argsort(n_objs, kind='stable')[::-1]:
+        n_obj = n_objs[task_ind]
+        n_chunks = max(1, int(np.ceil(n_obj / chunk_size)))
+        edges = np.linspace(0, n_obj, n_chunks + 1).astype(int)
+        for start, end in zip(edges[:-1], edges[1:]):
+            units.append((int(task_ind), slice(start, end)))
+
+    return units
+
+
+def _render_se_chunk(
+        *, se_info, band, msk_inds, draw_method, shears, payload, psf_kws,
+        gal_kws, wcs_kws=None):
+    """Render a chunk of the objects of an SE image.
 
     Parameters
     ----------
@@ -309,65 +820,336 @@ def _render_se_image(
         The entry from the `src_info` list for the coadd tile.
     band : str
         The band as a string.
-    truth_cat : np.ndarray
-        A structured array with the truth catalog. Must at least have the
-        columns 'ra' and 'dec' in degrees.
-    bounds_buffer_uv : float
-        The buffer in arcseconds for finding sources in the image. Any source
-        whose center lies outside of this buffer area around the CCD will not
-        be rendered for that CCD.
+    msk_inds : np.ndarray
+        The indices of the objects in the truth catalog to render.
     draw_method : str
         The method used to draw the image. See the docs of `GSObject.drawImage`
         for details and options. Usually 'auto' is correct unless using a
         PSF with the pixel in which case 'no_pixel' is the right choice.
-    noise_seed : int
-        The RNG seed to use to generate the noise field for the image.
-    output_meds_dir : str
-        The output DEADATA/MEDS_DIR for the simulation data products.
-    src_func : callable
-        A function with signature `src_func(src_ind)` that
-        returns the galsim object to be rendered and image position
-        for a given index of the truth catalog.
+    shears : list of dicts
+        The shears to render. Each entry has the keys 'g1', 'g2' and
+        'output_meds_dir', the output DEADATA/MEDS_DIR for the simulation
+        data products with that shear.
+    payload : dict
+        The descriptor of the memory-mapped catalogs from
+        `End2EndSimulation._write_shared_payload`.
+    psf_kws : dict
+        The keyword arguments used to build the PSF for the image.
     gal_kws : dict
         Dictionary containing the keywords passed to the
         the simulating code
+    wcs_kws : dict, optional
+        The WCS surrogate options. See `End2EndSimulation`.
+
+    Returns
+    -------
+    stamps : list of lists of 3-tuples
+        The stamps of the objects, one list per shear. See
+        `galsiming.render_stamps_for_image`.
     """
 
-    # step 1 - get the set of good objects for the CCD
-    msk_inds = _cut_tuth_cat_to_se_image(
-        truth_cat=truth_cat,
+    # build the source catalog for the image in this process
+    src_func = _make_lazy_source_cat(
         se_info=se_info,
-        bounds_buffer_uv=bounds_buffer_uv)
+        payload=payload,
+        psf_kws=psf_kws,
+        gal_kws=gal_kws,
+        draw_method=draw_method,
+        shears=shears,
+        wcs_kws=wcs_kws)
 
-    # step 2 - render the objects
-    im = _render_all_objects(
+    # render the objects, one image per shear
+    stamps = _render_all_objects(
         msk_inds=msk_inds,
-        truth_cat=truth_cat,
         se_info=se_info,
         band=band,
         src_func=src_func,
-        draw_method=draw_method)
+        draw_method=draw_method,
+        n_variants=len(shears),
+        engine=gal_kws.get('render_engine', 'stamp'),
+        use_templates=_use_stamp_templates(gal_kws))
+    logger.debug(
+        " stamp size cache for %s: %s",
+        se_info['image_path'], get_stamp_size_cache_stats())
+    if psf_kws['type'] in ['gauss-pix', 'nongauss-pix']:
+        flush_pixel_psf_cache()
+        logger.debug(
+            " pixel PSF cache for %s: %s",
+            se_info['image_path'], get_pixel_psf_cache_stats())
+    if _use_stamp_templates(gal_kws):
+        logger.debug(
+            " stamp template cache for %s: %s",
+            se_info['image_path'], get_stamp_template_cache_stats())
+    return stamps
+
+
+def _use_stamp_templates(gal_kws):
+    # the templates are keyed on the profile, so they are only reused when
+    # the objects share one
+    return (
+        gal_kws.get('stamp_templates', False) and
+        gal_kws['gal_source'] == 'simple')
+
+
+def _finish_se_image(*, ims, se_info, noise_seed, shears, gal_kws):
+    """Add the noise, background and mask to the rendered images of an SE
+    image and write them to disk.
 
-    # step 3 - add bkg and noise
-    # also removes the zero point
-    im, wgt, bkg, bmask = _add_noise_mask_background(
-        image=im,
+    Parameters
+    ----------
+    ims : list of np.ndarray
+        The noiseless image of the objects, one per shear.
+    se_info : dict
+        The entry from the `src_info` list for the coadd tile.
+    noise_seed : int
+        The RNG seed to use to generate the noise field for the image.
+    shears : list of dicts
+        The shears that were rendered. Each entry has the keys 'g1', 'g2'
+        and 'output_meds_dir', the output DEADATA/MEDS_DIR for the
+        simulation data products with that shear.
+    gal_kws : dict
+        Dictionary containing the keywords passed to the
+        the simulating code
+    """
+
+    # step 1 - optionally keep the noiseless images so that more noise
+    # realizations can be made without rendering again
+    if gal_kws.get('cache_noiseless', False):
+        for im, shear in zip(ims, shears):
+            _write_noiseless_image(
+                image=im,
+                se_info=se_info,
+                output_meds_dir=shear['output_meds_dir'])
+
+    # step 2 - read the bkg, weight and mask and make the noise once
+    noise_mask_background = _make_noise_mask_background(
+        image_shape=ims[0].shape,
         se_info=se_info,
         noise_seed=noise_seed,
-        gal_kws = gal_kws)
+        gal_kws=gal_kws)
+
+    for im, shear in zip(ims, shears):
+        # step 3 - add bkg and noise
+        # also removes the zero point
+        im, wgt, bkg, bmask = _apply_noise_mask_background(
+            image=im,
+            se_info=se_info,
+            noise_mask_background=noise_mask_background)
+
+        # step 4 - write to disk
+        _write_se_img_wgt_bkg(
+            image=im,
+            weight=wgt,
+            background=bkg,
+            bmask=bmask,
+            se_info=se_info,
+            output_meds_dir=shear['output_meds_dir'])
+
+
+def _make_psf_wrapper(*, psf_kws, se_info, draw_method):
+    """Build the PSF wrapper for an SE image.
+
+    This is cheap to call in a worker since it only needs the small
+    descriptor of the PSF (the paths in `se_info` and the `psf_kws`).
+    """
+    wcs = get_galsim_wcs(image_path=se_info['image_path'], image_ext=se_info['image_ext'])
 
-    # step 4 - write to disk
-    _write_se_img_wgt_bkg(
-        image=im,
-        weight=wgt,
-        background=bkg,
-        bmask=bmask,
-        se_info=se_info,
-        output_meds_dir=output_meds_dir)
+    if psf_kws['type'] == 'gauss':
+        psf_model = galsim.Gaussian(fwhm=0.9)
+    
+    #elif psf_kws['type'] == 'piff':
+    #    from ..des_piff import DES_Piff
+    #    psf_model = DES_Piff(expand_path(se_info['piff_path']))
+    #    assert draw_method == 'auto'
+    
+    elif psf_kws['type'] == 'gauss-pix':
+        from gauss_pix_psf import GaussPixPSF
+        kwargs = {k: psf_kws[k] for k in psf_kws if k != 'type'}
+        psf_model = GaussPixPSF(cache_id=se_info['image_path'], **kwargs)
+        assert draw_method == 'auto'
+    
+    elif psf_kws['type'] == 'nongauss-pix':
+        from nongauss_pix_psf import NonGaussPixPSF
+        kwargs = {k: psf_kws[k] for k in psf_kws if k != 'type'}
+        psf_model = NonGaussPixPSF(cache_id=se_info['image_path'], **kwargs)
+        assert draw_method == 'auto'
+
+    elif psf_kws['type'] == 'psfex':
+        from psfex_batching import DES_PSFExBatch
+        psf_model = DES_PSFExBatch(expand_path(se_info['psfex_path']), wcs = wcs) #Need to pass wcs when reading file
+        assert draw_method == 'no_pixel'
+    
+    elif psf_kws['type'] == 'des_psfex':
+        from des_psfex import DES_PSFEx_Deconv
+        psf_model = DES_PSFEx_Deconv(
+            expand_path(se_info['psfex_path']), wcs = wcs,
+            fit_cache_dir=psf_kws.get('fit_cache_dir', None),
+            fit_n_jobs=psf_kws.get('fit_n_jobs', 1),
+            psf_quantum=psf_kws.get('psf_quantum', None)) #Need to pass wcs when reading file
+        assert draw_method == 'auto' #Don't need no_pixel since psf already deconvolved
+        
+    elif psf_kws['type'] == 'psfex_deconvolved':
+        from psfex_deconvolved import PSFEx_Deconv
+        psf_model = PSFEx_Deconv(expand_path(se_info['psfex_path']), wcs = wcs) #Need to pass wcs when reading file
+        assert draw_method == 'auto' #Don't need no_pixel since psf already deconvolved
+    
+    else:
+        raise ValueError(
+            "psf type '%s' not recognized!" % psf_kws['type'])
+
+    psf_wrap = PSFWrapper(psf_model, wcs)
+
+    return psf_wrap
+
+
+def _get_psf_wrapper(*, psf_kws, se_info, draw_method):
+    """Get the PSF wrapper for an SE image, reusing the one from an earlier
+    chunk of the same SE image in this process if there is one."""
+    # the psf_kws can hold lists and dicts from the YAML config, so they are
+    # keyed by their repr
+    key = (
+        repr(sorted(psf_kws.items())),
+        se_info['image_path'],
+        se_info['image_ext'],
+        se_info.get('psfex_path'),
+        draw_method)
+    psf_wrap = _PSF_WRAPPERS.get(key, None)
+    if psf_wrap is None:
+        psf_wrap = _make_psf_wrapper(
+            psf_kws=psf_kws, se_info=se_info, draw_method=draw_method)
+        _PSF_WRAPPERS[key] = psf_wrap
+        if len(_PSF_WRAPPERS) > 8:
+            _PSF_WRAPPERS.popitem(last=False)
+    else:
+        _PSF_WRAPPERS.move_to_end(key)
+    return psf_wrap
 
 
-def _cut_tuth_cat_to_se_image(*, truth_cat, se_info, bounds_buffer_uv):
-    """get the inds of the objects to render from the truth catalog"""
+# the PSF wrappers of the last few SE images rendered by this process
+_PSF_WRAPPERS = collections.OrderedDict()
+
+
+def _prefill_psfex_fit_cache(*, se_info, psf_kws, draw_method):
+    """Fit the smooth PSF model of an SE image and write it to the fit
+    cache if it is not there yet."""
+    # this runs in a worker already, so the fit does not get its own pool
+    psf_wrap = _make_psf_wrapper(
+        psf_kws=dict(psf_kws, fit_n_jobs=1), se_info=se_info,
+        draw_method=draw_method)
+    cache_path = psf_wrap.psf.get_fit_cache_path()
+    if cache_path is None or not os.path.exists(cache_path):
+        psf_wrap.psf._fit_smooth_model()
+
+
+def _attach_payload(payload):
+    """Attach read-only to the memory-mapped catalogs of a payload
+    descriptor, returning the truth catalog, the simulated catalog and the
+    galaxy profile cache (None if there is none)."""
+    return _attach_shared_payload(
+        payload['truth_cat_path'],
+        payload['sim_cat_path'],
+        payload['sim_rot_path'],
+        payload['survey_bands'],
+        payload['ngal_per_arcmin2'],
+        payload['gal_profiles_path'],
+        payload['gal_offsets_path'])
+
+
+@functools.lru_cache(maxsize=8)
+def _attach_shared_payload(
+        truth_cat_path, sim_cat_path, sim_rot_path, survey_bands,
+        ngal_per_arcmin2, gal_profiles_path, gal_offsets_path):
+    """Attach read-only to the memory-mapped catalogs. This is cached so that
+    each worker process only attaches once."""
+    truth_cat = np.load(truth_cat_path, mmap_mode='r')
+
+    if gal_profiles_path is None:
+        galaxy_cache = None
+    else:
+        galaxy_cache = GalaxyProfileCache(
+            profiles_path=gal_profiles_path,
+            offsets_path=gal_offsets_path)
+
+    if sim_cat_path is None:
+        simulated_catalog = None
+    elif survey_bands is not None:
+        simulated_catalog = make_descwl_data(
+            survey_bands=survey_bands,
+            cat=np.load(sim_cat_path, mmap_mode='r'),
+            rand_rot=(
+                np.load(sim_rot_path, mmap_mode='r')
+                if sim_rot_path is not None
+                else None),
+            ngal_per_arcmin2=ngal_per_arcmin2)
+    else:
+        simulated_catalog = np.load(sim_cat_path, mmap_mode='r')
+
+    return truth_cat, simulated_catalog, galaxy_cache
+
+
+def _make_pickled_galaxies(*, inds, payload, gal_kws):
+    """Build and pickle the pre-PSF galaxy profiles of the objects at
+    `inds` in the truth catalog. See `End2EndSimulation._write_galaxy_cache`.
+    """
+    truth_cat, simulated_catalog, _ = _attach_payload(payload)
+    return [
+        pickle.dumps(
+            _make_galaxy(
+                ind=ind,
+                truth_cat=truth_cat,
+                gal_source=gal_kws['gal_source'],
+                gal_mag=gal_kws['gal_mag'],
+                simulated_catalog=simulated_catalog),
+            protocol=pickle.HIGHEST_PROTOCOL)
+        for ind in inds]
+
+
+def _make_lazy_source_cat(
+        *, se_info, payload, psf_kws, gal_kws, draw_method, shears,
+        wcs_kws=None):
+    """Build the `LazySourceCat` for an SE image from the shared payload."""
+    truth_cat, simulated_catalog, galaxy_cache = _attach_payload(payload)
+
+    return LazySourceCat(
+        truth_cat=truth_cat,
+        wcs=_get_se_wcs(se_info=se_info, wcs_kws=wcs_kws),
+        psf=_get_psf_wrapper(
+            psf_kws=psf_kws, se_info=se_info, draw_method=draw_method),
+        shears=[(shear['g1'], shear['g2']) for shear in shears],
+        gal_mag=gal_kws['gal_mag'],
+        gal_source=gal_kws['gal_source'],
+        simulated_catalog=simulated_catalog,
+        galaxy_cache=galaxy_cache)
+
+
+def _get_se_wcs(*, se_info, wcs_kws=None):
+    """Get the galsim WCS of an SE image, or its piecewise-affine surrogate
+    if `wcs_kws` asks for one."""
+    if wcs_kws is not None and wcs_kws.get('surrogate', False):
+        return get_wcs_surrogate(
+            image_path=se_info['image_path'],
+            image_ext=se_info['image_ext'],
+            image_shape=tuple(se_info['image_shape']),
+            max_pos_err=wcs_kws.get('max_pos_err', 1e-3),
+            max_jac_err=wcs_kws.get('max_jac_err', 1e-5))
+    else:
+        return get_galsim_wcs(
+            image_path=se_info['image_path'],
+            image_ext=se_info['image_ext'])
+
+
+def _cut_tuth_cat_to_se_image(
+        *, truth_cat, se_info, bounds_buffer_uv, sky_index=None,
+        footprint=None):
+    """get the inds of the objects to render from the truth catalog
+
+    If a `sky_index` of the truth catalog and the `footprint` of the CCD are
+    given, only the candidate objects from the index are checked. Otherwise
+    the whole truth catalog is checked against the rough sky bounds.
+    """
+    if sky_index is not None and footprint is not None:
+        return sky_index.query_footprint(footprint)
+
     wcs = get_esutil_wcs(
         image_path=se_info['image_path'],
         image_ext=se_info['image_ext'])
@@ -384,39 +1166,54 @@ def _cut_tuth_cat_to_se_image(*, truth_cat, se_info, bounds_buffer_uv):
 
 
 def _render_all_objects(
-        *, msk_inds, truth_cat, se_info, band, src_func, draw_method):
+        *, msk_inds, se_info, band, src_func, draw_method, n_variants=None,
+        engine='stamp', use_templates=False):
     gs_wcs = get_galsim_wcs(
         image_path=se_info['image_path'],
         image_ext=se_info['image_ext'])
 
-    im = render_sources_for_image(
+    # only the stamps are returned so that they are cheap to send back
+    # from the workers
+    return render_stamps_for_image(
         image_shape=se_info['image_shape'],
         wcs=gs_wcs,
         draw_method=draw_method,
         src_inds=msk_inds,
         src_func=src_func,
-        n_jobs=1)
-
-    return im.array
+        n_variants=n_variants,
+        engine=engine,
+        use_templates=use_templates)
 
 
 def _add_noise_mask_background(*, image, se_info, noise_seed, gal_kws):
     """add noise, mask and background to an image, remove the zero point"""
+    noise_mask_background = _make_noise_mask_background(
+        image_shape=image.shape,
+        se_info=se_info,
+        noise_seed=noise_seed,
+        gal_kws=gal_kws)
+    return _apply_noise_mask_background(
+        image=image,
+        se_info=se_info,
+        noise_mask_background=noise_mask_background)
 
-    noise_rng = np.random.RandomState(seed=noise_seed)
 
-    # first back to ADU units
-    image /= se_info['scale']
+def _make_noise_mask_background(*, image_shape, se_info, noise_seed, gal_kws):
+    """read the background, weight and mask of an SE image and draw its
+    noise field
+
+    The outputs can be applied to any number of renderings of the same SE
+    image with `_apply_noise_mask_background`.
+    """
+
+    noise_rng = np.random.RandomState(seed=noise_seed)
 
-    # add the background
     bkg = fitsio.read(se_info['bkg_path'], ext=se_info['bkg_ext'])
-    image += bkg
 
-    # now add noise
     wgt = fitsio.read(se_info['weight_path'], ext=se_info['weight_ext'])
     bmask = fitsio.read(se_info['bmask_path'], ext=se_info['bmask_ext'])
     img_std = 1.0 / np.sqrt(np.median(wgt[bmask == 0]))
-    image += (noise_rng.normal(size=image.shape) * img_std)
+    noise = noise_rng.normal(size=image_shape) * img_std
     wgt[:, :] = 1.0 / img_std**2
     
     
@@ -431,11 +1228,28 @@ def _add_noise_mask_background(*, image, se_info, noise_seed, gal_kws):
         bmask = np.zeros_like(bmask)
         
     else:
-        raise ValueError("Unknown value %s for keyword {Mask}. Choose True or False"%str(self.gal_kws['Mask']))
+        raise ValueError("Unknown value %s for keyword {Mask}. Choose True or False"%str(gal_kws['Mask']))
     
 #     bmask = np.zeros_like(bmask)
         
 
+    return noise, wgt, bkg, bmask
+
+
+def _apply_noise_mask_background(*, image, se_info, noise_mask_background):
+    """add the noise and background from `_make_noise_mask_background` to an
+    image, remove the zero point"""
+    noise, wgt, bkg, bmask = noise_mask_background
+
+    # first back to ADU units
+    image /= se_info['scale']
+
+    # add the background
+    image += bkg
+
+    # now add noise
+    image += noise
+
     return image, wgt, bkg, bmask
 
 
@@ -490,23 +1304,41 @@ class LazySourceCat(object):
         A galsim WCS instance for the image to be rendered.
     psf : PSFWrapper
         A PSF wrapper object to use for the PSF.
-    g1 : float
-        The shear to apply on the 1-axis.
-    g2 : float
-        The shear to apply on the 2-axis.
+    g1 : float, optional
+        The shear to apply on the 1-axis. Required if `shears` is None.
+    g2 : float, optional
+        The shear to apply on the 2-axis. Required if `shears` is None.
+    shears : list of 2-tuples, optional
+        A list of (g1, g2) shears. If given, `__call__` returns a list with
+        the object sheared by each of them, all convolved with the same PSF.
+    galaxy_cache : GalaxyProfileCache, optional
+        A cache of the pre-PSF galaxy profiles of the tile. Objects that are
+        not in it are built on the fly.
 
     Methods
     -------
     __call__(ind)
         Returns the object to be rendered from the truth catalog at
         index `ind`.
+    prepare(inds)
+        Computes the image positions, local WCS and PSFs of the objects at
+        `inds` at once and keeps them for later calls.
+    get_position(ind)
+        Returns the image position of the object at index `ind`.
+    constant_profiles()
+        Returns the profiles to render if they are the same for every
+        object, otherwise None.
+    stamp_size_key(ind)
+        Returns a key identifying the profile of the object at index `ind`
+        up to its position, or None if it cannot be cached.
     """
-    def __init__(self, *, truth_cat, wcs, psf, g1, g2, gal_mag, gal_source, galsource_rng = None, simulated_catalog = None):
+    def __init__(self, *, truth_cat, wcs, psf, gal_mag, gal_source, g1=None, g2=None, shears=None, galsource_rng = None, simulated_catalog = None, galaxy_cache=None):
         self.truth_cat = truth_cat
         self.wcs = wcs
         self.psf = psf
         self.g1 = g1
         self.g2 = g2
+        self.shears = shears
         
         self.gal_source = gal_source
         self.galsource_rng = galsource_rng
@@ -514,48 +1346,230 @@ class LazySourceCat(object):
         self.simulated_catalog = simulated_catalog
         
         self.gal_mag = gal_mag
-        
-            
+        self.galaxy_cache = galaxy_cache
+        self._prepared = {}
+
+        # only a constant PSF gives stamp sizes independent of position
+        if isinstance(self.psf.psf, galsim.GSObject):
+            self._psf_key = (
+                repr(self.psf.psf),
+                (g1, g2) if shears is None else tuple(map(tuple, shears)))
+        else:
+            self._psf_key = None
 
-    def __call__(self, ind):
-        pos = self.wcs.toImage(galsim.CelestialCoord(
+    def stamp_size_key(self, ind):
+        """Get a key for the stamp size cache of `galsiming`.
+
+        Parameters
+        ----------
+        ind : int
+            The index of the object in the truth catalog.
+
+        Returns
+        -------
+        key : tuple or None
+            A key that identifies the profile of the object and the PSF up to
+            the position of the object. None if the PSF varies over the image.
+        """
+        if self._psf_key is None:
+            return None
+
+        if self.gal_source == 'simple':
+            gal_key = ('simple',)
+        elif self.gal_source == 'descwl':
+            gal_key = ('descwl', int(self.truth_cat['ind'][ind]))
+        else:
+            sim_ind = self.truth_cat['ind'][ind]
+            gal_key = (self.gal_source,)
+            if self.gal_source in ['varsize', 'varsizeang']:
+                gal_key += (float(self.simulated_catalog['size'][sim_ind]),)
+            if self.gal_source in ['varang', 'varsizeang']:
+                gal_key += (
+                    float(self.simulated_catalog['q'][sim_ind]),
+                    float(self.simulated_catalog['ang_rot'][sim_ind]))
+
+        return self._psf_key + gal_key
+
+    def prepare(self, inds):
+        """Compute the image positions, local WCS and PSFs of many objects
+        at once.
+
+        The results are kept so that later calls for these objects do not
+        do any WCS transforms or PSF model evaluations.
+
+        Parameters
+        ----------
+        inds : np.ndarray
+            The indices of the objects in the truth catalog.
+
+        Returns
+        -------
+        image_pos : list of galsim.PositionD
+            The positions of the objects in the image.
+        local_wcs : list of galsim.JacobianWCS
+            The local WCS at the position of each object.
+        """
+        inds = np.asarray(inds)
+        x, y, jac = get_image_positions_and_jacobians(
+            wcs=self.wcs,
+            ra=self.truth_cat['ra'][inds],
+            dec=self.truth_cat['dec'][inds])
+
+        image_pos = [galsim.PositionD(x=_x, y=_y) for _x, _y in zip(x, y)]
+        local_wcs = [galsim.JacobianWCS(*_jac) for _jac in jac]
+        psfs = self.psf.getPSFs(image_pos, local_wcs=local_wcs)
+        self._prepared = dict(zip(
+            inds.tolist(), zip(image_pos, local_wcs, psfs)))
+        return image_pos, local_wcs
+
+    def get_position(self, ind):
+        """Get the image position of the object at index `ind`."""
+        if ind in self._prepared:
+            return self._prepared[ind][0]
+
+        return self.wcs.toImage(galsim.CelestialCoord(
             ra=self.truth_cat['ra'][ind] * galsim.degrees,
             dec=self.truth_cat['dec'][ind] * galsim.degrees))
+
+    def constant_profiles(self):
+        """Get the profiles to render if they are the same for every object.
+
+        Returns
+        -------
+        profiles : galsim.GSObject, list of galsim.GSObject or None
+            The sheared galaxy convolved with the PSF, or a list of them
+            with one per shear if `shears` was given. None if the objects
+            have different profiles or the PSF varies over the image.
+        """
+        if self.gal_source != 'simple' or self._psf_key is None:
+            return None
+
+        obj = _make_galaxy(
+            ind=None,
+            truth_cat=None,
+            gal_source=self.gal_source,
+            gal_mag=self.gal_mag,
+            simulated_catalog=None)
+
+        if self.shears is None:
+            return galsim.Convolve(
+                [obj.shear(g1=self.g1, g2=self.g2), self.psf.psf])
+        else:
+            return [
+                galsim.Convolve([obj.shear(g1=g1, g2=g2), self.psf.psf])
+                for g1, g2 in self.shears
+            ]
+
+    def __call__(self, ind):
+        if ind in self._prepared:
+            pos, local_wcs, psf = self._prepared[ind]
+        else:
+            pos = self.get_position(ind)
+            psf = self.psf.getPSF(image_pos=pos)
+
+        obj = None
+        if self.galaxy_cache is not None:
+            obj = self.galaxy_cache.get(ind)
+        if obj is None:
+            obj = _make_galaxy(
+                ind=ind,
+                truth_cat=self.truth_cat,
+                gal_source=self.gal_source,
+                gal_mag=self.gal_mag,
+                simulated_catalog=self.simulated_catalog,
+                galsource_rng=self.galsource_rng)
+
+        if self.shears is None:
+            obj = obj.shear(g1=self.g1, g2=self.g2)
+            return galsim.Convolve([obj, psf]), pos
+        else:
+            return [
+                galsim.Convolve([obj.shear(g1=g1, g2=g2), psf])
+                for g1, g2 in self.shears
+            ], pos
+
+
+class GalaxyProfileCache(object):
+    """A read-only cache of the pre-PSF galaxy profiles of a tile.
+
+    The profiles are stored pickled in a single memory-mapped byte array,
+    in order of truth catalog index, with an array of offsets into it so
+    that all of the workers can share them.
+
+    Parameters
+    ----------
+    profiles_path : str
+        The path to the `.npy` file with the pickled profiles as uint8.
+    offsets_path : str
+        The path to the `.npy` file with the offsets of the profiles. The
+        profile of the object at index `ind` in the truth catalog is in
+        `[offsets[ind], offsets[ind+1])`.
+
+    Methods
+    -------
+    get(ind)
+        Get the profile at index `ind` or None if it is not in the cache.
+    """
+    def __init__(self, *, profiles_path, offsets_path):
+        self.profiles = np.load(profiles_path, mmap_mode='r')
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+
+    def get(self, ind):
+        """Get the profile of an object.
+
+        Parameters
+        ----------
+        ind : int
+            The index of the object in the truth catalog.
+
+        Returns
+        -------
+        obj : galsim.GSObject or None
+            The pre-PSF and pre-shear galaxy profile or None if the object
+            is not in the cache.
+        """
+        start = self.offsets[ind]
+        end = self.offsets[ind + 1]
+        if end == start:
+            return None
+        return pickle.loads(self.profiles[start:end].tobytes())
+
+
+def _make_galaxy(
+        *, ind, truth_cat, gal_source, gal_mag, simulated_catalog,
+        galsource_rng=None):
+    """Make the pre-PSF and pre-shear galaxy profile of the object at index
+    `ind` in the truth catalog."""
+    if gal_source == 'simple':
+        obj = galsim.Exponential(half_light_radius=0.5)
         
+    elif gal_source == 'varsize':
+        rad = simulated_catalog['size'][truth_cat['ind'][ind]] #Get radius from catalog (in arcmin)
         
-        if self.gal_source == 'simple':
-            obj = galsim.Exponential(half_light_radius=0.5)
-            
-        elif self.gal_source == 'varsize':
-            rad = self.simulated_catalog['size'][self.truth_cat['ind'][ind]] #Get radius from catalog (in arcmin)
-            
-            obj = galsim.Exponential(half_light_radius=rad)
-            
-        elif self.gal_source == 'varang':
-            q   = self.simulated_catalog['q'][self.truth_cat['ind'][ind]] #Get ellipticity
-            rot = self.simulated_catalog['ang_rot'][self.truth_cat['ind'][ind]] #Get rotation of galaxy
-            
-            obj = galsim.Exponential(half_light_radius=0.5).shear(q = q, beta = rot * galsim.degrees)
-            
-        elif self.gal_source == 'varsizeang':
-            rad = self.simulated_catalog['size'][self.truth_cat['ind'][ind]] #Get radius from catalog (in arcmin)
-            q   = self.simulated_catalog['q'][self.truth_cat['ind'][ind]] #Get ellipticity
-            rot = self.simulated_catalog['ang_rot'][self.truth_cat['ind'][ind]] #Get rotation of galaxy
-            
-            #Take exponential profile, shear it to cause intrinsic ellipticity in direction given by rot
-            obj = galsim.Exponential(half_light_radius=rad).shear(q = q, beta = rot * galsim.degrees)
-            
-        elif self.gal_source == 'descwl':
-            
-            obj = get_descwl_galaxy(descwl_ind = self.truth_cat['ind'][ind],
-                                    rng  = self.galsource_rng, 
-                                    data = self.simulated_catalog)
-            
-        if self.gal_mag is not None:
-            normalized_flux = 10**((30 - self.gal_mag)/2.5)
-            obj = obj.withFlux(normalized_flux)
+        obj = galsim.Exponential(half_light_radius=rad)
+        
+    elif gal_source == 'varang':
+        q   = simulated_catalog['q'][truth_cat['ind'][ind]] #Get ellipticity
+        rot = simulated_catalog['ang_rot'][truth_cat['ind'][ind]] #Get rotation of galaxy
+        
+        obj = galsim.Exponential(half_light_radius=0.5).shear(q = q, beta = rot * galsim.degrees)
+        
+    elif gal_source == 'varsizeang':
+        rad = simulated_catalog['size'][truth_cat['ind'][ind]] #Get radius from catalog (in arcmin)
+        q   = simulated_catalog['q'][truth_cat['ind'][ind]] #Get ellipticity
+        rot = simulated_catalog['ang_rot'][truth_cat['ind'][ind]] #Get rotation of galaxy
         
-        obj = obj.shear(g1=self.g1, g2=self.g2)
-        psf = self.psf.getPSF(image_pos=pos)
+        #Take exponential profile, shear it to cause intrinsic ellipticity in direction given by rot
+        obj = galsim.Exponential(half_light_radius=rad).shear(q = q, beta = rot * galsim.degrees)
         
-        return galsim.Convolve([obj, psf]), pos
\ No newline at end of file
+    elif gal_source == 'descwl':
+        
+        obj = get_descwl_galaxy(descwl_ind = truth_cat['ind'][ind],
+                                rng  = galsource_rng, 
+                                data = simulated_catalog)
+        
+    if gal_mag is not None:
+        normalized_flux = 10**((30 - gal_mag)/2.5)
+        obj = obj.withFlux(normalized_flux)
+
+    return obj
@@ -1,6 +1,10 @@
 import numpy as np
+from scipy.spatial import cKDTree
 from meds.bounds import Bounds
 from meds.util import radec_to_uv
+import fitsio
+
+from wcsing import get_esutil_wcs
 
 
 def get_rough_sky_bounds(
@@ -49,6 +53,23 @@ def get_rough_sky_bounds(
     >>> in_sky_bnds = sky_bnds.contains_points(u, v)  # returs a bool mask
     >>> q = np.where(in_sky_bnds)
     """
+    umin, umax, vmin, vmax, ra_ccd, dec_ccd = _get_rough_sky_extent(
+        im_shape=im_shape,
+        wcs=wcs,
+        position_offset=position_offset,
+        bounds_buffer_uv=bounds_buffer_uv,
+        n_grid=n_grid,
+        celestial=celestial)
+    sky_bnds = Bounds(umin, umax, vmin, vmax)
+
+    return sky_bnds, ra_ccd, dec_ccd
+
+
+def _get_rough_sky_extent(
+        *, im_shape, wcs, position_offset, bounds_buffer_uv, n_grid,
+        celestial):
+    """Get the (u, v) extent of the rough sky bounds of a CCD along with the
+    CCD center. See `get_rough_sky_bounds` for the parameters."""
     nrow, ncol = im_shape
 
     # set n_grid so that pixels are square-ish
@@ -97,9 +118,164 @@ def get_rough_sky_bounds(
         ubuff = bounds_buffer_uv
         vbuff = bounds_buffer_uv
 
-    sky_bnds = Bounds(u.min() - ubuff,
-                      u.max() + ubuff,
-                      v.min() - vbuff,
-                      v.max() + vbuff)
+    return (
+        u.min() - ubuff,
+        u.max() + ubuff,
+        v.min() - vbuff,
+        v.max() + vbuff,
+        ra_ccd,
+        dec_ccd)
 
-    return sky_bnds, ra_ccd, dec_ccd
+
+def make_ccd_footprints(*, src_info, bounds_buffer_uv, n_grid=4):
+    """Compute the rough sky footprint of every SE image in a coadd tile.
+
+    Parameters
+    ----------
+    src_info : list of dicts
+        The `src_info` list from the band info for the coadd tile.
+    bounds_buffer_uv : float
+        The buffer in arcseconds for the chip boundaries in (u, v) coordinates.
+    n_grid : int, optional
+        Number of grid points to use in the small direction to construct
+        the bounding box. Default is 4.
+
+    Returns
+    -------
+    footprints : np.ndarray
+        A structured array with one entry per SE image in the same order as
+        `src_info`. The columns 'u_min', 'u_max', 'v_min' and 'v_max' give the
+        bounding box in arcseconds in the (u, v) system centered on the CCD
+        at 'ra_ccd' and 'dec_ccd' (both in degrees).
+    """
+    footprints = np.zeros(len(src_info), dtype=[
+        ('u_min', 'f8'), ('u_max', 'f8'),
+        ('v_min', 'f8'), ('v_max', 'f8'),
+        ('ra_ccd', 'f8'), ('dec_ccd', 'f8')])
+    for i, se_info in enumerate(src_info):
+        wcs = get_esutil_wcs(
+            image_path=se_info['image_path'],
+            image_ext=se_info['image_ext'])
+        footprints[i] = _get_rough_sky_extent(
+            im_shape=se_info['image_shape'],
+            wcs=wcs,
+            position_offset=se_info['position_offset'],
+            bounds_buffer_uv=bounds_buffer_uv,
+            n_grid=n_grid,
+            celestial=True)
+    return footprints
+
+
+def write_ccd_footprints(*, filename, footprints, bounds_buffer_uv):
+    """Write a CCD footprint table to disk.
+
+    The buffer used to build the footprints is stored in the header so that
+    readers can tell if the table can be reused.
+    """
+    fitsio.write(
+        filename, footprints, clobber=True,
+        header={'BUFFUV': bounds_buffer_uv})
+
+
+def read_ccd_footprints(*, filename, bounds_buffer_uv, n_se):
+    """Read a CCD footprint table from disk.
+
+    Parameters
+    ----------
+    filename : str
+        The path to the footprint table.
+    bounds_buffer_uv : float
+        The buffer in arcseconds the footprints must have been made with.
+    n_se : int
+        The number of SE images the footprints must cover.
+
+    Returns
+    -------
+    footprints : np.ndarray or None
+        The footprint table, or None if it does not exist or was made with
+        different settings.
+    """
+    try:
+        footprints, hdr = fitsio.read(filename, header=True)
+    except (IOError, OSError):
+        return None
+
+    if (
+        not np.allclose(hdr.get('BUFFUV', np.nan), bounds_buffer_uv) or
+        len(footprints) != n_se
+    ):
+        return None
+
+    return footprints
+
+
+def _radec_to_xyz(ra, dec):
+    ra = np.deg2rad(ra)
+    dec = np.deg2rad(dec)
+    cosdec = np.cos(dec)
+    return np.stack(
+        [cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)], axis=-1)
+
+
+class SkyIndex(object):
+    """A spatial index of a catalog on the sky for finding the objects that
+    fall within the rough sky bounds of a CCD.
+
+    The index is a KD-tree over unit vectors. It is built once per catalog
+    and then queried with the footprints from `make_ccd_footprints`.
+
+    Parameters
+    ----------
+    ra : np.ndarray
+        The ra positions of the catalog in degrees.
+    dec : np.ndarray
+        The dec positions of the catalog in degrees.
+
+    Methods
+    -------
+    query_footprint(footprint)
+        Get the indices of the catalog entries inside a CCD footprint.
+    """
+    def __init__(self, *, ra, dec):
+        self.ra = np.asarray(ra)
+        self.dec = np.asarray(dec)
+        self._tree = cKDTree(_radec_to_xyz(self.ra, self.dec))
+
+    def query_footprint(self, footprint):
+        """Get the indices of the catalog entries inside a CCD footprint.
+
+        Parameters
+        ----------
+        footprint : np.void or dict
+            An entry of the table returned by `make_ccd_footprints`.
+
+        Returns
+        -------
+        inds : np.ndarray
+            The sorted indices of the objects inside the footprint.
+        """
+        # the cone around the CCD center that contains the whole footprint
+        # we pad the radius a bit so that the projection used for (u, v)
+        # never matters
+        us, vs = np.meshgrid(
+            [footprint['u_min'], footprint['u_max']],
+            [footprint['v_min'], footprint['v_max']])
+        rad = np.max(np.hypot(us, vs))
+        theta = np.deg2rad(rad / 3600.0) * 1.01
+        chord = 2.0 * np.sin(min(theta, np.pi) / 2.0)
+
+        cands = self._tree.query_ball_point(
+            _radec_to_xyz(footprint['ra_ccd'], footprint['dec_ccd']),
+            chord)
+        cands = np.sort(np.array(cands, dtype=np.int64))
+        if len(cands) == 0:
+            return cands
+
+        u, v = radec_to_uv(
+            self.ra[cands], self.dec[cands],
+            footprint['ra_ccd'], footprint['dec_ccd'])
+        sky_bnds = Bounds(
+            footprint['u_min'], footprint['u_max'],
+            footprint['v_min'], footprint['v_max'])
+        msk = sky_bnds.contains_points(u, v)
+        return cands[msk]
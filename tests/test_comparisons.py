@@ -0,0 +1,96 @@
+"""Run the comparison helpers of the fast code paths against their
+reference implementations and check the differences are within tolerance.
+
+The PSFEx and descwl checks need data that are not in the repo. They are
+skipped unless `DES_PSFEX_TEST_FILE` points to a PSFEx file and
+`$CATSIM_DIR/OneDegSq.fits` exists.
+"""
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+galsim = pytest.importorskip('galsim')
+
+
+def test_fft_matches_stamps():
+    pytest.importorskip('scipy')
+    pytest.importorskip('joblib')
+    from galsiming import compare_fft_to_stamps
+
+    rng = np.random.RandomState(seed=10)
+    profile = galsim.Convolve(
+        galsim.Exponential(half_light_radius=0.5).shear(g1=0.02, g2=0.0),
+        galsim.Gaussian(fwhm=0.9))
+    stats = compare_fft_to_stamps(
+        image_shape=(512, 512),
+        wcs=galsim.PixelScale(0.263),
+        draw_method='auto',
+        profile=profile,
+        x=rng.uniform(low=20, high=492, size=50),
+        y=rng.uniform(low=20, high=492, size=50))
+
+    assert stats['max_rel_diff'] < 5e-3, stats
+    assert abs(stats['flux_ratio'] - 1) < 1e-3, stats
+
+
+@pytest.mark.parametrize('psf_class_name', ['GaussPixPSF', 'NonGaussPixPSF'])
+def test_analytic_psf_matches_interpolated(psf_class_name):
+    import gauss_pix_psf
+    import nongauss_pix_psf
+    from gauss_pix_psf import compare_analytic_psf
+
+    if psf_class_name == 'GaussPixPSF':
+        psf_class = gauss_pix_psf.GaussPixPSF
+        psf_kws = {}
+    else:
+        psf_class = nongauss_pix_psf.NonGaussPixPSF
+        psf_kws = {'draw_with_wcs': False}
+
+    rng = np.random.RandomState(seed=11)
+    stats = compare_analytic_psf(
+        psf_class=psf_class,
+        psf_kws=psf_kws,
+        image_pos=[
+            galsim.PositionD(x=x, y=y)
+            for x, y in zip(
+                rng.uniform(low=1, high=2048, size=10),
+                rng.uniform(low=1, high=4096, size=10))],
+        wcs=galsim.PixelScale(0.263),
+        n_repeat=1)
+
+    assert stats['max_rel_diff'] < 5e-3, stats
+    assert stats['time_analytic'] < stats['time_interpolated'], stats
+
+
+def test_psfex_batch_matches_galsim():
+    fname = os.environ.get('DES_PSFEX_TEST_FILE', None)
+    if fname is None or not os.path.exists(fname):
+        pytest.skip('set DES_PSFEX_TEST_FILE to a PSFEx file to run')
+    from psfex_batching import compare_psfex_batch
+
+    rng = np.random.RandomState(seed=12)
+    stats = compare_psfex_batch(
+        file_name=fname,
+        wcs=galsim.PixelScale(0.263),
+        xs=rng.uniform(low=1, high=2048, size=20),
+        ys=rng.uniform(low=1, high=4096, size=20))
+
+    assert stats['max_abs_array_diff'] < 1e-6, stats
+    assert stats['max_rel_image_diff'] < 1e-5, stats
+
+
+def test_descwl_galaxy_parity():
+    pytest.importorskip('descwl')
+    pytest.importorskip('fitsio')
+    if not os.path.exists(os.path.join(
+            os.environ.get('CATSIM_DIR', '.'), 'OneDegSq.fits')):
+        pytest.skip('needs $CATSIM_DIR/OneDegSq.fits')
+    from realistic_galaxying import (
+        init_descwl_catalog, check_descwl_galaxy_parity)
+
+    data = init_descwl_catalog(survey_bands='des-riz', rng=None)
+    max_rel_diff = check_descwl_galaxy_parity(
+        data=data, inds=np.arange(0, len(data.cat), len(data.cat) // 50))
+
+    assert max_rel_diff < 1e-5
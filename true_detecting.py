@@ -38,7 +38,12 @@ def make_true_detections(*, tilename, bands, output_meds_dir, box_size, config):
         "true detection" catalogs. The source extractor columns are hacked
         so that the MEDS making code produces this box size.
     config : dict
-        A dictionary with the config params for the simulations
+        A dictionary with the config params for the simulations. If
+        `config['true_detection']['coadd_placeholder']` is True, the coadd
+        image is not copied, decompressed and zeroed. Instead a placeholder
+        with its header (and so its WCS) and compressed all-zero pixels is
+        written for the MEDS making code, along with the coadd weight and
+        bmask. The seg map is copied as usual.
     """
 
     logger.info(' processing coadd tile %s', tilename)
@@ -48,8 +53,13 @@ def make_true_detections(*, tilename, bands, output_meds_dir, box_size, config):
         medsconf=MEDSCONF,
         tilename=tilename))
 
+    if config['true_detection'].get('coadd_placeholder', False):
+        _make_coadd = _write_coadd_placeholder
+    else:
+        _make_coadd = _copy_and_munge_coadd
+
     for band in bands:
-        dest_cat_file = _copy_and_munge_coadd(
+        dest_cat_file = _make_coadd(
             tilename=tilename,
             band=band,
             output_meds_dir=output_meds_dir)
@@ -182,3 +192,69 @@ def _copy_and_munge_coadd(*, tilename, band, output_meds_dir):
         pass
 
     return info['cat_path'].replace(TMP_DIR, output_meds_dir)
+
+
+def _write_coadd_placeholder(*, tilename, band, output_meds_dir):
+    # read band info
+    fname = get_band_info_file(
+        meds_dir=output_meds_dir,
+        medsconf=MEDSCONF,
+        tilename=tilename,
+        band=band)
+    with open(fname, 'r') as fp:
+        info = yaml.load(fp, Loader=yaml.Loader)
+
+    # the coadd image pixels are never used for fitting, so only the image
+    # is replaced by compressed zeros with the header (and so the WCS) of
+    # the coadd. The weight, bmask and seg maps are kept as they are, since
+    # a coadd cutout with zero weight would be dropped when the MEDS files
+    # are read.
+    logger.info(' writing coadd image placeholder for band %s', band)
+    for kind in ['weight', 'bmask']:
+        if info['%s_path' % kind] != info['image_path']:
+            raise ValueError(
+                'The coadd placeholder needs the coadd %s in the image '
+                'file!' % kind)
+
+    dest_file = info['image_path'].replace(TMP_DIR, output_meds_dir)
+    make_dirs_for_file(dest_file)
+    _write_placeholder_hdus(
+        src_file=expand_path(info['image_path']),
+        dest_file=dest_file,
+        zero_ext=info['image_ext'],
+        copy_exts=[info['weight_ext'], info['bmask_ext']],
+        shape=tuple(info['image_shape']))
+
+    dest_seg_file = info['seg_path'].replace(TMP_DIR, output_meds_dir)
+    make_dirs_for_file(dest_seg_file)
+    shutil.copy(expand_path(info['seg_path']), dest_seg_file)
+
+    return info['cat_path'].replace(TMP_DIR, output_meds_dir)
+
+
+def _write_placeholder_hdus(
+        *, src_file, dest_file, zero_ext, copy_exts, shape, n_rows=1000):
+    # write the image in chunks of rows so that we never hold the full
+    # image, zeros for `zero_ext` and the source pixels for `copy_exts`
+    tmp_file = dest_file + '.tmp%d' % os.getpid()
+    with fitsio.FITS(src_file) as src, \
+            fitsio.FITS(tmp_file, mode='rw', clobber=True) as fits:
+        for ext in [zero_ext] + list(copy_exts):
+            hdr = src[ext].read_header()
+            hdr.clean()
+            if ext == zero_ext:
+                dtype = 'f4'
+            else:
+                dtype = src[ext][0:1, 0:1].dtype
+            fits.create_image_hdu(
+                dims=shape, dtype=dtype, extname=ext, header=hdr,
+                compress='RICE', qmethod='SUBTRACTIVE_DITHER_2')
+            zeros = np.zeros((n_rows, shape[1]), dtype=dtype)
+            for row in range(0, shape[0], n_rows):
+                end = min(row + n_rows, shape[0])
+                if ext == zero_ext:
+                    data = zeros[:end - row]
+                else:
+                    data = src[ext][row:end, :]
+                fits[-1].write(data, start=[row, 0])
+    os.replace(tmp_file, dest_file)
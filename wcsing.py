@@ -1,4 +1,5 @@
 from functools import lru_cache
+import numpy as np
 import fitsio
 import esutil.wcsutil
 import galsim
@@ -48,3 +49,437 @@ def get_galsim_wcs(*, image_path, image_ext):
     wcs = galsim.FitsWCS(header=hd)
     assert not isinstance(wcs, galsim.PixelScale)  # this has been a problem
     return wcs
+
+
+def get_image_positions_and_jacobians(*, wcs, ra, dec):
+    """Get the image positions and local WCS jacobians of many objects at
+    once.
+
+    The positions come from the array form of `wcs.radecToxy`. The
+    jacobians are found with the same one pixel central finite differences
+    of `wcs.xyToradec` that `wcs.local` uses, so they match it, but for all
+    objects in one vectorized call. If `wcs` is an `AffineGridWCS`, its
+    interpolated positions and jacobians are returned instead.
+
+    Parameters
+    ----------
+    wcs : galsim celestial WCS or AffineGridWCS
+        The WCS object.
+    ra : np.ndarray
+        The right ascension of the objects in degrees.
+    dec : np.ndarray
+        The declination of the objects in degrees.
+
+    Returns
+    -------
+    x : np.ndarray
+        The x positions in one-indexed, pixel centered image coordinates.
+    y : np.ndarray
+        The y positions in one-indexed, pixel centered image coordinates.
+    jac : np.ndarray, shape (n, 4)
+        The jacobians (dudx, dudy, dvdx, dvdy) in arcsec per pixel, in the
+        order of the arguments to `galsim.JacobianWCS`.
+    """
+    if isinstance(wcs, AffineGridWCS):
+        return wcs.get_image_positions_and_jacobians(ra=ra, dec=dec)
+
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    x, y = wcs.radecToxy(ra, dec, units=galsim.degrees)
+    x = np.atleast_1d(x)
+    y = np.atleast_1d(y)
+
+    return x, y, get_local_jacobians(wcs=wcs, x=x, y=y)
+
+
+def get_local_jacobians(*, wcs, x, y):
+    """Get the local WCS jacobians at many image positions at once.
+
+    This uses the same one pixel central finite differences as `wcs.local`.
+
+    Parameters
+    ----------
+    wcs : galsim celestial WCS or AffineGridWCS
+        The WCS object.
+    x : np.ndarray
+        The x positions in one-indexed, pixel centered image coordinates.
+    y : np.ndarray
+        The y positions in one-indexed, pixel centered image coordinates.
+
+    Returns
+    -------
+    jac : np.ndarray, shape (n, 4)
+        The jacobians (dudx, dudy, dvdx, dvdy) in arcsec per pixel, in the
+        order of the arguments to `galsim.JacobianWCS`.
+    """
+    if isinstance(wcs, AffineGridWCS):
+        return wcs.jacobians(x, y)
+
+    x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+
+    # the center plus steps of one pixel in +/-x and +/-y
+    xs = np.concatenate([x, x + 1, x - 1, x, x])
+    ys = np.concatenate([y, y, y, y + 1, y - 1])
+    _ra, _dec = wcs.xyToradec(xs, ys, units=galsim.radians)
+    _ra = _ra.reshape(5, -1)
+    _dec = _dec.reshape(5, -1)
+
+    # wrap ra to be near the center
+    _ra = np.where(_ra < _ra[0] - np.pi, _ra + 2*np.pi, _ra)
+    _ra = np.where(_ra > _ra[0] + np.pi, _ra - 2*np.pi, _ra)
+
+    # u points west, so du is the negative of dra
+    cosdec = np.cos(_dec[0])
+    factor = galsim.radians / galsim.arcsec
+    return np.stack([
+        -0.5 * (_ra[1] - _ra[2]) * cosdec,
+        -0.5 * (_ra[3] - _ra[4]) * cosdec,
+        0.5 * (_dec[1] - _dec[2]),
+        0.5 * (_dec[3] - _dec[4]),
+    ], axis=1) * factor
+
+
+@lru_cache(maxsize=256)
+def get_wcs_surrogate(
+        *, image_path, image_ext, image_shape, max_pos_err,
+        max_jac_err=1e-5):
+    """Build an `AffineGridWCS` for an image from its galsim WCS.
+
+    Parameters
+    ----------
+    image_path : str
+        The path to the image.
+    image_ext : int or str
+        The extension with the WCS information.
+    image_shape : tuple of ints
+        The shape of the image.
+    max_pos_err : float
+        The largest allowed position error in pixels.
+    max_jac_err : float, optional
+        The largest allowed error of an element of the local jacobians in
+        arcsec per pixel. Default is 1e-5.
+
+    Returns
+    -------
+    wcs : AffineGridWCS
+        The WCS surrogate.
+    """
+    return AffineGridWCS(
+        wcs=get_galsim_wcs(image_path=image_path, image_ext=image_ext),
+        image_shape=tuple(image_shape),
+        max_pos_err=max_pos_err,
+        max_jac_err=max_jac_err)
+
+
+class AffineGridWCS(object):
+    """A piecewise-affine approximation to a celestial WCS over an image.
+
+    The WCS is evaluated once on a regular grid of nodes covering the image
+    plus a buffer. Positions are bilinearly interpolated between the nodes
+    on the tangent plane at the image center and the local jacobians are
+    bilinearly interpolated between the exact ones at the nodes. The
+    inverse (world to image) is found with Newton iterations on the
+    interpolated map.
+
+    The grid spacing is halved until the position error and the error of
+    the elements of the local jacobians, both measured against the exact
+    WCS at the centers and edge midpoints of all of the grid cells, are
+    below `max_pos_err` and `max_jac_err`.
+
+    Parameters
+    ----------
+    wcs : galsim celestial WCS
+        The WCS to approximate.
+    image_shape : tuple of ints
+        The shape of the image.
+    max_pos_err : float, optional
+        The largest allowed position error in pixels. Default is 1e-3.
+    max_jac_err : float, optional
+        The largest allowed error of an element of the local jacobians in
+        arcsec per pixel. Default is 1e-5.
+    buffer : int, optional
+        The number of pixels past the edge of the image covered by the grid.
+        Default is 256.
+    spacing : int, optional
+        The initial grid spacing in pixels. Default is 256.
+    min_spacing : int, optional
+        The smallest grid spacing to try. Default is 8.
+
+    Attributes
+    ----------
+    pos_err : float
+        The measured maximum position error in pixels.
+    jac_err : float
+        The measured maximum error of an element of the local jacobians in
+        arcsec per pixel.
+    spacing : int
+        The grid spacing in pixels.
+
+    Methods
+    -------
+    get_image_positions_and_jacobians(ra, dec)
+        Get the image positions and local jacobians for many objects.
+    radecToxy(ra, dec)
+        Convert world to image coordinates.
+    xyToradec(x, y)
+        Convert image to world coordinates.
+    jacobians(x, y)
+        Get the local jacobians at many image positions.
+    toImage(world_pos)
+        Get the image position of a `galsim.CelestialCoord`.
+    local(image_pos)
+        Get the local WCS at an image position.
+    jacobian(image_pos)
+        Same as `local`.
+
+    Raises
+    ------
+    RuntimeError
+        If the position or jacobian error cannot be brought below
+        `max_pos_err` or `max_jac_err`.
+    """
+    def __init__(
+            self, *, wcs, image_shape, max_pos_err=1e-3, max_jac_err=1e-5,
+            buffer=256, spacing=256, min_spacing=8):
+        self.wcs = wcs
+        self.image_shape = image_shape
+        self.max_pos_err = max_pos_err
+        self.max_jac_err = max_jac_err
+        self.buffer = buffer
+
+        # the tangent plane of the interpolation
+        self._ra0, self._dec0 = [
+            float(np.atleast_1d(c)[0]) for c in wcs.xyToradec(
+                (image_shape[1] + 1) / 2,
+                (image_shape[0] + 1) / 2,
+                units=galsim.radians)]
+
+        while True:
+            self._build(spacing)
+            self.pos_err, self.jac_err = self._measure_errs()
+            if self.pos_err <= max_pos_err and self.jac_err <= max_jac_err:
+                break
+            if spacing // 2 < min_spacing:
+                raise RuntimeError(
+                    "could not approximate the WCS to %g pixels and %g "
+                    "arcsec per pixel in the jacobian with a grid spacing of "
+                    "%d pixels (errors are %g pixels and %g arcsec per "
+                    "pixel)!" % (
+                        max_pos_err, max_jac_err, spacing, self.pos_err,
+                        self.jac_err))
+            spacing //= 2
+
+    def _build(self, spacing):
+        self.spacing = spacing
+        self._x = np.arange(
+            1 - self.buffer, self.image_shape[1] + self.buffer + spacing,
+            spacing, dtype=np.float64)
+        self._y = np.arange(
+            1 - self.buffer, self.image_shape[0] + self.buffer + spacing,
+            spacing, dtype=np.float64)
+        xg, yg = np.meshgrid(self._x, self._y)
+        shape = xg.shape
+
+        ra, dec = self.wcs.xyToradec(
+            xg.ravel(), yg.ravel(), units=galsim.radians)
+        u, v = self._project(ra, dec)
+        self._u = u.reshape(shape)
+        self._v = v.reshape(shape)
+        self._jac = get_local_jacobians(
+            wcs=self.wcs, x=xg.ravel(), y=yg.ravel()).reshape(shape + (4,))
+
+    def _project(self, ra, dec):
+        # gnomonic projection to the tangent plane in arcsec, with u
+        # pointing west as in galsim
+        cos_dra = np.cos(ra - self._ra0)
+        cosc = (
+            np.sin(self._dec0) * np.sin(dec)
+            + np.cos(self._dec0) * np.cos(dec) * cos_dra)
+        factor = galsim.radians / galsim.arcsec
+        u = -np.cos(dec) * np.sin(ra - self._ra0) / cosc * factor
+        v = (
+            np.cos(self._dec0) * np.sin(dec)
+            - np.sin(self._dec0) * np.cos(dec) * cos_dra) / cosc * factor
+        return u, v
+
+    def _deproject(self, u, v):
+        factor = galsim.arcsec / galsim.radians
+        x = -u * factor
+        y = v * factor
+        rho = np.sqrt(x**2 + y**2)
+        c = np.arctan(rho)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sin_c_rho = np.where(rho > 0, np.sin(c) / rho, 1.0)
+        dec = np.arcsin(
+            np.cos(c) * np.sin(self._dec0)
+            + y * sin_c_rho * np.cos(self._dec0))
+        ra = self._ra0 + np.arctan2(
+            x * sin_c_rho,
+            np.cos(self._dec0) * np.cos(c)
+            - y * sin_c_rho * np.sin(self._dec0))
+        return ra, dec
+
+    def _cell(self, x, y):
+        ix = np.clip(
+            np.floor((x - self._x[0]) / self.spacing).astype(int),
+            0, len(self._x) - 2)
+        iy = np.clip(
+            np.floor((y - self._y[0]) / self.spacing).astype(int),
+            0, len(self._y) - 2)
+        tx = (x - self._x[ix]) / self.spacing
+        ty = (y - self._y[iy]) / self.spacing
+        return ix, iy, tx, ty
+
+    @staticmethod
+    def _bilinear(arr, ix, iy, tx, ty):
+        if arr.ndim == 3:
+            tx = tx[:, np.newaxis]
+            ty = ty[:, np.newaxis]
+        return (
+            (1 - tx) * (1 - ty) * arr[iy, ix]
+            + tx * (1 - ty) * arr[iy, ix + 1]
+            + (1 - tx) * ty * arr[iy + 1, ix]
+            + tx * ty * arr[iy + 1, ix + 1])
+
+    def _xy_to_uv(self, x, y):
+        ix, iy, tx, ty = self._cell(x, y)
+        u = self._bilinear(self._u, ix, iy, tx, ty)
+        v = self._bilinear(self._v, ix, iy, tx, ty)
+
+        # the derivatives of the bilinear map for the inverse
+        h = self.spacing
+        dudx = (
+            (1 - ty) * (self._u[iy, ix + 1] - self._u[iy, ix])
+            + ty * (self._u[iy + 1, ix + 1] - self._u[iy + 1, ix])) / h
+        dudy = (
+            (1 - tx) * (self._u[iy + 1, ix] - self._u[iy, ix])
+            + tx * (self._u[iy + 1, ix + 1] - self._u[iy, ix + 1])) / h
+        dvdx = (
+            (1 - ty) * (self._v[iy, ix + 1] - self._v[iy, ix])
+            + ty * (self._v[iy + 1, ix + 1] - self._v[iy + 1, ix])) / h
+        dvdy = (
+            (1 - tx) * (self._v[iy + 1, ix] - self._v[iy, ix])
+            + tx * (self._v[iy + 1, ix + 1] - self._v[iy, ix + 1])) / h
+        return u, v, dudx, dudy, dvdx, dvdy
+
+    def _uv_to_xy(self, u, v, n_iter=20, tol=1e-8):
+        # start at the image center and iterate
+        x = np.full_like(u, (self.image_shape[1] + 1) / 2)
+        y = np.full_like(u, (self.image_shape[0] + 1) / 2)
+        for _ in range(n_iter):
+            _u, _v, dudx, dudy, dvdx, dvdy = self._xy_to_uv(x, y)
+            du = u - _u
+            dv = v - _v
+            det = dudx * dvdy - dudy * dvdx
+            dx = (dvdy * du - dudy * dv) / det
+            dy = (-dvdx * du + dudx * dv) / det
+            x += dx
+            y += dy
+            if np.all(np.abs(dx) < tol) and np.all(np.abs(dy) < tol):
+                break
+        return x, y
+
+    def _measure_errs(self):
+        # the interpolation is worst away from the nodes, so check the
+        # cell centers and edge midpoints
+        h = self.spacing
+        xc = np.concatenate([self._x[:-1] + h / 2, self._x])
+        yc = np.concatenate([self._y[:-1] + h / 2, self._y])
+        xg, yg = np.meshgrid(xc, yc)
+        xg = xg.ravel()
+        yg = yg.ravel()
+
+        ra, dec = self.wcs.xyToradec(xg, yg, units=galsim.radians)
+        x, y = self._uv_to_xy(*self._project(ra, dec))
+        pos_err = float(np.max(np.hypot(x - xg, y - yg)))
+
+        jac_err = float(np.max(np.abs(
+            self.jacobians(xg, yg) -
+            get_local_jacobians(wcs=self.wcs, x=xg, y=yg))))
+        return pos_err, jac_err
+
+    def radecToxy(self, ra, dec):
+        """Convert world to image coordinates.
+
+        Parameters
+        ----------
+        ra : np.ndarray
+            The right ascension in degrees.
+        dec : np.ndarray
+            The declination in degrees.
+
+        Returns
+        -------
+        x, y : np.ndarray
+            The positions in one-indexed, pixel centered image coordinates.
+        """
+        ra = np.deg2rad(np.atleast_1d(np.asarray(ra, dtype=np.float64)))
+        dec = np.deg2rad(np.atleast_1d(np.asarray(dec, dtype=np.float64)))
+        return self._uv_to_xy(*self._project(ra, dec))
+
+    def xyToradec(self, x, y):
+        """Convert image to world coordinates.
+
+        Parameters
+        ----------
+        x, y : np.ndarray
+            The positions in one-indexed, pixel centered image coordinates.
+
+        Returns
+        -------
+        ra, dec : np.ndarray
+            The right ascension and declination in degrees.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        u, v = self._xy_to_uv(x, y)[:2]
+        ra, dec = self._deproject(u, v)
+        return np.rad2deg(ra) % 360, np.rad2deg(dec)
+
+    def jacobians(self, x, y):
+        """Get the local jacobians at many image positions.
+
+        Parameters
+        ----------
+        x, y : np.ndarray
+            The positions in one-indexed, pixel centered image coordinates.
+
+        Returns
+        -------
+        jac : np.ndarray, shape (n, 4)
+            The jacobians (dudx, dudy, dvdx, dvdy) in arcsec per pixel.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        return self._bilinear(self._jac, *self._cell(x, y))
+
+    def get_image_positions_and_jacobians(self, *, ra, dec):
+        """Get the image positions and local jacobians for many objects.
+        See `wcsing.get_image_positions_and_jacobians`."""
+        x, y = self.radecToxy(ra, dec)
+        return x, y, self.jacobians(x, y)
+
+    def toImage(self, world_pos):
+        """Get the image position of a `galsim.CelestialCoord`."""
+        x, y = self.radecToxy(world_pos.ra.deg, world_pos.dec.deg)
+        return galsim.PositionD(x=x[0], y=y[0])
+
+    def local(self, image_pos):
+        """Get the local WCS at an image position.
+
+        Parameters
+        ----------
+        image_pos : galsim.PositionD
+            The image position in one-indexed, pixel centered coordinates.
+
+        Returns
+        -------
+        wcs : galsim.JacobianWCS
+            The local WCS.
+        """
+        return galsim.JacobianWCS(*self.jacobians(image_pos.x, image_pos.y)[0])
+
+    def jacobian(self, image_pos):
+        """Same as `local`."""
+        return self.local(image_pos)